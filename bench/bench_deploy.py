@@ -0,0 +1,180 @@
+"""Measure end to end deployment throughput and latency offline, by
+deploying fleets of nodes to a simulated cloud whose nodes are served
+by an in-process SSH server, for each combination of node count, file
+count and file size.
+
+Typical usage: $ python bench/bench_deploy.py --nodes 1,8,32 --files 10,100"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import logging
+import math
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import provision.config as config
+import provision.engine as engine
+import provision.nodelib as nodelib
+import provision.workers as workers
+
+from bench.fakecloud import FakeCloud
+
+BUNDLE = 'bench'
+SCRIPT = '''#!/bin/sh
+# bench script {0}
+ls -l "$HOME/bench" > bench-{0}.out
+'''
+
+def percentile(values, p):
+
+    """Return the nearest rank p-th percentile of values"""
+
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+def make_bundle(dirname, files, file_size, scripts):
+
+    """Write the files and scripts of a bundle to dirname, and add it
+    to config.BUNDLEMAP"""
+
+    filemap = {}
+    for i in range(files):
+        source = os.path.join(dirname, 'file-{0}'.format(i))
+        with open(source, 'wb') as f:
+            f.write(os.urandom(file_size))
+        filemap['/root/bench/file-{0}'.format(i)] = source
+    names = []
+    for i in range(scripts):
+        names.append('bench-{0}.sh'.format(i))
+        with open(os.path.join(dirname, names[-1]), 'w') as f:
+            f.write(SCRIPT.format(i))
+    config.new_bundle(BUNDLE, config.makemap(names, dirname), filemap)
+
+def run(parsed, cloud, provider, count):
+
+    """Deploy count nodes concurrently, and return the list of
+    workers.Result whose values are (seconds, NodeProxy)"""
+
+    catalog = nodelib.get_catalog(nodelib.get_driver(None, 'bench', provider), refresh=True)
+
+    def deploy(deployment):
+        start = time.time()
+        node = deployment.deploy(nodelib.get_driver(None, 'bench', provider), 0, 0, catalog,
+                                 parsed.pipeline)
+        if node.sum_exit_status() != 0:
+            raise Exception('scripts failed on {0}: {1!r}'.format(
+                    node.name, [(sd.name, sd.exit_status, sd.stderr)
+                                for sd in node.script_deployments if sd.exit_status]))
+        return time.time() - start, node
+
+    def deploy_async(loop, deployment):
+        start = time.time()
+        node = yield deployment.deploy_async(loop, nodelib.get_driver(None, 'bench', provider),
+                                             0, 0, catalog, parsed.pipeline)
+        raise engine.Return((time.time() - start, node))
+
+    deployments = [nodelib.Deployment(bundles=[BUNDLE], prefix='bench-', image_name='lucid',
+                                      archive=parsed.archive, incremental=parsed.incremental,
+                                      journal=parsed.journal, multiplex=parsed.multiplex,
+                                      parallel=parsed.parallel)
+                   for i in range(count)]
+    if not parsed.event_loop:
+        return workers.map_bounded(deploy, deployments, parsed.workers)
+
+    loop = engine.Loop(parsed.workers)
+    try:
+        futures = loop.run_until_complete(engine.gather(
+                loop, [deploy_async(loop, d) for d in deployments]))
+    finally:
+        loop.close()
+    return [workers.Result(d, value=f.result()) if f.exception() is None
+            else workers.Result(d, error=f.exception(), tb=f.tb)
+            for d, f in zip(deployments, futures)]
+
+def phases(results):
+
+    """Return the mean duration of each traced phase over results"""
+
+    durations = {}
+    for result in results:
+        if result.ok:
+            for span in result.value[1].trace.to_dicts():
+                durations.setdefault(span['name'], []).append(span['duration'])
+    return sorted((name, sum(d) / len(d)) for name, d in durations.items())
+
+def ints(text):
+    return [int(s) for s in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', default='1,4,16', type=ints)
+    parser.add_argument('--files', default='10', type=ints)
+    parser.add_argument('--file-size', default='4096', type=ints)
+    parser.add_argument('--scripts', default=5, type=int)
+    parser.add_argument('--workers', default=config.DEFAULT_WORKERS, type=int)
+    parser.add_argument('--boot-time', default=0.0, type=float,
+                        help='seconds each node takes to boot')
+    parser.add_argument('--api-latency', default=0.0, type=float,
+                        help='seconds each provider API call takes')
+    parser.add_argument('--create-failure-rate', default=0.0, type=float,
+                        help='probability of create_node failing')
+    parser.add_argument('--archive', default=False, action='store_true')
+    parser.add_argument('--incremental', default=False, action='store_true')
+    parser.add_argument('--journal', default=False, action='store_true')
+    parser.add_argument('--pipeline', default=False, action='store_true')
+    parser.add_argument('--multiplex', default=False, action='store_true')
+    parser.add_argument('--parallel', default=False, action='store_true')
+    parser.add_argument('--event-loop', default=False, action='store_true',
+                        help='deploy from a single engine.Loop instead of a thread per node')
+    parser.add_argument('--phases', default=False, action='store_true',
+                        help='also report the mean duration of each deployment phase')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true')
+    parsed = parser.parse_args()
+
+    if not parsed.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('provision').setLevel(logging.CRITICAL)
+        logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    config.DEFAULT_BUNDLES = config.DEFAULT_BOOTSTRAP_BUNDLES = []
+
+    cloud = FakeCloud(parsed.boot_time, parsed.api_latency,
+                      {'create_node': parsed.create_failure_rate}, seed=0)
+    try:
+        provider = cloud.install()
+        config.CACHE_DIR = os.path.join(cloud.dir, 'cache')
+        print('{0:>6} {1:>6} {2:>9} {3:>6} {4:>6} {5:>8} {6:>8} {7:>8} {8:>8} {9:>8}'.format(
+                'nodes', 'files', 'bytes', 'ok', 'failed', 'wall s', 'nodes/s',
+                'p50 s', 'p90 s', 'p99 s'))
+        for files, file_size, count in itertools.product(
+                parsed.files, parsed.file_size, parsed.nodes):
+            bundledir = os.path.join(cloud.dir, 'bundle-{0}-{1}'.format(files, file_size))
+            if not os.path.isdir(bundledir):
+                os.makedirs(bundledir)
+            make_bundle(bundledir, files, file_size, parsed.scripts)
+            start = time.time()
+            results = run(parsed, cloud, provider, count)
+            wall = time.time() - start
+            if parsed.verbose:
+                for result in results:
+                    if not result.ok:
+                        print(result.tb, file=sys.stderr)
+            latencies = [r.value[0] for r in results if r.ok] or [float('nan')]
+            ok = len([r for r in results if r.ok])
+            print('{0:>6} {1:>6} {2:>9} {3:>6} {4:>6} {5:>8.2f} {6:>8.2f} '
+                  '{7:>8.2f} {8:>8.2f} {9:>8.2f}'.format(
+                    count, files, file_size, ok, len(results) - ok, wall, ok / wall,
+                    percentile(latencies, 50), percentile(latencies, 90),
+                    percentile(latencies, 99)))
+            if parsed.phases:
+                for name, mean in phases(results):
+                    print('{0:>16} {1:<24} {2:>8.3f}'.format('', name, mean))
+    finally:
+        cloud.close()
+
+if __name__ == '__main__':
+    main()
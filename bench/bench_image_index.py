@@ -0,0 +1,68 @@
+"""Compare the cost of image name lookups using a linear scan of the
+image list, as image_from_name() does for a plain list, against a prebuilt
+catalog.ImageIndex, for increasingly large catalogs.
+
+Typical usage: $ python bench/bench_image_index.py"""
+
+from __future__ import print_function
+
+import argparse
+import os.path
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import provision.catalog as catalog
+
+class Image(object):
+    def __init__(self, name):
+        self.name = name
+
+def linear_image_from_name(name, images):
+    prefixed_images = [i for i in images if i.name.startswith(name)]
+    if name in [i.name for i in prefixed_images]:
+        return [i for i in prefixed_images if i.name == name][-1]
+    decorated = sorted(
+        [(catalog.natural_key(i.name), n, i) for n, i in enumerate(prefixed_images)])
+    return [i[2] for i in decorated][-1]
+
+def make_images(count, rng):
+    distros = ['Ubuntu 10.04 LTS (lucid)', 'Ubuntu 11.04 (Natty)', 'CentOS 5.6',
+               'Debian 6 (squeeze)', 'Fedora 15', 'Windows Server 2008 R2']
+    return [Image('{0} build{1}'.format(rng.choice(distros), rng.randint(0, 10 * count)))
+            for i in range(count)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000,100000')
+    parser.add_argument('--lookups', default=100, type=int)
+    parsed = parser.parse_args()
+
+    rng = random.Random(0)
+    names = ['Ubuntu 10.04', 'Ubuntu 11.04 (Natty)', 'CentOS', 'Fedora 15 build1']
+    print('{0:>8} {1:>12} {2:>12} {3:>12}'.format(
+            'images', 'build ms', 'linear us', 'index us'))
+    for size in [int(s) for s in parsed.sizes.split(',')]:
+        images = make_images(size, rng)
+        build = timeit.timeit(lambda: catalog.ImageIndex(images), number=1)
+        index = catalog.ImageIndex(images)
+        lookups = [names[n % len(names)] for n in range(parsed.lookups)]
+        linear = timeit.timeit(lambda: [linear_image_from_name(n, images) for n in lookups],
+                               number=1)
+        indexed = timeit.timeit(lambda: [index.lookup(n) for n in lookups], number=1)
+
+        # lookups after the first per name are memoized, so also time
+        # the uncached path, which only searches the names matching
+        def uncached_lookups():
+            for n in lookups:
+                index.memo.clear()
+                index.lookup(n)
+        uncached = timeit.timeit(uncached_lookups, number=1)
+        print('{0:>8} {1:>12.1f} {2:>12.1f} {3:>12.1f} ({4:.1f} uncached)'.format(
+                size, build * 1e3, linear * 1e6 / parsed.lookups,
+                indexed * 1e6 / parsed.lookups, uncached * 1e6 / parsed.lookups))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Compare configuring from a large generated site configuration
+directory, and preparing a deployment of all its bundles, with and
+without the manifest of provision/manifest.py, each in a fresh
+interpreter.
+
+Typical usage: $ python bench/bench_manifest.py --bundles 100,500"""
+
+from __future__ import print_function
+
+import argparse
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RUN = '''from __future__ import print_function
+import time
+t = time.time()
+import provision.config as config
+config.CACHE_DIR = {cachedir!r}
+config.MANIFEST_CACHE = {manifest!r}
+config.load()
+config.configure_cached([{site!r}], '/')
+configured = time.time() - t
+import provision.nodelib as nodelib
+t = time.time()
+d = nodelib.Deployment(name='bench', bundles=sorted(b for b in config.BUNDLEMAP
+                                                    if b.startswith('site-')),
+                       pubkey='', journal=True)
+d.prepare()
+print(configured, time.time() - t)'''
+
+def make_site(path, bundles, files):
+    for sub in ['scripts', 'files']:
+        os.makedirs(os.path.join(path, sub))
+    lines = ['def init(config):']
+    for b in range(bundles):
+        with open(os.path.join(path, 'scripts', 'b{0}.sh'.format(b)), 'w') as f:
+            f.write('echo bundle {0}\n'.format(b) * 50)
+        names = []
+        for n in range(files):
+            name = 'b{0}-f{1}.conf'.format(b, n)
+            with open(os.path.join(path, 'files', name), 'w') as f:
+                f.write('setting = {0}\n'.format(n) * 100)
+            names.append('/etc/site/' + name)
+        lines.append('    config.add_bundle({0!r}, [{1!r}], {2!r})'.format(
+                'site-{0}'.format(b), 'b{0}.sh'.format(b), names))
+    with open(os.path.join(path, '__init__.py'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def run(site, cachedir, manifest):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    code = RUN.format(site=site, cachedir=cachedir, manifest=manifest)
+    out, err = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+    if not out:
+        raise Exception(err.decode())
+    return [float(t) for t in out.decode().split()]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bundles', default='100,500')
+    parser.add_argument('--files', default=10, type=int, help='files per bundle')
+    parsed = parser.parse_args()
+
+    print('{0:>8} {1:>7} {2:>22} {3:>22} {4:>22}'.format(
+            'bundles', 'files', 'no manifest ms', 'recording ms', 'restored ms'))
+    for bundles in [int(b) for b in parsed.bundles.split(',')]:
+        tmp = tempfile.mkdtemp()
+        try:
+            site = os.path.join(tmp, 'benchsite')
+            cachedir = os.path.join(tmp, 'cache')
+            make_site(site, bundles, parsed.files)
+            timings = [run(site, cachedir, False), run(site, cachedir, True),
+                       run(site, cachedir, True)]
+            print('{0:>8} {1:>7} {2}'.format(bundles, bundles * parsed.files, ' '.join(
+                        '{0:>10.1f} +{1:>10.1f}'.format(c * 1000, p * 1000)
+                        for c, p in timings)))
+        finally:
+            shutil.rmtree(tmp)
+    print('(configure + prepare)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Compare connecting to many booting nodes' ssh servers by retrying
+the full handshake every few seconds, as connect_ssh_client() used to,
+and by first probing for the ssh banner, see provision/probe.py.
+
+Each node is a local port which refuses connections until the node
+finishes booting, after a random delay, and then serves ssh with
+bench/sshserver.py, in a child process.  Reported are how long after
+its server started each node was connected, the CPU time of the
+connecting process, and how many lines provision logged.
+
+Typical usage: $ python bench/bench_probe.py --nodes 50 --boot 2,10"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libcloud.compute.ssh import SSHClient
+
+import provision.patches as patches
+import provision.workers as workers
+
+from bench.sshserver import SSHServer
+
+PASSWORD = 'bench'
+
+
+def free_ports(rand, count):
+
+    """Return count unused ports below the usual ephemeral range,
+    which connections from this host to them can't themselves be
+    bound to"""
+
+    ports = set()
+    while len(ports) < count:
+        port = rand.randint(20000, 30000)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind(('127.0.0.1', port))
+            ports.add(port)
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+    return sorted(ports)
+
+
+def handshake_loop(ssh_client, wait_period=3, timeout=300):
+
+    """connect_ssh_client() without probing, as it was"""
+
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            patches.ssh_connect_once(ssh_client)
+        except patches.connect_retryable_errors():
+            patches.logger.exception(traceback.format_exc())
+            ssh_client.close()
+        else:
+            return ssh_client
+        time.sleep(wait_period)
+    raise Exception('timed out')
+
+
+def serve(root, nodes):
+
+    """Start serving ssh on the port of each of nodes, a list of
+    [port, boot delay], after its delay, printing when it did, until
+    stdin is closed"""
+
+    def start(port):
+        SSHServer(lambda u, p: root if p == PASSWORD else None, port=port).start()
+        print(port, time.time())
+        sys.stdout.flush()
+    for port, boot in nodes:
+        timer = threading.Timer(boot, start, [port])
+        timer.daemon = True
+        timer.start()
+    sys.stdin.read()
+
+
+def run(mode, nodes, root):
+    child = subprocess.Popen([sys.executable, __file__, '--serve', root, json.dumps(nodes)],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=open(os.devnull, 'w'))
+    cpu = sum(os.times()[:2])
+
+    def connect(node):
+        client = SSHClient('127.0.0.1', node[0], 'root', PASSWORD, timeout=10)
+        if mode == 'handshake':
+            handshake_loop(client)
+        else:
+            patches.NodeDriver_connect_ssh_client(None, client)
+        connected = time.time()
+        client.close()
+        return connected
+
+    results = workers.map_bounded(connect, nodes, len(nodes))
+    cpu = sum(os.times()[:2]) - cpu
+    opened = dict(line.split() for line in [child.stdout.readline().decode()
+                                            for n in nodes])
+    child.stdin.close()
+    child.wait()
+    failed = [r for r in results if not r.ok]
+    if failed:
+        raise Exception(failed[0].tb)
+    latencies = sorted(r.value - float(opened[str(r.item[0])]) for r in results)
+    return sum(latencies) / len(latencies), latencies[-1], cpu
+
+
+def main():
+    if sys.argv[1:2] == ['--serve']:
+        return serve(sys.argv[2], json.loads(sys.argv[3]))
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', default=50, type=int)
+    parser.add_argument('--boot', default='2,10',
+                        help='range of seconds before each node serves ssh')
+    parser.add_argument('--seed', default=0, type=int)
+    parsed = parser.parse_args()
+    low, high = [float(s) for s in parsed.boot.split(',')]
+
+    tmp = tempfile.mkdtemp(prefix='provision-bench-')
+    logging.getLogger().handlers = [logging.NullHandler()]
+    logged = []
+    handler = logging.Handler()
+    handler.emit = logged.append
+    logging.getLogger('provision').addHandler(handler)
+    logging.getLogger('provision').propagate = False
+    logging.getLogger('provision').setLevel(logging.DEBUG)
+    try:
+        print('{0:>10} {1:>16} {2:>16} {3:>8} {4:>10}'.format(
+                'mode', 'mean ready ms', 'max ready ms', 'cpu s', 'logged'))
+        for mode in ['handshake', 'probe']:
+            rand = random.Random(parsed.seed)
+            nodes = [[port, rand.uniform(low, high)]
+                     for port in free_ports(rand, parsed.nodes)]
+            del logged[:]
+            mean, worst, cpu = run(mode, nodes, tmp)
+            print('{0:>10} {1:>16.0f} {2:>16.0f} {3:>8.2f} {4:>10}'.format(
+                    mode, mean * 1000, worst * 1000, cpu, len(logged)))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
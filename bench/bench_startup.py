@@ -0,0 +1,78 @@
+"""Measure the startup cost of each console entry point in setup.py:
+the time to import its module, whether that imports paramiko, and the
+wall time of running it with --help, each the median of several runs
+in a fresh interpreter.
+
+Typical usage: $ python bench/bench_startup.py"""
+
+from __future__ import print_function
+
+import argparse
+import os.path
+import re
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT = '''from __future__ import print_function
+import sys, time
+t = time.time()
+import {0}
+print(time.time() - t, 'paramiko' in sys.modules)'''
+
+HELP = '''import sys
+sys.argv = ['{0}', '--help']
+import {1}
+sys.exit({1}.{2}())'''
+
+def entry_points():
+
+    """Return the (name, module, function) of each console script in setup.py"""
+
+    with open(os.path.join(ROOT, 'setup.py')) as f:
+        return re.findall(r"'([\w-]+) = ([\w.]+):(\w+)'", f.read())
+
+def python(code):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def time_import(module, runs):
+    seconds = []
+    for i in range(runs):
+        out, err = python(IMPORT.format(module)).communicate()
+        if not out:
+            raise Exception('importing {0} failed:\n{1}'.format(module, err.decode()))
+        elapsed, paramiko = out.decode().split()
+        seconds.append(float(elapsed))
+    return median(seconds), paramiko == 'True'
+
+def time_help(name, module, function, runs):
+    seconds = []
+    for i in range(runs):
+        start = time.time()
+        python(HELP.format(name, module, function)).communicate()
+        seconds.append(time.time() - start)
+    return median(seconds)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', default=5, type=int)
+    parsed = parser.parse_args()
+
+    print('{0:<14} {1:>10} {2:>9} {3:>10}'.format('command', 'import ms', 'paramiko',
+                                                  '--help ms'))
+    for name, module, function in entry_points():
+        imported, paramiko = time_import(module, parsed.runs)
+        helped = time_help(name, module, function, parsed.runs)
+        print('{0:<14} {1:>10.1f} {2:>9} {3:>10.1f}'.format(
+                name, imported * 1000, 'yes' if paramiko else 'no', helped * 1000))
+
+if __name__ == '__main__':
+    main()
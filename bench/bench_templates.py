@@ -0,0 +1,64 @@
+"""Compare preparing templated scripts for a fleet by reformatting
+each script for every node, as substitute() used to, against
+rendering templates compiled and bound once by provision.templates,
+for increasingly large scripts and fleets.
+
+Typical usage: $ python bench/bench_templates.py"""
+
+from __future__ import print_function
+
+import argparse
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import provision.config as config
+import provision.templates as templates
+
+def make_script(kind, lines, variables, node_every):
+
+    """Return a script of lines which each use a variable, and every
+    node_every lines also the node name"""
+
+    if kind == 'format-string':
+        line, node = 'echo {{var{0}}} >> /var/log/setup.log\n', 'hostname {node_name}\n'
+    else:
+        line, node = 'echo ${{var{0}}} >> /var/log/setup.log\n', 'hostname $node_name\n'
+    return '# provision-template-type: {0}\n{1}'.format(
+        kind, ''.join(line.format(i % variables) + (node if i % node_every == 0 else '')
+                      for i in range(lines)))
+
+def uncompiled(script, submap):
+    kind = templates.template_type(script)
+    return config.TEMPLATE_TYPEMAP[kind](script, submap)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', default='100,1000,10000')
+    parser.add_argument('--nodes', default='50,500')
+    parser.add_argument('--variables', default=10, type=int)
+    parser.add_argument('--node-every', default=100, type=int,
+                        help='lines per use of the node name')
+    parsed = parser.parse_args()
+
+    submap = dict(('var{0}'.format(i), 'value{0}'.format(i)) for i in range(parsed.variables))
+    print('{0:>16} {1:>7} {2:>6} {3:>12} {4:>12}'.format(
+            'type', 'lines', 'nodes', 'reformat ms', 'compiled ms'))
+    for kind in sorted(templates.COMPILERS):
+        for lines in [int(l) for l in parsed.lines.split(',')]:
+            script = make_script(kind, lines, parsed.variables, parsed.node_every)
+            for nodes in [int(n) for n in parsed.nodes.split(',')]:
+                submaps = [dict(submap, node_name='node-{0}'.format(n)) for n in range(nodes)]
+                reformat = timeit.timeit(lambda: [uncompiled(script, s) for s in submaps],
+                                         number=1)
+                templates.CACHE.clear()
+                compiled = timeit.timeit(lambda: [templates.render(script, s)
+                                                  for s in submaps], number=1)
+                assert templates.render(script, submaps[-1]) == uncompiled(script, submaps[-1])
+                print('{0:>16} {1:>7} {2:>6} {3:>12.1f} {4:>12.1f}'.format(
+                        kind, lines, nodes, reformat * 1000, compiled * 1000))
+
+if __name__ == '__main__':
+    main()
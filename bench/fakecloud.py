@@ -0,0 +1,179 @@
+"""A simulated cloud provider, for exercising deployments offline.
+
+FakeCloud holds the state of the simulated provider, shared by every
+driver for it: the nodes, when each finishes booting, and the
+directory holding each node's filesystem, as served by
+sshserver.SSHServer.  Every API call takes api_latency seconds, and
+fails with probability failure_rates[method], so that retries and
+error handling can be measured as well.  Saving an image of a node
+copies its filesystem, which nodes created from the image start with.
+
+Drivers are obtained the usual way, through nodelib.get_driver(), once
+cloud.install() has registered the cloud as a provider."""
+
+from __future__ import absolute_import
+
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from libcloud.common.types import LibcloudError
+from libcloud.compute.base import Node, NodeDriver, NodeImage, NodeLocation, NodeSize
+from libcloud.compute.types import NodeState, Provider
+
+import provision.config as config
+
+from bench.sshserver import SSHServer
+
+PROVIDER = 'fake'
+
+
+class FakeAPIError(LibcloudError):
+    pass
+
+
+class FakeCloud(object):
+
+    """The simulated provider, with an SSH server for its nodes"""
+
+    def __init__(self, boot_time=0, api_latency=0, failure_rates=None, seed=None,
+                 image_names=None):
+        self.boot_time = boot_time
+        self.api_latency = api_latency
+        self.failure_rates = failure_rates or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.nodes = {}
+        self.booted_at = {}
+        self.roots = {}
+        self.calls = {}
+        self.next_id = 1
+        self.dir = tempfile.mkdtemp(prefix='provision-bench-')
+        self.images = [NodeImage(i, name, None, {})
+                       for i, name in enumerate(sorted(image_names or
+                                                       config.IMAGE_NAMES.values()))]
+        self.sizes = [NodeSize(0, '256 server', 256, 10, None, 0.01, None)]
+        self.locations = [NodeLocation(0, 'local', 'US', None)]
+        self.sshd = SSHServer(self.authenticate).start()
+
+    def install(self, name=PROVIDER):
+
+        """Register the cloud as a provider, and point ssh at its server"""
+
+        config.PROVIDERS[name] = type('FakeNodeDriver', (FakeNodeDriver,), {'cloud': self})
+        config.SSH_PORT = self.sshd.port
+        return name
+
+    def close(self):
+        self.sshd.stop()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def call(self, method):
+
+        """Account for, delay and possibly fail an API call"""
+
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            fail = self.random.random() < self.failure_rates.get(method, 0)
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        if fail:
+            raise FakeAPIError('injected failure of {0}'.format(method))
+
+    def authenticate(self, username, password):
+        with self.lock:
+            return self.roots.get(password)
+
+    def create_node(self, driver, name, image):
+        with self.lock:
+            node_id = str(self.next_id)
+            self.next_id += 1
+            password = '{0}-{1:x}'.format(node_id, self.random.getrandbits(64))
+            node = Node(node_id, name, NodeState.PENDING, [], [], driver,
+                        extra={'password': password, 'imageId': image.id})
+            self.nodes[node_id] = node
+            self.booted_at[node_id] = time.time() + self.boot_time
+            self.roots[password] = os.path.join(self.dir, node_id)
+            if image.extra.get('root'):
+                shutil.copytree(image.extra['root'], self.roots[password], symlinks=True)
+        return node
+
+    def save_image(self, node, name):
+        with self.lock:
+            image = NodeImage(len(self.images), name, None,
+                              {'root': os.path.join(self.dir, 'image-{0}'.format(
+                                  len(self.images)))})
+            root = self.roots[self.nodes[node.id].extra['password']]
+            if os.path.isdir(root):
+                shutil.copytree(root, image.extra['root'], symlinks=True)
+            else:
+                os.makedirs(image.extra['root'])
+            self.images.append(image)
+        return image
+
+    def list_nodes(self, driver):
+        now = time.time()
+        with self.lock:
+            nodes = []
+            for node_id, node in sorted(self.nodes.items()):
+                running = now >= self.booted_at[node_id]
+                nodes.append(Node(node.id, node.name,
+                                  NodeState.RUNNING if running else NodeState.PENDING,
+                                  ['127.0.0.1'] if running else [], [], driver,
+                                  extra=dict(node.extra)))
+            return nodes
+
+    def destroy_node(self, node):
+        with self.lock:
+            return self.nodes.pop(node.id, None) is not None
+
+
+class FakeNodeDriver(NodeDriver):
+
+    """A driver for the FakeCloud it is bound to as the cloud attribute"""
+
+    name = 'Fake Node Provider'
+    type = Provider.DUMMY
+    features = {'create_node': ['generates_password']}
+    cloud = None
+
+    def __init__(self, key, secret=None, secure=True, host=None, port=None):
+        self.key = key
+        self.secret = secret
+
+    def list_nodes(self):
+        self.cloud.call('list_nodes')
+        return self.cloud.list_nodes(self)
+
+    def list_images(self, location=None):
+        self.cloud.call('list_images')
+        return [NodeImage(i.id, i.name, self, i.extra) for i in self.cloud.images]
+
+    def list_sizes(self, location=None):
+        self.cloud.call('list_sizes')
+        return [NodeSize(s.id, s.name, s.ram, s.disk, s.bandwidth, s.price, self)
+                for s in self.cloud.sizes]
+
+    def list_locations(self):
+        self.cloud.call('list_locations')
+        return [NodeLocation(l.id, l.name, l.country, self) for l in self.cloud.locations]
+
+    def create_node(self, **kwargs):
+        self.cloud.call('create_node')
+        return self.cloud.create_node(self, kwargs['name'], kwargs['image'])
+
+    def destroy_node(self, node):
+        self.cloud.call('destroy_node')
+        return self.cloud.destroy_node(node)
+
+    def ex_save_image(self, node, name):
+        self.cloud.call('ex_save_image')
+        image = self.cloud.save_image(node, name)
+        return NodeImage(image.id, image.name, self, image.extra)
+
+    def reboot_node(self, node):
+        self.cloud.call('reboot_node')
+        return True
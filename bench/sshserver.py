@@ -0,0 +1,286 @@
+"""An in-process SSH and SFTP server standing in for booted nodes.
+
+Every simulated node gets its own directory, which the server treats
+as that node's root filesystem: SFTP paths are resolved inside it, and
+absolute paths under /root in commands and their standard input, and
+the target of tar -C /, are rewritten to point inside it before the
+command is run by a local shell, with HOME set to the node's /root.  The contents of scripts
+are not rewritten, so they should refer to /root as $HOME.  Which node
+a session belongs to is determined by the password it authenticates
+with, since all nodes share one address and port.
+
+This is enough to run Deployment.deploy() unchanged against nodes
+whose targets are under /root, as the default bundles' are, without
+touching the real /root."""
+
+from __future__ import absolute_import
+
+import errno
+import fcntl
+import os
+import re
+import socket
+import subprocess
+import threading
+
+import paramiko
+
+import logging
+logger = logging.getLogger('provision.bench')
+
+HOME = '/root'
+HOME_RE = re.compile(r'''(^|[\s'"=>;&|(])(/root)(?=/|[\s'";&|)]|$)''')
+TAR_ROOT_RE = re.compile(r'(-C\s+)/(?=\s|$)')
+
+
+class NodeRoot(object):
+
+    """Translates between paths on a simulated node and the local
+    directory holding its filesystem"""
+
+    def __init__(self, root):
+        self.root = root
+        self.home = root + HOME
+        if not os.path.isdir(self.home):
+            os.makedirs(self.home)
+
+    def path(self, path):
+        if not path.startswith('/'):
+            path = os.path.join(HOME, path)
+        return self.root + os.path.normpath(path)
+
+    def command(self, command):
+        command = HOME_RE.sub(lambda m: m.group(1) + self.home, command)
+        return TAR_ROOT_RE.sub(lambda m: m.group(1) + self.root, command)
+
+    def output(self, text):
+        return text.replace(self.root, '')
+
+
+class SFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            if attr.st_mode is not None:
+                os.chmod(self.filename, attr.st_mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class NodeSFTPServer(paramiko.SFTPServerInterface):
+
+    """Serves the filesystem of the node the session authenticated as"""
+
+    def __init__(self, server, *args, **kwargs):
+        paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+        self.node = server.node
+
+    def canonicalize(self, path):
+        if not path.startswith('/'):
+            path = os.path.join(HOME, path)
+        return os.path.normpath(path)
+
+    def open(self, path, flags, attr):
+        real = self.node.path(path)
+        try:
+            mode = getattr(attr, 'st_mode', None) or 0o666
+            fd = os.open(real, flags | getattr(os, 'O_BINARY', 0), mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        # otherwise commands run concurrently for other nodes inherit
+        # it, and executing the uploaded script fails with ETXTBSY
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        if flags & os.O_WRONLY:
+            fmode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fmode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fmode = 'rb'
+        handle = SFTPHandle(flags)
+        handle.filename = real
+        handle.readfile = handle.writefile = os.fdopen(fd, fmode)
+        return handle
+
+    def _call(self, func, *args):
+        try:
+            func(*args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.node.path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        real = self.node.path(path)
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(real, f)), f)
+                    for f in os.listdir(real)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        return self._call(os.remove, self.node.path(path))
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, self.node.path(oldpath), self.node.path(newpath))
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, self.node.path(path))
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, self.node.path(path))
+
+    def chattr(self, path, attr):
+        if attr.st_mode is None:
+            return paramiko.SFTP_OK
+        return self._call(os.chmod, self.node.path(path), attr.st_mode)
+
+
+def pump(read, write):
+    while True:
+        data = read(32 * 1024)
+        if not data:
+            return
+        write(data)
+
+def execute(node, channel, command):
+
+    """Run command in a local shell on behalf of node, relaying stdin,
+    stdout, stderr and the exit status over channel"""
+
+    env = dict(os.environ, HOME=node.home)
+    proc = subprocess.Popen(node.command(command), shell=True, cwd=node.home, env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, close_fds=True)
+
+    def feed():
+        # stdin may hold commands too, e.g. for sh -s, so it is
+        # rewritten like the command, a line at a time
+        pending = ['']
+        def write(data):
+            lines = (pending[0] + data.decode('latin-1')).split('\n')
+            pending[0] = lines.pop()
+            for line in lines:
+                proc.stdin.write((node.command(line) + '\n').encode('latin-1'))
+        try:
+            pump(channel.recv, write)
+            proc.stdin.write(node.command(pending[0]).encode('latin-1'))
+            proc.stdin.close()
+        except (IOError, OSError, socket.error, EOFError):
+            pass
+
+    def relay(f, send):
+        pump(f.read1 if hasattr(f, 'read1') else lambda n: os.read(f.fileno(), n),
+             lambda data: send(node.output(data.decode('latin-1')).encode('latin-1')))
+
+    stdin = threading.Thread(target=feed)
+    stdin.daemon = True
+    stdin.start()
+    stderr = threading.Thread(target=relay, args=(proc.stderr, channel.sendall_stderr))
+    stderr.start()
+    relay(proc.stdout, channel.sendall)
+    stderr.join()
+    channel.send_exit_status(proc.wait())
+    channel.close()
+
+
+class NodeServerInterface(paramiko.ServerInterface):
+
+    def __init__(self, authenticate):
+        self.authenticate = authenticate
+        self.node = None
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        root = self.authenticate(username, password)
+        if root is None:
+            return paramiko.AUTH_FAILED
+        self.node = NodeRoot(root)
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        if isinstance(command, bytes):
+            command = command.decode('utf-8')
+        t = threading.Thread(target=execute, args=(self.node, channel, command))
+        t.daemon = True
+        t.start()
+        return True
+
+
+class SSHServer(object):
+
+    """Accepts SSH connections on a local port, until stopped.
+
+    authenticate(username, password) returns the directory holding
+    the filesystem of the node whose credentials those are, or None."""
+
+    def __init__(self, authenticate, host='127.0.0.1', port=0, host_key=None):
+        self.authenticate = authenticate
+        self.host_key = host_key or paramiko.RSAKey.generate(1024)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.host, self.port = self.sock.getsockname()
+        self.transports = []
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve, name='bench-sshd')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EBADF, errno.EINVAL):
+                    return # stopped
+                raise
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, NodeSFTPServer)
+            self.transports.append(transport)
+            t = threading.Thread(target=self.negotiate, args=(transport, addr))
+            t.daemon = True
+            t.start()
+
+    def negotiate(self, transport, addr):
+        try:
+            transport.start_server(server=NodeServerInterface(self.authenticate))
+        except (paramiko.SSHException, EOFError, socket.error) as e:
+            logger.debug('ssh negotiation with {0} failed: {1}'.format(addr, e))
+            # paramiko leaves its handshake timer running, such as after a
+            # readiness probe disconnects, see provision.probe
+            transport.packetizer.complete_handshake()
+
+    def stop(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
@@ -0,0 +1,153 @@
+"""Bake images with bundles preinstalled, so that deployments which
+install the same leading bundles only need to boot, and install the
+rest.
+
+A baked image is made by deploying a node with the bundles, saving a
+snapshot of it through the driver's image API, and recording the
+bundles' fingerprints in the provision.registry of the account."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hashlib
+import sys
+import time
+import argparse
+
+from libcloud.common.types import LibcloudError
+
+import provision.config as config
+import provision.nodelib as nodelib
+import provision.registry
+
+logger = config.logger
+
+IMAGE_READY_STATES = [None, 'ACTIVE', 'active', 'available']
+IMAGE_FAILED_STATES = ['FAILED', 'failed', 'error']
+
+
+class BakeError(Exception):
+    pass
+
+
+def save_image(driver, node, name):
+
+    """Start saving an image of node named name, using whichever image
+    API driver has, and return the NodeImage"""
+
+    if hasattr(driver, 'create_image'):
+        return driver.create_image(node, name)
+    if hasattr(driver, 'ex_save_image'):
+        return driver.ex_save_image(node, name)
+    raise BakeError('{0} cannot save images of nodes'.format(driver.name))
+
+def wait_for_image(driver, image, wait_period=5, timeout=3600):
+
+    """Return the listed image with the id of image, once its status
+    shows it can be deployed"""
+
+    end = time.time() + timeout
+    while time.time() < end:
+        for listed in driver.list_images():
+            if str(listed.id) != str(image.id):
+                continue
+            status = listed.extra.get('status')
+            if status in IMAGE_READY_STATES:
+                return listed
+            if status in IMAGE_FAILED_STATES:
+                raise BakeError('saving image {0} failed'.format(image.name))
+            logger.debug('image {0} is {1}'.format(image.name, status))
+        time.sleep(wait_period)
+    raise LibcloudError(value='Timed out after %s seconds' % (timeout), driver=driver)
+
+def baked_name(base, fingerprints, prefix=None):
+
+    """Return a name for an image baked from base with the bundles of
+    fingerprints, which differs whenever they do"""
+
+    digest = hashlib.sha1(repr(fingerprints).encode('utf-8')).hexdigest()
+    return '{0}{1}-{2}'.format(prefix or config.BAKED_IMAGE_PREFIX, base, digest[:10])
+
+def bake(driver, bundles=[], image_name=config.DEFAULT_IMAGE_NAME, name=None,
+         location_id=config.DEFAULT_LOCATION_ID, size_id=config.DEFAULT_SIZE_ID,
+         catalog=None, subvars=[], keep_node=False):
+
+    """Deploy a node with bundles, along with the default bundles of
+    the image, save an image of it named name, register the image as
+    baked from image_name, and return its BakedImage.
+
+    Baking always starts from the base image, and the node is
+    destroyed afterwards, even if saving its image fails, unless
+    keep_node is True, or it could not be deployed cleanly."""
+
+    deployment = nodelib.Deployment(bundles=bundles, image_name=image_name,
+                                    subvars=subvars, journal=False, baked=False)
+    fingerprints = [(b, provision.registry.bundle_fingerprint(config.BUNDLEMAP[b],
+                                                              deployment.submap))
+                    for b in deployment.install_bundles]
+    for b, fingerprint in fingerprints:
+        if fingerprint is None:
+            logger.warn('bundle {0} has scripts templated per node, so nodes deployed '
+                        'from the baked image install it and later bundles again'.format(b))
+            break
+    name = name or baked_name(image_name, fingerprints)
+
+    if catalog is None:
+        catalog = nodelib.get_catalog(driver)
+    node = deployment.deploy(driver, location_id, size_id, catalog)
+    if node.sum_exit_status() != 0:
+        raise BakeError('not baking {0}, scripts failed on node {1}: {2}'.format(
+                name, node.name, ', '.join('{0.name}={0.exit_status}'.format(sd)
+                                           for sd in node.script_deployments
+                                           if sd.exit_status)))
+
+    try:
+        logger.info('saving image {0} of node {1}'.format(name, node.name))
+        image = wait_for_image(driver, save_image(driver, node.node, name))
+        baked = provision.registry.BakedImage(image.id, image.name, image_name, fingerprints)
+        provision.registry.add(provision.registry.registry_path(driver, config.CACHE_DIR),
+                               baked)
+        nodelib.get_catalog(driver, refresh=True) # so deployments can find the new image
+    finally:
+        if not keep_node:
+            node.destroy()
+    return baked
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='Bake an image with bundles preinstalled')
+    config.add_auth_args(parser, config)
+    parser.add_argument('-b', '--bundles', default=[], action='append')
+    parser.add_argument('-i', '--image', default=config.DEFAULT_IMAGE_NAME,
+                        help='name of the image to bake from')
+    parser.add_argument('-l', '--location', default=config.DEFAULT_LOCATION_ID, type=int)
+    parser.add_argument('-n', '--name',
+                        help='name of the baked image, generated from its bundles by default')
+    parser.add_argument('-s', '--size', default=config.DEFAULT_SIZE_ID, type=int)
+    parser.add_argument('-t', '--subvars', default=[], action='append',
+                        help='key=value pairs of template substitution variables')
+    parser.add_argument('-v', '--verbose', default=True)
+    parser.add_argument('--keep-node', default=False, action='store_true',
+                        help='do not destroy the node once its image is saved')
+    parser.add_argument('--list', default=False, action='store_true',
+                        help='list the baked images of the account instead of baking')
+    return parser
+
+def bake_image(parsed):
+    driver = nodelib.get_driver(parsed.secret_key, parsed.userid, parsed.provider)
+    if parsed.list:
+        for baked in provision.registry.load(
+            provision.registry.registry_path(driver, config.CACHE_DIR)):
+            print(baked)
+        return 0
+    baked = bake(driver, parsed.bundles, parsed.image, parsed.name, parsed.location,
+                 parsed.size, subvars=parsed.subvars, keep_node=parsed.keep_node)
+    if parsed.verbose:
+        print(baked)
+    return 0
+
+def main():
+    return config.handle_errors(bake_image, config.reconfig(parser))
+
+if __name__ == '__main__':
+    sys.exit(main())
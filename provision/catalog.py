@@ -0,0 +1,188 @@
+"""On-disk cache of each account's locations, sizes and images.
+
+Listing them takes three slow provider API calls, and the image list
+can hold hundreds of entries, yet they rarely change.  Caching them
+lets deploy() go straight to creating the node."""
+
+from __future__ import absolute_import
+
+import bisect
+import copy
+import os
+import re
+import tempfile
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import logging
+logger = logging.getLogger('provision')
+
+
+class Catalog(object):
+
+    """The locations, sizes and images available to an account"""
+
+    def __init__(self, locations, sizes, images, timestamp=None):
+        self.locations = locations
+        self.sizes = sizes
+        self.images = images
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    @classmethod
+    def fetch(cls, driver):
+        logger.debug('fetching catalog using driver {0}'.format(driver))
+        return cls(driver.list_locations(), driver.list_sizes(), driver.list_images())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_image_index', None)
+        return state
+
+    def image_index(self):
+
+        """Return an ImageIndex of the images, building it on first use"""
+
+        if getattr(self, '_image_index', None) is None:
+            self._image_index = ImageIndex(self.images)
+        return self._image_index
+
+    def entries(self):
+        return self.locations + self.sizes + self.images
+
+    def attach(self, driver):
+
+        """Bind every entry to driver, since drivers aren't cached"""
+
+        for entry in self.entries():
+            entry.driver = driver
+        return self
+
+    def age(self):
+        return time.time() - self.timestamp
+
+    def save(self, path):
+
+        """Atomically write the catalog to path, without its driver"""
+
+        detached = copy.copy(self)
+        detached.locations, detached.sizes, detached.images = [
+            [copy.copy(e) for e in entries]
+            for entries in (self.locations, self.sizes, self.images)]
+        for entry in detached.entries():
+            entry.driver = None
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(detached, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+NUMBER_RE = re.compile(r'\d+')
+
+def natural_key(name):
+
+    """Return the first number in name, or -1 if it has none"""
+
+    match = NUMBER_RE.search(name)
+    return int(match.group(0)) if match else -1
+
+
+class ImageIndex(object):
+
+    """Answer repeated image name lookups without scanning every image.
+
+    Names are kept sorted, so the images starting with a given prefix
+    form a contiguous range found by bisection, and only that range is
+    searched for the largest natural key.  Results are memoized by name."""
+
+    def __init__(self, images):
+        self.images = list(images)
+        self.exact = {}
+        for image in self.images:
+            self.exact[image.name] = image # last exact match wins
+        # ties in natural key go to the image later in the original list
+        order = sorted(range(len(self.images)), key=lambda i: self.images[i].name)
+        self.names = [self.images[i].name for i in order]
+        self.keys = [(natural_key(self.images[i].name), i) for i in order]
+        self.memo = {}
+
+    def lookup(self, name):
+
+        """Return the last image named exactly name if there is one,
+        otherwise the image starting with name with the largest
+        natural key.  Raise IndexError if no image starts with name."""
+
+        if name not in self.memo:
+            if name in self.exact:
+                self.memo[name] = self.exact[name]
+            else:
+                lo = bisect.bisect_left(self.names, name)
+                hi = self.prefix_end(name, lo)
+                if lo == hi:
+                    raise IndexError('no image name starts with {0!r}'.format(name))
+                self.memo[name] = self.images[max(self.keys[lo:hi])[1]]
+        return self.memo[name]
+
+    def prefix_end(self, name, lo):
+
+        """Return the sorted position after the last name starting with
+        name, given the position lo of the first, by bisection, since
+        names starting with name are contiguous"""
+
+        hi = len(self.names)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.names[mid].startswith(name):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+def catalog_path(driver, cachedir):
+
+    """Return the cache file path for the driver's provider and account"""
+
+    key = re.sub(r'[^\w.-]', '_', '{0}-{1}'.format(driver.type, driver.key))
+    return os.path.join(cachedir, 'catalog-{0}.pickle'.format(key))
+
+_lock = threading.Lock()
+
+def get_catalog(driver, cachedir, ttl, refresh=False):
+
+    """Return the catalog for driver's account from cachedir, unless it
+    is older than ttl seconds, missing, unreadable, or refresh is True,
+    in which case fetch it using driver and update the cache."""
+
+    path = catalog_path(driver, cachedir)
+    _lock.acquire()
+    try:
+        if not refresh and os.path.exists(path):
+            try:
+                catalog = Catalog.load(path)
+            except Exception as e:
+                logger.warn('ignoring unreadable catalog {0}: {1}'.format(path, e))
+            else:
+                if catalog.age() < ttl:
+                    logger.debug('using cached catalog {0}'.format(path))
+                    return catalog.attach(driver)
+        catalog = Catalog.fetch(driver)
+        try:
+            catalog.save(path)
+        except (IOError, OSError) as e:
+            logger.warn('unable to cache catalog {0}: {1}'.format(path, e))
+        return catalog
+    finally:
+        _lock.release()
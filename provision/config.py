@@ -10,6 +10,11 @@ directories outside the source tree.
 The second step specifies which bundles to install on the new node,
 and any other details specific to the deployment.
 
+Importing this module is cheap: the configuration directories are
+only imported by load(), and libcloud is only patched by
+patch_libcloud(), which reconfig() and provision.nodelib call for the
+commands that need them.
+
 Each bundle represents a set of files to be copied and scripts to be
 run during node deployment."""
 
@@ -33,6 +38,8 @@ join = os.path.join
 PROVIDERS = {
     'rackspace': Provider.RACKSPACE}
 
+CREDENTIALS = {} # provider name: (userid, secret key), for list-nodes -P
+
 IMAGE_NAMES = {
     'karmic': 'Ubuntu 9.10 (karmic)',
     'lucid': 'Ubuntu 10.04 LTS (lucid)',
@@ -43,7 +50,12 @@ DEFAULT_IMAGE_NAME = 'lucid'
 DEFAULT_LOCATION_ID = 0
 DEFAULT_SIZE_ID = 0
 
-DEFAULT_PUBKEY = open(os.path.expanduser('~/.ssh/id_rsa.pub')).read()
+DEFAULT_PROVIDER = None # these are set by configuration directories
+DEFAULT_USERID = None
+DEFAULT_SECRET_KEY = None
+
+DEFAULT_PUBKEY = None # read from DEFAULT_PUBKEY_PATH by default_pubkey() unless set
+DEFAULT_PUBKEY_PATH = os.path.expanduser('~/.ssh/id_rsa.pub')
 
 # Note that the last directory in the path cannot start with a '.'
 # due to module naming restrictions
@@ -54,12 +66,39 @@ VIRTUAL_DEFAULTS = join(VIRTUAL_ENV, 'provision_secrets') if VIRTUAL_ENV else ''
 
 DEFAULT_TARGETDIR = '/root/deploy'
 
+SSH_PORT = 22
+
+ARCHIVE_NAME = 'files.tar.gz' # uploaded to DEFAULT_TARGETDIR when archiving files
+JOURNAL_NAME = '.journal' # records completed deployment steps in DEFAULT_TARGETDIR
+
+UPLOAD_BUFSIZE = 64 * 1024 # bytes read per write when streaming files to a node
+UPLOAD_MMAP_THRESHOLD = None # memory map files at least this large, if set
+
+DEFAULT_WORKERS = 10 # maximum concurrent node operations
+RUN_TIMEOUT = 60 # seconds run-nodes waits for each node's ssh server
+
+SCRIPT_CHANNELS = 4 # maximum bundles whose scripts run at once on a node, when parallel
+
+CACHE_DIR = os.path.expanduser('~/.provision/cache')
+CATALOG_TTL = 24 * 60 * 60 # seconds before cached locations, sizes and images are refetched
+NODE_LIST_TTL = 30 # seconds list-nodes reuses an account's cached node list
+MANIFEST_CACHE = False # restore what configuration directories configure, see provision/manifest.py
+
 DEFAULT_NAME_PREFIX = 'deploy-test-'
+BAKED_IMAGE_PREFIX = 'baked-' # names of images saved by bake-image start with this
+POOL_PREFIX = 'pool-' # names of standby nodes kept by pool-nodes start with this
 
-DESTROYABLE_PREFIXES = [DEFAULT_NAME_PREFIX]
+DESTROYABLE_PREFIXES = [DEFAULT_NAME_PREFIX, POOL_PREFIX]
+
+POOL_SIZE = 2 # standby nodes kept ready per image by pool-nodes
+POOL_TTL = 6 * 60 * 60 # seconds before an unclaimed standby node is destroyed
+POOL_INTERVAL = 60 # seconds between refills and reaps by pool-nodes watch
+POOL_CLAIM_NAME = '.claimed' # created in DEFAULT_TARGETDIR when a standby node is claimed
 
 TEMPLATE_RE = re.compile('#.+provision-template-type:\W*(?P<type>[\w-]+)')
 
+# format-string and template-string scripts are compiled by provision.templates,
+# which renders them as these functions do
 TEMPLATE_TYPEMAP = {
     # http://docs.python.org/library/string.html#format-string-syntax
     'format-string': lambda text, submap: text.format(**submap),
@@ -67,6 +106,8 @@ TEMPLATE_TYPEMAP = {
     'template-string': lambda text, submap: string.Template(text).safe_substitute(submap),
     }
 
+TEMPLATE_CACHE_SIZE = 1024 # compiled scripts, and scripts bound to fleet variables, kept
+
 CODEPATH = os.path.dirname(__file__)
 
 SCRIPTSDIR = 'scripts'
@@ -82,12 +123,18 @@ DEFAULT_BUNDLES = [] # these get installed if image name in BOOTSTRAPPED_IMAGE_N
 DEFAULT_BOOTSTRAP_BUNDLES = [] # otherwise these get installed
 
 PATH = None
+LOADED = False
 
 import logging
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(name)s %(levelname)s %(message)s')
 logger = logging.getLogger('provision')
 
+def setup_logging(level=logging.DEBUG):
+
+    """Log to stderr at level, as the provision commands do"""
+
+    logging.basicConfig(level=level,
+                        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
 
 # error codes for corresponding exceptions
 EXCEPTION = 11
@@ -115,42 +162,59 @@ def handle_errors(callback, parsed=None, out=sys.stderr):
             return callback(parsed)
         else:
             return callback()
-    except DeploymentError as e:
+    except SystemExit:
+        pass
+    except:
         traceback.print_exc(file=out)
+        return error_code(sys.exc_info()[1], out)
+
+
+def error_code(e, out=sys.stderr):
+
+    """Determine which kind of exception e is, output an appropriate
+    message, and return the corresponding error code"""
+
+    if isinstance(e, DeploymentError):
         print(e, file=out)
         if hasattr(e, 'value') and hasattr(e.value, 'args') and len(e.value.args) > 0 and \
                 'open_sftp_client' in e.value.args[0]:
             print('Timeout', file=out)
             return TIMEOUT
         return DEPLOYMENT_ERROR
-    except MalformedResponseError as e:
-        traceback.print_exc(file=out)
+    if isinstance(e, MalformedResponseError):
         print(e, file=out)
         if 'Service Unavailable' in e.body:
             return SERVICE_UNAVAILABLE
         return MALFORMED_RESPONSE
-    except SystemExit:
-        pass
-    except:
-        traceback.print_exc(file=out)
-        return EXCEPTION
+    return EXCEPTION
 
 
 class Bundle(object):
 
     """Encapsulates mappings from file and script paths on the target
-    node to their local, source paths"""
+    node to their local, source paths, and how its scripts may be
+    scheduled relative to other bundles' scripts"""
 
-    def __init__(self, scriptmap=None, filemap=None):
+    def __init__(self, scriptmap=None, filemap=None, depends=None, locks=()):
         """
         @type scriptmap: C{dict}
         @keyword scriptmap: Maps target path to source path for scripts
 
         @type filemap: C{dict}
         @keyword filemap: Maps target path to source path for files
+
+        @type depends: C{list}
+        @keyword depends: Names of bundles whose scripts must finish
+                          first, or None for all bundles installed before it
+
+        @type locks: C{list}
+        @keyword locks: Names of resources, such as the package manager,
+                        which its scripts use exclusively
         """
         self.scriptmap = scriptmap or provision.collections.OrderedDict()
         self.filemap = filemap or {}
+        self.depends = depends
+        self.locks = frozenset(locks)
 
 def makemap(filenames, sourcedir, targetdir=None):
 
@@ -164,7 +228,8 @@ def makemap(filenames, sourcedir, targetdir=None):
     return provision.collections.OrderedDict(
         (join(targetdir, f),  join(sourcedir, f)) for f in filenames)
 
-def add_bundle(name, scripts=[], files=[], scriptsdir=SCRIPTSDIR, filesdir=FILESDIR):
+def add_bundle(name, scripts=[], files=[], scriptsdir=SCRIPTSDIR, filesdir=FILESDIR,
+               depends=None, locks=()):
 
     """High level, simplified interface for creating a bundle which
     takes the bundle name, a list of script file names in a common
@@ -175,16 +240,18 @@ def add_bundle(name, scripts=[], files=[], scriptsdir=SCRIPTSDIR, filesdir=FILES
 
     scriptmap = makemap(scripts, join(PATH, scriptsdir))
     filemap = dict(zip(files, [join(PATH, filesdir, os.path.basename(f)) for f in files]))
-    new_bundle(name, scriptmap, filemap)
+    new_bundle(name, scriptmap, filemap, depends, locks)
 
-def new_bundle(name, scriptmap, filemap=None):
+def new_bundle(name, scriptmap, filemap=None, depends=None, locks=()):
 
-    """Create a bundle and add to available bundles"""
+    """Create a bundle and add to available bundles.  Unless depends
+    is given, the bundle's scripts run after those of every bundle
+    installed before it; see Bundle"""
 
     #logger.debug('new bundle %s' % name)
     if name in BUNDLEMAP:
         logger.warn('overwriting bundle %s' % name)
-    BUNDLEMAP[name] = Bundle(scriptmap, filemap)
+    BUNDLEMAP[name] = Bundle(scriptmap, filemap, depends, locks)
 
 def random_str(length=6, charspace=string.ascii_lowercase+string.digits):
     return ''.join(random.sample(charspace, length))
@@ -275,6 +342,49 @@ def configure(paths, relative_to):
             load_pubkeys(pubkeys_path, PUBKEYS)
         init_module(path)
 
+def load():
+
+    """Configure from the defaults directory, then the local and
+    virtualenv secrets directories, if they exist, unless already done.
+    The secrets directories hold credentials, so they are always
+    configured from, never restored from a manifest."""
+
+    global LOADED
+    if LOADED:
+        return
+    LOADED = True
+    configure_cached(['defaults'], CODEPATH)
+    configure([p for p in [LOCAL_DEFAULTS, VIRTUAL_DEFAULTS] if os.path.exists(p)],
+              CODEPATH)
+
+def patch_libcloud():
+
+    """Apply provision.patches, which imports paramiko and the EC2
+    driver, unless already done"""
+
+    if 'provision.patches' not in sys.modules:
+        logger.debug('monkey patching libcloud')
+    import provision.patches
+
+def default_pubkey():
+
+    """Return DEFAULT_PUBKEY, reading it from DEFAULT_PUBKEY_PATH the
+    first time"""
+
+    global DEFAULT_PUBKEY
+    if DEFAULT_PUBKEY is None:
+        with open(DEFAULT_PUBKEY_PATH) as f:
+            DEFAULT_PUBKEY = f.read()
+    return DEFAULT_PUBKEY
+
+def configure_cached(paths, relative_to):
+
+    """Like configure(), but restoring from the manifest of paths, if
+    there is one, which is recorded when MANIFEST_CACHE is True"""
+
+    import provision.manifest
+    provision.manifest.configure(paths, relative_to)
+
 def parser():
 
     """Return a parser for setting one or more configuration paths"""
@@ -295,20 +405,13 @@ def add_auth_args(parser, config):
 
 def reconfig(main_parser, args=sys.argv[1:]):
 
-    """Parse any config paths and reconfigure defaults with them
+    """Load the configuration, parse any config paths and reconfigure
+    defaults with them
     http://docs.python.org/library/argparse.html#partial-parsing
     Return parsed remaining arguments"""
 
+    setup_logging()
+    load()
     parsed, remaining_args = parser().parse_known_args(args)
-    configure(parsed.config_paths, os.getcwd())
+    configure_cached(parsed.config_paths, os.getcwd())
     return main_parser().parse_args(remaining_args)
-
-defaults = ['defaults']
-if os.path.exists(LOCAL_DEFAULTS):
-    defaults.append(LOCAL_DEFAULTS)
-if os.path.exists(VIRTUAL_DEFAULTS):
-    defaults.append(VIRTUAL_DEFAULTS)
-configure(defaults, CODEPATH)
-
-logger.debug('monkey patching libcloud')
-import provision.patches
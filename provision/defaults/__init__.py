@@ -5,15 +5,19 @@ def init(config):
     config.DEFAULT_USERID = None
     config.DEFAULT_SECRET_KEY = None
 
-    config.add_bundle('bootstrap-python', ['bootstrap-python.sh'])
+    # every default script installs packages, so all take the dpkg
+    # lock, and run one at a time even with deploy-node --parallel
+    dpkg = ['dpkg']
+    config.add_bundle('bootstrap-python', ['bootstrap-python.sh'], depends=[], locks=dpkg)
     config.add_bundle('dev', ['emacs.sh', 'screen.sh'],
-                      ['/root/.emacs.d/init.el', '/root/.screenrc', '/root/.tmux.conf'])
-    config.add_bundle('hudson', ['jre.sh', 'postfix.sh', 'hudson.sh'])
-    config.add_bundle('libcloud', ['libcloud-env.sh'])
-    config.add_bundle('mta', ['postfix.sh'])
-    config.add_bundle('nginx', ['nginx.sh'])
-    config.add_bundle('pyenv', ['python-env.sh'])
-    config.add_bundle('proxy',['apache-proxy.sh'])
-    config.add_bundle('snmpd', ['snmpd.sh'])
-    config.add_bundle('tz', ['tz.sh'])
-    config.add_bundle('zenoss',['zenoss.sh'])
+                      ['/root/.emacs.d/init.el', '/root/.screenrc', '/root/.tmux.conf'],
+                      depends=[], locks=dpkg)
+    config.add_bundle('hudson', ['jre.sh', 'postfix.sh', 'hudson.sh'], depends=[], locks=dpkg)
+    config.add_bundle('libcloud', ['libcloud-env.sh'], depends=['bootstrap-python'], locks=dpkg)
+    config.add_bundle('mta', ['postfix.sh'], depends=[], locks=dpkg)
+    config.add_bundle('nginx', ['nginx.sh'], depends=[], locks=dpkg)
+    config.add_bundle('pyenv', ['python-env.sh'], depends=['bootstrap-python'], locks=dpkg)
+    config.add_bundle('proxy',['apache-proxy.sh'], depends=[], locks=dpkg)
+    config.add_bundle('snmpd', ['snmpd.sh'], depends=[], locks=dpkg)
+    config.add_bundle('tz', ['tz.sh'], depends=[], locks=dpkg)
+    config.add_bundle('zenoss',['zenoss.sh'], depends=[], locks=dpkg)
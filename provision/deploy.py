@@ -1,15 +1,30 @@
 from __future__ import absolute_import
+from __future__ import print_function
 
+import os.path
 import sys
 import argparse
 
 import provision.config as config
 import provision.nodelib as nodelib
+import provision.pool
+import provision.trace
+
+def positive_int(value):
+
+    """Return value as an int, if it is at least 1"""
+
+    count = int(value)
+    if count < 1:
+        raise argparse.ArgumentTypeError('{0} is not a positive integer'.format(value))
+    return count
 
 def parser():
     parser = argparse.ArgumentParser()
     config.add_auth_args(parser, config)
 
+    parser.add_argument('-a', '--archive', default=False, action='store_true',
+                        help='upload files as a single compressed archive')
     parser.add_argument('-b', '--bundles', default=[], action='append')
     parser.add_argument('-d', '--description-file')
     parser.add_argument('-i', '--image', default=config.DEFAULT_IMAGE_NAME)
@@ -21,24 +36,165 @@ def parser():
                         help='key=value pairs of template substitution variables')
     parser.add_argument('-v', '--verbose', default=True)
     parser.add_argument('-x', '--prefix', default=config.DEFAULT_NAME_PREFIX)
+    parser.add_argument('--incremental', default=False, action='store_true',
+                        help='only upload files whose content differs on the node')
+    parser.add_argument('--journal', default=False, action='store_true',
+                        help='record completed steps on the node, so retries resume')
+    parser.add_argument('--multiplex', default=False, action='store_true',
+                        help='install and run all scripts over a single ssh channel')
+    parser.add_argument('--parallel', default=False, action='store_true',
+                        help='run independent bundles\' scripts concurrently')
+    parser.add_argument('--no-baked', dest='baked', default=True, action='store_false',
+                        help='always start from the named image, not one baked from it')
+    parser.add_argument('--from-pool', default=False, action='store_true',
+                        help='claim a standby node kept by pool-nodes, if there is one')
+    parser.add_argument('--refresh-catalog', default=False, action='store_true',
+                        help='refetch cached locations, sizes and images')
+    parser.add_argument('--pipeline', default=False, action='store_true',
+                        help='prepare scripts and files while the node boots')
+    parser.add_argument('--count', default=1, type=positive_int,
+                        help='number of nodes to deploy concurrently')
+    parser.add_argument('--workers', default=config.DEFAULT_WORKERS, type=int,
+                        help='maximum number of nodes deployed at the same time')
+    parser.add_argument('--target', default=[], action='append',
+                        help='provider[/location][=weight] to spread --count nodes across, '
+                        'with credentials from config.CREDENTIALS if there.  Can be used '
+                        'multiple times.')
+    parser.add_argument('--event-loop', default=False, action='store_true',
+                        help='deploy all nodes at once from a single event loop, with '
+                        '--workers threads for blocking calls')
+    parser.add_argument('--trace-file',
+                        help='write the timing of each phase of every deployment to this '
+                        'file, in Chrome trace format')
     return parser
 
-def deploy(args=None):
-    parsed = config.reconfig(parser, args)
-    deployment = nodelib.Deployment(name=parsed.name, bundles=parsed.bundles,
-                                    prefix=parsed.prefix, image_name=parsed.image,
-                                    subvars=parsed.subvars)
-    driver = nodelib.get_driver(parsed.secret_key, parsed.userid, parsed.provider)
-    node = deployment.deploy(driver, parsed.location, parsed.size)
+def node_names(parsed):
+
+    """Return a list of parsed.count node names, where None means the
+    name will be randomly generated from the prefix"""
+
+    if parsed.count == 1:
+        return [parsed.name]
+    if parsed.name:
+        return ['{0}-{1}'.format(parsed.name, i) for i in range(1, parsed.count + 1)]
+    return [None] * parsed.count
+
+def description_path(path, name, count):
+
+    """Return the description file path for the named node, which is
+    path itself unless more than one node is deployed"""
+
+    if count == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{0}-{1}{2}'.format(root, name, ext)
+
+def deployments(parsed):
+    return [nodelib.Deployment(name=name, bundles=parsed.bundles,
+                               prefix=parsed.prefix, image_name=parsed.image,
+                               subvars=parsed.subvars, archive=parsed.archive,
+                               incremental=parsed.incremental, journal=parsed.journal,
+                               multiplex=parsed.multiplex, parallel=parsed.parallel,
+                               baked=parsed.baked)
+            for name in node_names(parsed)]
+
+def driver_factory(parsed):
+    return lambda: nodelib.get_driver(parsed.secret_key, parsed.userid, parsed.provider)
+
+def targets(parsed):
+    return [nodelib.Target.parse(t, parsed.userid, parsed.secret_key) for t in parsed.target]
+
+def write_trace(parsed, deployments):
+
+    """Write the traces of deployments to parsed.trace_file, if given,
+    including those which failed part way"""
+
+    if parsed.trace_file:
+        provision.trace.write_chrome_trace(parsed.trace_file,
+                                           [d.tracer for d in deployments])
+
+def deploy_node(parsed):
+    deployment = deployments(parsed)[0]
+    driver = driver_factory(parsed)()
+    catalog = nodelib.get_catalog(driver, parsed.refresh_catalog)
+    node = None
+    try:
+        if parsed.from_pool:
+            node = provision.pool.Pool(driver_factory(parsed), parsed.image,
+                                       location_id=parsed.location, size_id=parsed.size,
+                                       catalog=catalog).deploy(deployment)
+        if node is None:
+            node = deployment.deploy(driver, parsed.location, parsed.size, catalog,
+                                     parsed.pipeline)
+    finally:
+        write_trace(parsed, [deployment])
     if parsed.verbose:
         print(node)
     if parsed.description_file:
         node.write_json(parsed.description_file)
     return node
 
+def deploy_fleet(parsed):
+
+    """Deploy parsed.count nodes concurrently, and return the list of
+    workers.Result for each of them"""
+
+    def done(result):
+        if result.ok:
+            config.logger.info('deployed node {0}'.format(result.value.name))
+        else:
+            config.logger.error('failed to deploy node {0}: {1}'.format(
+                    result.item.name, result.error))
+
+    if parsed.from_pool:
+        config.logger.warn('--from-pool only applies when deploying a single node')
+    fleet = deployments(parsed)
+    if parsed.target:
+        results = nodelib.deploy_to_targets(fleet, targets(parsed), parsed.size,
+                                            parsed.workers, done, parsed.pipeline,
+                                            parsed.event_loop, parsed.refresh_catalog)
+    else:
+        catalog = nodelib.get_catalog(driver_factory(parsed)(), parsed.refresh_catalog)
+        deploy_many = nodelib.deploy_many_async if parsed.event_loop else nodelib.deploy_many
+        results = deploy_many(fleet, driver_factory(parsed),
+                              parsed.location, parsed.size, parsed.workers, done,
+                              catalog, parsed.pipeline)
+    write_trace(parsed, fleet)
+    for result in results:
+        if not result.ok:
+            continue
+        node = result.value
+        if parsed.verbose:
+            print(node)
+        if parsed.description_file:
+            node.write_json(description_path(parsed.description_file, node.name,
+                                             parsed.count))
+    return results
+
+def fleet_retcode(results, out=sys.stderr):
+
+    """Return the sum of the exit status of every deployed node, plus
+    the error code of every deployment which raised an exception, capped
+    at 255 so that failures never wrap around to a 0 exit status"""
+
+    retcode = 0
+    for result in results:
+        if result.ok:
+            retcode += result.value.sum_exit_status()
+        else:
+            print('{0}:\n{1}'.format(result.item.name, result.tb), file=out)
+            retcode += config.error_code(result.error, out)
+    return min(retcode, 255)
+
+def deploy(args=None):
+    return deploy_node(config.reconfig(parser, args))
+
 def deploy_retcode():
-    node = deploy()
-    return node.sum_exit_status()
+    parsed = config.reconfig(parser)
+    if parsed.count > 1 or parsed.event_loop or parsed.target:
+        return fleet_retcode(deploy_fleet(parsed))
+    node = deploy_node(parsed)
+    return min(node.sum_exit_status(), 255)
 
 def main():
     return config.handle_errors(deploy_retcode)
@@ -6,24 +6,84 @@ import argparse
 import xml.dom.minidom
 
 import provision.config as config
-import provision.nodelib as nodelib
+
+GLOB_CHARS = '*?['
 
 def parser():
-    parser = argparse.ArgumentParser(description='Destroy node by name')
+    parser = argparse.ArgumentParser(description='Destroy nodes by name, prefix or glob')
     config.add_auth_args(parser, config)
-    parser.add_argument('name')
+    parser.add_argument('names', nargs='*', default=[],
+                        help='names of nodes to destroy, or shell style patterns such as '
+                        '"deploy-test-*"')
+    parser.add_argument('-f', '--file', default=[], action='append',
+                        help='file of names or patterns, one per line, or - for stdin')
     parser.add_argument('-t', '--testresults',
                         help='only destroy node if all tests in XML file passed')
     parser.add_argument('-v', '--verbose', default=True)
+    parser.add_argument('-x', '--prefix', default=[], action='append',
+                        help='destroy every node whose name starts with this')
+    parser.add_argument('--workers', default=config.DEFAULT_WORKERS, type=int,
+                        help='maximum number of nodes destroyed at the same time')
     return parser
 
-def destroy(parsed):
-    driver = nodelib.get_driver(parsed.secret_key, parsed.userid, parsed.provider)
-    if nodelib.destroy_by_name(parsed.name, driver):
-        return 0
-    else:
-        print('ERROR: unable to destroy node', file=sys.stderr)
+def read_names(path):
+
+    """Return the names listed in the file at path, or stdin if path
+    is -, skipping blank lines and # comments"""
+
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def selectors(parsed):
+
+    """Return the exact names and the patterns of parsed"""
+
+    given = list(parsed.names)
+    for path in parsed.file:
+        given.extend(read_names(path))
+    names = [n for n in given if not any(c in n for c in GLOB_CHARS)]
+    patterns = [n for n in given if any(c in n for c in GLOB_CHARS)]
+    return names, patterns
+
+def destroy(parsed, out=sys.stderr):
+    names, patterns = selectors(parsed)
+    if not (names or patterns or parsed.prefix):
+        print('ERROR: no names, patterns or prefixes given', file=out)
+        return 1
+    import provision.nodelib as nodelib # imports paramiko, so not for --help or errors
+    driver_factory = lambda: nodelib.get_driver(parsed.secret_key, parsed.userid,
+                                                parsed.provider)
+    nodes = nodelib.select_nodes(nodelib.list_nodes(driver_factory()), names,
+                                 parsed.prefix, patterns)
+    missing = sorted(set(names) - set(n.name for n in nodes))
+    for name in missing:
+        print('ERROR: no node named {0}'.format(name), file=out)
+
+    refused = [n for n in nodes if not config.is_node_destroyable(n.name)]
+    for node in refused:
+        print('ERROR: not destroying {0}, which has a non-destroyable prefix'.format(
+                node.name), file=out)
+    nodes = [n for n in nodes if config.is_node_destroyable(n.name)]
+
+    results = nodelib.destroy_many(nodes, driver_factory, parsed.workers)
+    destroyed = [r.item.name for r in results if r.ok and r.value]
+    failed = [r for r in results if not (r.ok and r.value)]
+    for result in failed:
+        print('ERROR: unable to destroy {0}: {1}'.format(
+                result.item.name, result.tb or 'provider refused'), file=out)
+    if parsed.verbose:
+        for name in destroyed:
+            print('destroyed {0}'.format(name))
+    print('destroyed {0} of {1} nodes: {2} failed, {3} refused, {4} names not found'.format(
+            len(destroyed), len(nodes) + len(refused), len(failed), len(refused),
+            len(missing)), file=out)
+    if failed or refused or missing or not destroyed:
         return 1
+    return 0
 
 def main():
     parsed = config.reconfig(parser)
@@ -0,0 +1,481 @@
+"""Event loop for driving many deployments from a single thread.
+
+Deploying with a thread per node means hundreds of threads, which
+spend nearly all their time asleep, waiting for nodes to boot or for
+ssh to come up.  Instead, a Loop runs deployments as coroutines:
+generators which yield a Future, or another coroutine, whenever they
+need to wait, and are resumed with its result.  Waiting costs nothing
+but a timer, and only the provider API calls and ssh sessions, which
+block, are handed to a small, fixed pool of executor threads.
+
+A coroutine returns a value by raising Return(value), e.g.
+
+    def double_later(loop, x):
+        yield loop.sleep(1)
+        raise Return(2 * x)
+
+    Loop().run_until_complete(double_later(loop, 21))"""
+
+from __future__ import absolute_import
+
+import collections
+import errno
+import heapq
+import itertools
+import os
+import select
+import sys
+import threading
+import time
+import traceback
+import types
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from libcloud.common.types import LibcloudError
+
+import provision.patches
+import provision.poller
+import provision.probe
+import provision.trace
+
+import logging
+logger = logging.getLogger('provision')
+
+
+class Return(Exception):
+
+    """Raised by a coroutine to return value"""
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Future(object):
+
+    """The eventual outcome of an operation: a value, or an exception
+    along with its formatted traceback.  Only the loop thread may
+    resolve a Future or add callbacks to it."""
+
+    def __init__(self):
+        self._done = False
+        self._value = None
+        self._exc_info = None
+        self.tb = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError('result of unfinished future')
+        if self._exc_info is not None:
+            raise self._exc_info[1]
+        return self._value
+
+    def exception(self):
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def set_result(self, value):
+        self._value = value
+        self._finish()
+
+    def set_exc_info(self, exc_info):
+
+        """Fail with the exception described by the (type, value,
+        traceback) tuple exc_info"""
+
+        self._exc_info = exc_info
+        self.tb = ''.join(traceback.format_exception(*exc_info))
+        self._finish()
+
+    def set_exception(self, error):
+        try:
+            raise error
+        except Exception:
+            self.set_exc_info(sys.exc_info())
+
+    def _finish(self):
+        if self._done:
+            raise RuntimeError('future already done')
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+
+class Task(Future):
+
+    """Runs a coroutine on a loop, and resolves to what it returns"""
+
+    def __init__(self, loop, coro):
+        Future.__init__(self)
+        self.loop = loop
+        self.coro = coro
+        loop.call_soon(self._step, None, None)
+
+    def _step(self, value, exc_info):
+        try:
+            if exc_info is None:
+                yielded = self.coro.send(value)
+            else:
+                yielded = self.coro.throw(*exc_info)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Return as r:
+            self.set_result(r.value)
+            return
+        except Exception:
+            self.set_exc_info(sys.exc_info())
+            return
+        if isinstance(yielded, types.GeneratorType):
+            yielded = Task(self.loop, yielded)
+        if not isinstance(yielded, Future):
+            error = TypeError('coroutine yielded {0!r}, not a Future'.format(yielded))
+            self.loop.call_soon(self._step, None, (TypeError, error, None))
+            return
+        yielded.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        # resume from the loop, rather than recursing into the coroutine
+        self.loop.call_soon(self._step, future._value, future._exc_info)
+
+
+class Executor(object):
+
+    """A fixed pool of threads for running blocking calls on behalf of
+    a loop, which is told when each call completes"""
+
+    def __init__(self, loop, workers):
+        self.loop = loop
+        self.calls = queue.Queue()
+        self.threads = [threading.Thread(target=self.work, name='provision-executor-{0}'.format(n))
+                        for n in range(max(1, workers))]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        self.calls.put((future, func, args, kwargs))
+        return future
+
+    def work(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            future, func, args, kwargs = call
+            try:
+                value = func(*args, **kwargs)
+            except Exception:
+                self.loop.call_soon_threadsafe(future.set_exc_info, sys.exc_info())
+            else:
+                self.loop.call_soon_threadsafe(future.set_result, value)
+
+    def shutdown(self):
+        for t in self.threads:
+            self.calls.put(None)
+
+
+class Loop(object):
+
+    """Runs callbacks, timers and coroutines in the calling thread"""
+
+    def __init__(self, workers=10):
+        self.ready = collections.deque()
+        self.timers = []
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.executor = Executor(self, workers)
+        self.pollers = {}
+
+    def call_soon(self, callback, *args):
+        self.lock.acquire()
+        try:
+            self.ready.append((callback, args))
+        finally:
+            self.lock.release()
+
+    def call_soon_threadsafe(self, callback, *args):
+
+        """Schedule callback from another thread, waking up the loop"""
+
+        self.call_soon(callback, *args)
+        try:
+            os.write(self.wakeup_w, b'x')
+        except OSError:
+            pass # closed
+
+    def call_later(self, delay, callback, *args):
+        self.lock.acquire()
+        try:
+            heapq.heappush(self.timers, (time.time() + delay, next(self.sequence),
+                                         callback, args))
+        finally:
+            self.lock.release()
+
+    def sleep(self, delay, value=None):
+
+        """Return a Future which resolves to value after delay seconds"""
+
+        future = Future()
+        self.call_later(delay, future.set_result, value)
+        return future
+
+    def run_in_executor(self, func, *args, **kwargs):
+
+        """Return a Future for calling func in an executor thread"""
+
+        return self.executor.submit(func, *args, **kwargs)
+
+    def spawn(self, coro):
+
+        """Start running coroutine coro, and return its Task"""
+
+        return Task(self, coro)
+
+    def run_until_complete(self, coro):
+
+        """Run the loop until coro, a coroutine or Future, is done, and
+        return its value or raise its exception"""
+
+        future = coro if isinstance(coro, Future) else self.spawn(coro)
+        while not future.done():
+            self.run_once()
+        return future.result()
+
+    def run_once(self):
+        self.lock.acquire()
+        try:
+            if self.ready:
+                timeout = 0
+            elif self.timers:
+                timeout = max(0, self.timers[0][0] - time.time())
+            else:
+                timeout = None
+        finally:
+            self.lock.release()
+
+        try:
+            readable = select.select([self.wakeup_r], [], [], timeout)[0]
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        if readable:
+            os.read(self.wakeup_r, 4096)
+
+        self.lock.acquire()
+        try:
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                when, n, callback, args = heapq.heappop(self.timers)
+                self.ready.append((callback, args))
+            batch = list(self.ready)
+            self.ready.clear()
+        finally:
+            self.lock.release()
+        for callback, args in batch:
+            callback(*args)
+
+    def close(self):
+        self.executor.shutdown()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+
+def gather(loop, coros):
+
+    """Return a Future which resolves to the list of Futures for coros,
+    once all of them are done, whether they succeeded or not"""
+
+    futures = [c if isinstance(c, Future) else loop.spawn(c) for c in coros]
+    gathered = Future()
+    pending = set(range(len(futures)))
+
+    def done(i):
+        def callback(future):
+            pending.discard(i)
+            if not pending and not gathered.done():
+                gathered.set_result(futures)
+        return callback
+
+    for i, future in enumerate(futures):
+        future.add_done_callback(done(i))
+    if not futures:
+        gathered.set_result(futures)
+    return gathered
+
+
+class NodeStatePoller(object):
+
+    """Poll list_nodes() from a loop on behalf of all nodes waiting on
+    one account, like provision.poller.NodeStatePoller, but without a
+    thread, other than an executor's for the call itself"""
+
+    def __init__(self, loop, max_wait_period=provision.poller.MAX_WAIT_PERIOD,
+                 backoff=provision.poller.BACKOFF):
+        self.loop = loop
+        self.max_wait_period = max_wait_period
+        self.backoff = backoff
+        self.waiters = {}
+        self.polling = False
+        self.token = 0
+        self.polls = 0
+
+    def wait(self, driver, node, wait_period=provision.poller.MIN_WAIT_PERIOD, timeout=600):
+
+        """Return a Future which resolves to the updated Node once node
+        is running and has a public IP address"""
+
+        waiter = provision.poller.Waiter(driver, node, wait_period)
+        future = Future()
+        self.waiters[waiter] = future
+        self.loop.call_later(timeout, self.expire, waiter, timeout)
+        self.schedule()
+        return future
+
+    def schedule(self):
+        if self.polling or not self.waiters:
+            return
+        self.token += 1
+        delay = min(w.due for w in self.waiters) - time.time()
+        self.loop.call_later(max(0, delay), self.poll, self.token)
+
+    def poll(self, token):
+        if token != self.token or self.polling or not self.waiters:
+            return
+        self.polling = True
+        self.polls += 1
+        waiters = list(self.waiters)
+        future = self.loop.run_in_executor(waiters[0].driver.list_nodes)
+        future.add_done_callback(lambda f: self.polled(waiters, f))
+
+    def polled(self, waiters, future):
+        self.polling = False
+        waiters = [w for w in waiters if w in self.waiters]
+        if future.exception() is not None:
+            for waiter in waiters:
+                waiter.error = future.exception()
+            done = waiters
+        else:
+            done = provision.poller.update(waiters, future.result(), self.backoff,
+                                           self.max_wait_period)
+        for waiter in done:
+            self.resolve(waiter)
+        self.schedule()
+
+    def resolve(self, waiter):
+        future = self.waiters.pop(waiter)
+        if waiter.error is not None:
+            future.set_exception(waiter.error)
+        else:
+            future.set_result(waiter.node)
+
+    def expire(self, waiter, timeout):
+        if waiter in self.waiters:
+            waiter.error = LibcloudError(value='Timed out after %s seconds' % (timeout),
+                                         driver=waiter.driver)
+            self.resolve(waiter)
+
+
+def wait_until_running(loop, driver, node, wait_period=provision.poller.MIN_WAIT_PERIOD,
+                       timeout=600):
+
+    """Coroutine counterpart of NodeDriver.wait_until_running()"""
+
+    key = (driver.type, driver.key)
+    if key not in loop.pollers:
+        loop.pollers[key] = NodeStatePoller(loop)
+    node = yield loop.pollers[key].wait(driver, node, wait_period, timeout)
+    raise Return(node)
+
+
+def wait_for_ssh(loop, ssh_client, timeout):
+
+    """Return a Future which resolves to the Probe of ssh_client's
+    server once it sends its banner, or fails with NotReadyError after
+    timeout seconds.  Probing is done by the shared prober thread, see
+    provision.probe, rather than by an executor thread per node."""
+
+    future = Future()
+
+    def done(probe, error):
+        if error is None:
+            loop.call_soon_threadsafe(future.set_result, probe)
+        else:
+            loop.call_soon_threadsafe(future.set_exception, error)
+
+    provision.probe.prober().watch(ssh_client.hostname, ssh_client.port, timeout, done)
+    return future
+
+
+def connect_ssh_client(loop, driver, ssh_client, wait_period=3, timeout=300,
+                       tracer=provision.trace.NULL):
+
+    """Coroutine counterpart of NodeDriver.connect_ssh_client()"""
+
+    end = time.time() + timeout
+    attempt = 0
+    while time.time() < end:
+        attempt += 1
+        with tracer.span('ssh_connect_attempt', attempt=attempt) as span:
+            try:
+                probe = yield wait_for_ssh(loop, ssh_client, end - time.time())
+                span['probes'] = probe.attempts
+                yield loop.run_in_executor(provision.patches.ssh_connect_once, ssh_client)
+            except provision.probe.NotReadyError as e:
+                span['error'] = str(e)
+                raise LibcloudError(value='Could not connect to the remote SSH ' +
+                                    'server: {0}. Giving up.'.format(e), driver=driver)
+            except provision.patches.connect_retryable_errors() as e:
+                logger.debug('ssh connection to {0} failed: {1}'.format(
+                        ssh_client.hostname, e))
+                span['error'] = str(e)
+                ssh_client.close()
+            else:
+                raise Return(ssh_client)
+        yield loop.sleep(wait_period)
+
+    raise LibcloudError(value='Could not connect to the remote SSH ' +
+                        'server. Giving up.', driver=driver)
+
+
+def run_deployment_script(loop, driver, task, node, ssh_client, max_tries=3,
+                          tracer=provision.trace.NULL):
+
+    """Coroutine counterpart of NodeDriver.run_deployment_script(),
+    which runs task in an executor thread, where tracer is active"""
+
+    tries = 0
+    while tries < max_tries:
+        try:
+            with tracer.span('deployment_try', attempt=tries + 1):
+                node = yield loop.run_in_executor(provision.trace.traced(tracer, task.run),
+                                                  node, ssh_client)
+        except Exception:
+            logger.exception(traceback.format_exc())
+            tries += 1
+            if tries >= max_tries:
+                raise LibcloudError(value='Failed after %d tries'
+                                    % (max_tries), driver=driver)
+            yield loop.sleep(1)
+            ssh_client.close()
+            ssh_client = yield connect_ssh_client(loop, driver, ssh_client, tracer=tracer)
+        else:
+            ssh_client.close()
+            raise Return(node)
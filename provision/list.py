@@ -1,21 +1,191 @@
+"""List nodes, across any number of provider accounts at once.
+
+Each account's nodes are cached in config.CACHE_DIR for
+config.NODE_LIST_TTL seconds, so that scripts which call list-nodes
+repeatedly don't list every node of the account each time.  Filters
+apply to the cached list, and each account's nodes are written as
+soon as they are listed.
+
+Since libcloud's drivers import paramiko, which takes most of the time
+of short runs, provision.nodelib is only imported once a provider
+actually has to be called."""
+
 from __future__ import print_function
 from __future__ import absolute_import
 
+import csv
+import json
+import os
+import re
 import sys
+import tempfile
+import threading
+import time
 import argparse
 
+from libcloud.compute.types import NodeState
+
 import provision.config as config
-import provision.nodelib as nodelib
+import provision.workers
+
+FIELDS = ['provider', 'name', 'id', 'state', 'public_ip', 'private_ip', 'image_id']
+FORMATS = ['text', 'json', 'csv']
+# terminated nodes are never listed, as in nodelib.list_nodes
+STATES = dict((name.lower(), value) for name, value in vars(NodeState).items()
+              if name.isupper() and value != NodeState.TERMINATED)
+STATE_NAMES = dict((value, name) for name, value in STATES.items())
 
 def parser():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description='List nodes')
     config.add_auth_args(parser, config)
+    parser.add_argument('-P', '--providers', default=[], action='append',
+                        help='list the nodes of this provider instead, with its credentials '
+                        'from config.CREDENTIALS if there.  Can be used multiple times.')
+    parser.add_argument('-x', '--prefix', default=[], action='append',
+                        help='only list nodes whose name starts with prefix')
+    parser.add_argument('-s', '--state', default=[], action='append', choices=sorted(STATES),
+                        help='only list nodes in state')
+    parser.add_argument('-i', '--image', default=[], action='append',
+                        help='only list nodes of image, an id or a name')
+    parser.add_argument('--format', default='text', choices=FORMATS)
+    parser.add_argument('--refresh', default=False, action='store_true',
+                        help='list nodes even if a cached list is recent enough')
+    parser.add_argument('--workers', default=config.DEFAULT_WORKERS, type=int,
+                        help='maximum number of providers listed at the same time')
     return parser
 
-def print_list():
-    parsed = config.reconfig(parser)
-    driver = nodelib.get_driver(parsed.secret_key, parsed.userid, parsed.provider)
-    [print('%s %s' % (n.name, n.public_ip[0])) for n in nodelib.list_nodes(driver)]
+def node_record(provider, node):
+
+    """Return a JSON serializable dict describing node, which has no
+    public IP address while it boots"""
+
+    return {'provider': provider,
+            'name': node.name,
+            'id': node.id,
+            'state': STATE_NAMES.get(node.state, 'unknown'),
+            'public_ip': list(node.public_ip or []),
+            'private_ip': list(node.private_ip or []),
+            'image_id': node.extra.get('imageId') if node.extra else None}
+
+def cache_path(provider, userid, cachedir):
+
+    """Return the node list cache file path for provider and userid"""
+
+    key = re.sub(r'[^\w.-]', '_', '{0}-{1}'.format(provider, userid))
+    return os.path.join(cachedir, 'nodes-{0}.json'.format(key))
+
+def driver_factory(provider, userid, secret_key):
+    def get_driver():
+        import provision.nodelib as nodelib
+        return nodelib.get_driver(secret_key, userid, provider)
+    return get_driver
+
+def get_records(driver_factory, provider, userid, ttl=config.NODE_LIST_TTL, refresh=False):
+
+    """Return the records of provider's nodes for userid, from the
+    cache unless it is older than ttl seconds, missing, unreadable, or
+    refresh is True, in which case they are listed using a driver from
+    driver_factory, and cached"""
+
+    path = cache_path(provider, userid, config.CACHE_DIR)
+    if not refresh and ttl > 0 and os.path.exists(path):
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            if time.time() - cached['timestamp'] < ttl:
+                config.logger.debug('using cached node list {0}'.format(path))
+                return cached['nodes']
+        except (IOError, ValueError, KeyError) as e:
+            config.logger.warn('ignoring unreadable node list {0}: {1}'.format(path, e))
+    import provision.nodelib as nodelib
+    records = [node_record(provider, n) for n in nodelib.list_nodes(driver_factory())]
+    try:
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'timestamp': time.time(), 'nodes': records}, f)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        config.logger.warn('unable to cache node list {0}: {1}'.format(path, e))
+    return records
+
+def image_ids(driver, images):
+
+    """Return the set of image ids meant by images, which are ids,
+    image names, or names in config.IMAGE_NAMES"""
+
+    import provision.nodelib as nodelib
+    ids = set(str(i) for i in images)
+    names = set(images) | set(config.IMAGE_NAMES[i] for i in images if i in config.IMAGE_NAMES)
+    ids.update(str(i.id) for i in nodelib.get_catalog(driver).images if i.name in names)
+    return ids
+
+def matches(record, prefixes=(), states=(), images=None):
+
+    """Return whether record passes every given filter"""
+
+    return (not prefixes or any(record['name'].startswith(p) for p in prefixes)) and \
+        (not states or record['state'] in states) and \
+        (images is None or str(record['image_id']) in images)
+
+def list_account(parsed, provider):
+
+    """Return the records of the nodes of provider which pass the
+    filters of parsed"""
+
+    userid, secret_key = config.CREDENTIALS.get(provider, (parsed.userid, parsed.secret_key))
+    factory = driver_factory(provider, userid, secret_key)
+    records = get_records(factory, provider, userid, config.NODE_LIST_TTL, parsed.refresh)
+    images = image_ids(factory(), parsed.image) if parsed.image else None
+    return [r for r in records if matches(r, parsed.prefix, parsed.state, images)]
+
+def writer(format, out, providers=1):
+
+    """Return a function which writes a record to out in format, with
+    its provider in text format only when listing several providers"""
+
+    if format == 'json':
+        return lambda record: print(json.dumps(record, sort_keys=True), file=out)
+    if format == 'csv':
+        rows = csv.writer(out)
+        rows.writerow(FIELDS)
+        return lambda record: rows.writerow(
+            [' '.join(record[f]) if isinstance(record[f], list) else record[f]
+             for f in FIELDS])
+    def write(record):
+        fields = [record['name'], (record['public_ip'] or ['-'])[0]]
+        if providers > 1:
+            fields.insert(0, record['provider'])
+        print(' '.join(fields), file=out)
+    return write
+
+def print_list(parsed=None, out=sys.stdout, err=sys.stderr):
+
+    """Write the nodes of each provider as soon as they are listed,
+    one provider at a time, and return the sum of the error codes of
+    the providers which failed"""
+
+    parsed = parsed or config.reconfig(parser)
+    providers = parsed.providers or [parsed.provider]
+    write = writer(parsed.format, out, len(providers))
+    lock = threading.Lock()
+    retcodes = []
+
+    def written(result):
+        with lock:
+            if result.ok:
+                for record in result.value:
+                    write(record)
+                out.flush()
+            else:
+                print('{0}:\n{1}'.format(result.item, result.tb), file=err)
+                retcodes.append(config.error_code(result.error, err))
+
+    provision.workers.map_bounded(lambda p: list_account(parsed, p), providers,
+                                  parsed.workers, written)
+    return sum(retcodes)
 
 def main():
     return config.handle_errors(print_list)
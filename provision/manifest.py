@@ -0,0 +1,332 @@
+"""On-disk manifest of what configuration directories configure.
+
+Configuring from a directory imports it as a module, calls its init()
+to define bundles and settings, and reads its public keys.  Deploying
+then reads every bundle script, and hashes every bundle file for the
+journal, baked image lookups and incremental uploads.  For site
+configuration trees of hundreds of bundles and thousands of files,
+that is most of the time of a short run.
+
+So, when config.MANIFEST_CACHE is True, configure() records, in
+config.CACHE_DIR, the settings which configuring changed, the stat of
+every file and directory in the configuration directories and of every
+bundle source, and the digest of every bundle source.  The next run
+with the same directories, starting from the same settings, restores
+the settings instead of importing the modules, as long as nothing
+recorded has changed since.  So init() functions which read anything
+else, such as environment variables, would have their old results
+restored, which is why the manifest is opt-in.
+
+Settings which cannot be pickled, such as functions added to
+config.TEMPLATE_TYPEMAP, cannot be restored, and credentials are never
+written to disk, so configuring which changes any of them is never
+recorded.
+
+Digests and script texts are also kept in memory by FILES, and
+reused for as long as their file's size, mtime and inode don't change."""
+
+from __future__ import absolute_import
+
+import hashlib
+import os
+import tempfile
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import provision.collections
+import provision.config as config
+
+logger = config.logger
+
+VERSION = 1
+PROTOCOL = 2 # readable by every supported python
+
+CREDENTIALS = frozenset(['DEFAULT_SECRET_KEY', 'CREDENTIALS']) # never recorded, nor digested
+
+
+def stat_key(path):
+
+    """Return what changes when the file or directory at path does"""
+
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+class FileCache(object):
+
+    """Digests and texts of local files, by path, valid while the
+    stat_key of their file is unchanged"""
+
+    def __init__(self):
+        self.entries = {} # path: [stat_key, digest or None, text or None]
+        self.lock = threading.Lock()
+
+    def entry(self, path):
+        key = stat_key(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != key:
+                entry = self.entries[path] = [key, None, None]
+            return entry
+
+    def digest(self, path, bufsize=64 * 1024):
+
+        """Return the hex SHA1 digest of the contents of file path"""
+
+        entry = self.entry(path)
+        if entry[1] is None:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(bufsize)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+            entry[1] = digest.hexdigest()
+        return entry[1]
+
+    def text(self, path):
+
+        """Return the contents of file path"""
+
+        entry = self.entry(path)
+        if entry[2] is None:
+            with open(path) as f:
+                entry[2] = f.read()
+        return entry[2]
+
+    def export(self, paths):
+
+        """Return the stat keys and digests of paths, without texts"""
+
+        with self.lock:
+            return dict((p, self.entries[p][:2] + [None]) for p in paths
+                        if p in self.entries)
+
+    def update(self, entries):
+        with self.lock:
+            for path, entry in entries.items():
+                if path not in self.entries:
+                    self.entries[path] = list(entry)
+
+FILES = FileCache()
+
+
+def manifest_path(paths, cachedir):
+
+    """Return the manifest file path for configuring from paths, the
+    working directory and then the configuration directories"""
+
+    key = hashlib.sha1('\0'.join(paths).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cachedir, 'manifest-{0}.pickle'.format(key))
+
+
+def shape(value):
+
+    """Return what changes when an unpicklable value is changed in place"""
+
+    if isinstance(value, dict):
+        return sorted((repr(k), id(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [id(v) for v in value]
+    return id(value)
+
+
+def settings():
+
+    """Return the pickles of the picklable settings of config, and the
+    shapes of the others, by name"""
+
+    pickled, shapes = {}, {}
+    for name, value in vars(config).items():
+        if not name.isupper():
+            continue
+        try:
+            pickled[name] = pickle.dumps(value, PROTOCOL)
+        except Exception:
+            shapes[name] = shape(value)
+    return pickled, shapes
+
+
+def canonical(value):
+
+    """Return value with its dicts and sets sorted, and its objects
+    replaced by their attributes, so that equal settings pickle the
+    same however they were built"""
+
+    if isinstance(value, provision.collections.OrderedDict):
+        return ('odict', [(canonical(k), canonical(v)) for k, v in value.items()])
+    if isinstance(value, dict):
+        return ('dict', sorted([(canonical(k), canonical(v)) for k, v in value.items()],
+                               key=repr))
+    if isinstance(value, (set, frozenset)):
+        return ('set', sorted([canonical(v) for v in value], key=repr))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, [canonical(v) for v in value])
+    if hasattr(value, '__dict__') and not isinstance(value, type):
+        return (type(value).__name__, canonical(vars(value)))
+    return value
+
+
+def state_digest(names):
+
+    """Return a digest of the current values of the named settings,
+    which is the same in every run with the same settings"""
+
+    digest = hashlib.sha1()
+    for name in sorted(names):
+        digest.update(name.encode('utf-8'))
+        digest.update(pickle.dumps(canonical(getattr(config, name)), PROTOCOL))
+    return digest.hexdigest()
+
+
+def sources(bundles):
+
+    """Return the script and the file source paths of bundles"""
+
+    scripts, files = set(), set()
+    for bundle in bundles:
+        scripts.update(bundle.scriptmap.values())
+        files.update(bundle.filemap.values())
+    return scripts, files
+
+
+def watched(paths, extra):
+
+    """Return the stat_key of every file and directory in paths, and
+    of every path in extra, which exists"""
+
+    stats = {}
+    for path in paths:
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in [''] + filenames:
+                full = os.path.join(dirpath, name) if name else dirpath
+                stats[full] = stat_key(full)
+    for path in extra:
+        if path not in stats and os.path.exists(path):
+            stats[path] = stat_key(path)
+    return stats
+
+
+def unchanged(stats):
+    for path, key in stats.items():
+        try:
+            if stat_key(path) != key:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def read(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except IOError:
+        return None
+    except Exception as e:
+        logger.warn('ignoring unreadable manifest {0}: {1}'.format(path, e))
+        return None
+
+
+def write(path, manifest):
+    try:
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(manifest, f, PROTOCOL)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        logger.warn('unable to save manifest {0}: {1}'.format(path, e))
+
+
+def discard(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def restore(manifest, paths, before):
+
+    """Apply manifest and return True if it was recorded configuring
+    from paths, starting from settings whose state_digest() is before,
+    and nothing it watches has changed"""
+
+    if manifest is None or manifest.get('version') != VERSION or \
+            manifest['paths'] != paths or manifest['before'] != before or \
+            not unchanged(manifest['stats']):
+        return False
+    for name, value in manifest['after'].items():
+        setattr(config, name, pickle.loads(value))
+    FILES.update(manifest['files'])
+    return True
+
+
+def configure(paths, relative_to, cachedir=None):
+
+    """Like config.configure(), but restore the settings from the
+    manifest of paths if it is still valid, and otherwise record a new
+    one if config.MANIFEST_CACHE is True once configured.  Return True
+    if the manifest was used."""
+
+    if not paths:
+        return False
+    # bundle sources may be relative to the working directory, so it
+    # is part of the key
+    given, paths = paths, [os.getcwd()] + [
+        os.path.abspath(config.normalize_path(p, relative_to)) for p in paths]
+    path = manifest_path(paths, cachedir or config.CACHE_DIR)
+    before, before_shapes = settings()
+    before_digest = state_digest(set(before) - CREDENTIALS)
+    if restore(read(path), paths, before_digest):
+        logger.debug('configured from manifest {0}'.format(path))
+        return True
+
+    others = dict((n, v) for n, v in vars(config).items() if not n.isupper())
+    config.configure(given, relative_to)
+    after, after_shapes = settings()
+    changed = dict((n, v) for n, v in after.items() if before.get(n) != v)
+    if not config.MANIFEST_CACHE:
+        logger.debug('not recording manifest {0}: disabled by configuration'.format(path))
+        discard(path)
+        return False
+    if CREDENTIALS & set(changed):
+        logger.debug('not recording manifest {0}: configuring set credentials'.format(path))
+        discard(path)
+        return False
+    if after_shapes != before_shapes or \
+            any(others.get(n) is not v for n, v in vars(config).items() if not n.isupper()):
+        logger.debug('not recording manifest {0}: configuring changed settings which '
+                     'cannot be restored'.format(path))
+        return False
+
+    scripts, files = sources(config.BUNDLEMAP.values())
+    try:
+        for source in scripts | files:
+            FILES.digest(source)
+        stats = watched(paths[1:], scripts | files)
+    except (IOError, OSError) as e:
+        logger.debug('not recording manifest {0}: {1}'.format(path, e))
+        return False
+    write(path, {'version': VERSION,
+                 'paths': paths,
+                 'before': before_digest,
+                 'after': changed,
+                 'stats': stats,
+                 'files': FILES.export(scripts | files)})
+    return False
+
+
+def file_digest(path, bufsize=64 * 1024):
+    return FILES.digest(path, bufsize)
+
+
+def read_script(path):
+    return FILES.text(path)
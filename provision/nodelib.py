@@ -2,12 +2,18 @@
 
 from __future__ import absolute_import
 
+import copy
 import datetime
+import fnmatch
 import itertools
 import json
 import os
 import re
 import string
+import sys
+import threading
+import time
+import traceback
 
 import libcloud.compute.providers
 import libcloud.compute.deployment
@@ -15,19 +21,49 @@ import libcloud.compute.ssh
 from libcloud.compute.types import NodeState
 
 import provision.config as config
+import provision.catalog
 import provision.collections
+import provision.engine
+import provision.manifest
+import provision.registry
+import provision.steps
+import provision.templates
+import provision.trace
+import provision.workers
 logger = config.logger
 
+config.load()
+config.patch_libcloud()
 
-def get_driver(secret_key=config.DEFAULT_SECRET_KEY, userid=config.DEFAULT_USERID,
-               provider=config.DEFAULT_PROVIDER):
+
+def get_driver(secret_key=None, userid=None, provider=None):
 
     """A driver represents successful authentication.  They become
-    stale, so obtain them as late as possible, and don't cache them."""
+    stale, so obtain them as late as possible, and don't cache them.
+
+    Providers are configured in config.PROVIDERS either as libcloud
+    provider constants, or as NodeDriver classes.  Arguments which
+    are None default to config.DEFAULT_SECRET_KEY, DEFAULT_USERID and
+    DEFAULT_PROVIDER, as configured when called."""
 
+    if secret_key is None: secret_key = config.DEFAULT_SECRET_KEY
+    if userid is None: userid = config.DEFAULT_USERID
+    if provider is None: provider = config.DEFAULT_PROVIDER
     logger.debug('get_driver {0}@{1}'.format(userid, provider))
-    return libcloud.compute.providers.get_driver(
-        config.PROVIDERS[provider])(userid, secret_key)
+    driver = config.PROVIDERS[provider]
+    if not isinstance(driver, type):
+        driver = libcloud.compute.providers.get_driver(driver)
+    return driver(userid, secret_key)
+
+
+def get_catalog(driver, refresh=False):
+
+    """Return the locations, sizes and images available to driver's
+    account, cached on disk for config.CATALOG_TTL seconds unless
+    refresh is True"""
+
+    return provision.catalog.get_catalog(driver, config.CACHE_DIR, config.CATALOG_TTL,
+                                         refresh)
 
 
 def list_nodes(driver):
@@ -55,6 +91,10 @@ class NodeProxy(object):
             'private_ip': self.node.private_ip,
             'image_id': self.image.id,
             'image_name': self.image.name}
+        if hasattr(self.node, 'placement'):
+            info.update(self.node.placement)
+        if hasattr(self.node, 'trace'):
+            info['trace'] = self.node.trace.to_dicts()
         with open(path, 'wb') as df:
             json.dump(info, df)
             df.close()
@@ -87,17 +127,10 @@ def substitute(script, submap):
 
     """Check for presence of template indicator and if found, perform
     variable substition on script based on template type, returning
-    script."""
+    script.  Scripts are compiled once and shared across deployments,
+    see provision/templates.py."""
 
-    match = config.TEMPLATE_RE.search(script)
-    if match:
-        template_type = match.groupdict()['type']
-        try:
-            return config.TEMPLATE_TYPEMAP[template_type](script, submap)
-        except KeyError:
-            logger.error('Unsupported template type: %s' % template_type)
-            raise
-    return script
+    return provision.templates.render(script, submap)
 
 
 def script_deployment(path, script, submap=None):
@@ -113,13 +146,14 @@ def script_deployment(path, script, submap=None):
 
 def merge(items, amap, load=False):
 
-    """Merge list of tuples into dict amap, and optionally load source as value"""
+    """Merge list of tuples into dict amap, and optionally load source
+    as value, which is read once per process while unchanged"""
 
     for target, source in items:
         if amap.get(target):
             logger.warn('overwriting {0}'.format(target))
         if load:
-            amap[target] = open(source).read()
+            amap[target] = provision.manifest.read_script(source)
         else:
             amap[target] = source
 
@@ -135,13 +169,24 @@ def merge_keyvals_into_map(keyvals, amap):
         amap[k] = v
 
 
+def default_bundles(image_name):
+
+    """Return a new list of the bundles installed on every node of
+    image_name, before any others"""
+
+    if image_name in config.BOOTSTRAPPED_IMAGE_NAMES:
+        return config.DEFAULT_BUNDLES[:]
+    return config.DEFAULT_BOOTSTRAP_BUNDLES[:]
+
+
 class Deployment(object):
 
     """Split the deployment process into two steps"""
 
-    def __init__(self, name=None, bundles=[], pubkey=config.DEFAULT_PUBKEY,
+    def __init__(self, name=None, bundles=[], pubkey=None,
                  prefix=config.DEFAULT_NAME_PREFIX, image_name=config.DEFAULT_IMAGE_NAME,
-                 subvars=[]):
+                 subvars=[], archive=False, incremental=False, journal=False,
+                 multiplex=False, parallel=False, baked=True, keys=True, defaults=True):
 
         """Initialize a node deployment.
 
@@ -152,37 +197,137 @@ class Deployment(object):
 
         The list of bundle names is concatenated with any globally
         common bundle names from which result the set of files to be
-        installed, and scripts to be run on the new node.
+        installed, and scripts to be run on the new node.  If defaults
+        is False, only the given bundles are installed.
 
-        The pubkey is concatented with any other public keys loaded
-        during configuration and used as the first step in the
-        multi-step deployment.  Additional steps represent the scripts
-        to be run.
+        The pubkey, config.default_pubkey() unless given, is
+        concatented with any other public keys loaded during
+        configuration and used as the first step in the multi-step
+        deployment.  Additional steps represent the scripts to be run.
 
         The image_name is used to determine which set of default
         bundles to install, as well as to actually get the image id in
-        deploy()."""
+        deploy().
+
+        If archive is True, files with absolute target paths are
+        uploaded together as a single compressed archive rather than
+        one at a time.  If incremental is True, only files whose
+        content differs from what is already on the node are uploaded,
+        which makes re-provisioning an existing node cheap.
+
+        If journal is True, completed steps are recorded on the node so
+        that retrying the deployment resumes from the step which failed.
+
+        If multiplex is True, all scripts are installed and run by a
+        single shell over one ssh channel, rather than uploaded and run
+        one at a time.  Each script's output and exit status is still
+        captured.  When journaling, the scripts form a single step.
+
+        If parallel is True, each bundle's scripts run as a group, and
+        groups run concurrently, up to config.SCRIPT_CHANNELS at once,
+        subject to the dependencies and locks declared by their
+        bundles.  A script listed by several bundles belongs to the
+        first.  Combined with multiplex, each group is run by its own
+        shell.  When journaling, all the groups form a single step.
+
+        If baked is True, and an image baked from image_name by
+        bake-image already has the leading bundles to be installed,
+        unchanged, deploy() starts from the baked image with the most
+        such bundles, and installs only the rest.
+
+        If keys is False, no public keys are installed, such as when
+        running bundles on nodes which already have them.
+
+        Reading and templating scripts, and any other preparation of
+        the deployment steps, is deferred to prepare(), so that it can
+        overlap with the node booting."""
 
         self.name = name or prefix + config.random_str()
         config.SUBMAP['node_name'] = self.name
         merge_keyvals_into_map(subvars, config.SUBMAP)
-        logger.debug('substitution map {0}'.format(config.SUBMAP))
+        self.submap = dict(config.SUBMAP) # later deployments change config.SUBMAP
+        logger.debug('substitution map {0}'.format(self.submap))
 
-        self.pubkeys = [pubkey]
-        self.pubkeys.extend(config.PUBKEYS)
+        self.keys = keys
+        self.pubkeys = []
+        if keys:
+            self.pubkeys.append(pubkey if pubkey is not None else config.default_pubkey())
+            self.pubkeys.extend(config.PUBKEYS)
 
         self.image_name = image_name
 
+        self.install_bundles = default_bundles(image_name) if defaults else []
+        self.install_bundles.extend(bundles)
+        for bundle in self.install_bundles:
+            if bundle not in config.BUNDLEMAP:
+                raise KeyError('unknown bundle {0}'.format(bundle))
+
+        self.archive = archive
+        self.incremental = incremental
+        self.journal = journal
+        self.multiplex = multiplex
+        self.parallel = parallel
+        self.baked = baked
+        self.baked_image = None
+        self.provider = None # name in config.PROVIDERS, when known
+        self.location = None
+
+        self.timings = {}
+        self.tracer = provision.trace.NULL
+        self._deployment = None
+        self._script_deployments = None
+        self._prepare_lock = threading.Lock()
+
+    def prepare(self):
+
+        """Merge the bundles, load and template the scripts, and build
+        the deployment steps, including packing archives and hashing
+        files where needed.  Only the first call does any work."""
+
+        self._prepare_lock.acquire()
+        try:
+            if self._deployment is None:
+                start = time.time()
+                with self.tracer.span('prepare'):
+                    self._build()
+                self.timings['prepare'] = time.time() - start
+                logger.debug('prepared deployment of {0} in {1:.2f}s'.format(
+                        self.name, self.timings['prepare']))
+        finally:
+            self._prepare_lock.release()
+
+    def rename(self, name):
+
+        """Rename the deployment, such as to the name of the existing
+        node it is to be deployed to, in its substitution map and trace
+        too.  Steps already prepared are prepared again."""
+
+        self._prepare_lock.acquire()
+        try:
+            self.name = name
+            self.submap['node_name'] = name
+            if self.tracer is not provision.trace.NULL:
+                self.tracer.name = name
+            self._deployment = None
+            self._script_deployments = None
+        finally:
+            self._prepare_lock.release()
+
+    @property
+    def deployment(self):
+        self.prepare()
+        return self._deployment
+
+    @property
+    def script_deployments(self):
+        self.prepare()
+        return self._script_deployments
+
+    def _build(self):
         filemap = {}
         scriptmap = provision.collections.OrderedDict() # preserve script run order
 
-        if image_name in config.BOOTSTRAPPED_IMAGE_NAMES:
-            install_bundles = config.DEFAULT_BUNDLES[:]
-        else:
-            install_bundles = config.DEFAULT_BOOTSTRAP_BUNDLES[:]
-        install_bundles.extend(bundles)
-
-        for bundle in install_bundles:
+        for bundle in self.install_bundles:
             logger.debug('loading bundle {0}'.format(bundle))
             merge(config.BUNDLEMAP[bundle].filemap.items(), filemap)
             merge(config.BUNDLEMAP[bundle].scriptmap.items(), scriptmap, load=True)
@@ -190,28 +335,118 @@ class Deployment(object):
         logger.debug('files {0}'.format(filemap.values()))
         logger.debug('scripts {0}'.format(scriptmap.keys()))
 
-        file_deployments = [libcloud.compute.deployment.FileDeployment(
-                target, source) for target, source in filemap.items()]
+        archive_target = os.path.join(config.DEFAULT_TARGETDIR, config.ARCHIVE_NAME) \
+            if self.archive else None
+        if self.incremental and filemap:
+            file_deployments = [provision.steps.IncrementalFileDeployment(
+                    filemap, archive_target, config.UPLOAD_BUFSIZE,
+                    config.UPLOAD_MMAP_THRESHOLD)]
+        else:
+            file_deployments = provision.steps.file_steps(
+                filemap, archive_target, config.UPLOAD_BUFSIZE, config.UPLOAD_MMAP_THRESHOLD)
         logger.debug('len(file_deployments) = {0}'.format(len(file_deployments)))
 
-        self.script_deployments = [script_deployment(path, script, config.SUBMAP)
-                                   for path, script in scriptmap.items()]
-        logger.debug('len(script_deployments) = {0}'.format(len(self.script_deployments)))
+        script_deployments = [script_deployment(path, script, self.submap)
+                              for path, script in scriptmap.items()]
+        logger.debug('len(script_deployments) = {0}'.format(len(script_deployments)))
 
-        steps = [libcloud.compute.deployment.SSHKeyDeployment(''.join(self.pubkeys))]
+        steps = []
+        if self.keys:
+            steps.append(libcloud.compute.deployment.SSHKeyDeployment(''.join(self.pubkeys)))
         steps.extend(file_deployments)
-        steps.extend(self.script_deployments)
-        self.deployment = libcloud.compute.deployment.MultiStepDeployment(steps)
+        if self.parallel and script_deployments:
+            steps.append(provision.steps.ParallelScriptDeployment(
+                    self._script_groups(script_deployments), config.SCRIPT_CHANNELS))
+        elif self.multiplex and script_deployments:
+            steps.append(provision.steps.ScriptBatchDeployment(script_deployments))
+        else:
+            steps.extend(script_deployments)
+        if self.journal:
+            deployment = provision.steps.JournaledDeployment(
+                steps, os.path.join(config.DEFAULT_TARGETDIR, config.JOURNAL_NAME))
+        else:
+            deployment = provision.steps.TracedDeployment(steps)
+        provision.steps.prepare(deployment)
+
+        self._script_deployments = script_deployments
+        self._deployment = deployment
+
+    def _script_groups(self, script_deployments):
+
+        """Return a ScriptGroup for each installed bundle which owns
+        any of script_deployments, with dependencies on bundles without
+        scripts replaced by their own dependencies"""
+
+        bundles = []
+        for name in self.install_bundles:
+            if name not in bundles:
+                bundles.append(name)
+        owned = dict((name, []) for name in bundles)
+        remaining = dict((sd.name, sd) for sd in script_deployments)
+        for name in bundles:
+            for path in config.BUNDLEMAP[name].scriptmap:
+                if path in remaining:
+                    owned[name].append(remaining.pop(path))
+
+        depends = {}
+        for i, name in enumerate(bundles):
+            declared = config.BUNDLEMAP[name].depends
+            if declared is None:
+                declared = bundles[:i]
+            depends[name] = [d for d in declared if d in owned]
+            for unknown in set(declared) - set(owned):
+                logger.debug('bundle {0} depends on {1}, which is not installed'.format(
+                        name, unknown))
+
+        def resolve(name, seen):
+            resolved = set()
+            for d in depends[name]:
+                if owned[d]:
+                    resolved.add(d)
+                elif d not in seen:
+                    seen.add(d)
+                    resolved.update(resolve(d, seen))
+            return resolved
+
+        groups = []
+        for name in bundles:
+            if not owned[name]:
+                continue
+            if self.multiplex:
+                group_steps = [provision.steps.ScriptBatchDeployment(owned[name])]
+            else:
+                group_steps = owned[name]
+            groups.append(provision.steps.ScriptGroup(
+                    name, group_steps, resolve(name, set([name])),
+                    config.BUNDLEMAP[name].locks))
+        return groups
 
     def deploy(self, driver, location_id=config.DEFAULT_LOCATION_ID,
-               size_id=config.DEFAULT_SIZE_ID):
+               size_id=config.DEFAULT_SIZE_ID, catalog=None, pipeline=False,
+               tracer=None):
 
         """Use driver to deploy node, with optional ability to specify
         location id and size id.
 
-        First, obtain location object from driver.  Next, get the
-        size.  Then, get the image. Finally, deploy node, and return
-        NodeProxy. """
+        First, obtain location object from the catalog, which unless
+        given is the driver's cached catalog.  Next, get the size.
+        Then, get the image. Finally, deploy node, and return
+        NodeProxy.
+
+        If pipeline is True, the deployment is prepared while the node
+        boots rather than beforehand.  Should preparation fail, the
+        node is destroyed, if its name allows it.
+
+        Each phase is timed by tracer, by default a new trace.Tracer,
+        which is kept as self.tracer and as the trace of the node."""
+
+        self.tracer = tracer or provision.trace.Tracer(self.name)
+        with provision.trace.activate(self.tracer):
+            return self._deploy(driver, location_id, size_id, catalog, pipeline)
+
+    def _node_args(self, driver, catalog, location_id, size_id):
+
+        """Return the keyword arguments for driver.create_node()"""
 
         args = {'name': self.name}
 
@@ -223,71 +458,511 @@ class Deployment(object):
 
         logger.debug('deploying node %s using driver %s' % (self.name, driver))
 
-        args['location'] = driver.list_locations()[location_id]
+        args['location'] = self.location = catalog.locations[location_id]
         logger.debug('location %s' % args['location'])
 
-        args['size'] = driver.list_sizes()[size_id]
+        args['size'] = catalog.sizes[size_id]
         logger.debug('size %s' % args['size'])
 
-        logger.debug('image name %s' % config.IMAGE_NAMES[self.image_name])
-        args['image'] = image_from_name(
-            config.IMAGE_NAMES[self.image_name], driver.list_images())
+        if self.baked:
+            args['image'] = self._baked_image(driver, catalog)
+        if args.get('image') is None:
+            logger.debug('image name %s' % config.IMAGE_NAMES[self.image_name])
+            args['image'] = image_from_name(
+                config.IMAGE_NAMES[self.image_name], catalog.image_index())
         logger.debug('image %s' % args['image'])
 
+        return args
+
+    def _baked_image(self, driver, catalog):
+
+        """Return the catalog image of the best baked image for this
+        deployment, if any, and stop installing the bundles baked into
+        it.  Once prepared, the bundles to install are settled, so
+        keep to the image chosen before then."""
+
+        if self._deployment is not None:
+            return self.baked_image
+        images = provision.registry.load(
+            provision.registry.registry_path(driver, config.CACHE_DIR))
+        if not images:
+            return None
+        fingerprints = [(name, provision.registry.bundle_fingerprint(config.BUNDLEMAP[name],
+                                                                     self.submap))
+                        for name in self.install_bundles]
+        baked, count = provision.registry.select(images, self.image_name, fingerprints)
+        if baked is None:
+            return None
+        matches = [image for image in catalog.images if str(image.id) == str(baked.id)]
+        if not matches:
+            logger.warn('baked image {0} is not in the catalog of {1}, try '
+                        '--refresh-catalog'.format(baked.name, driver))
+            return None
+        logger.info('deploying {0} from baked image {1}, skipping bundles {2}'.format(
+                self.name, baked.name, ', '.join(self.install_bundles[:count])))
+        self.install_bundles = self.install_bundles[count:]
+        self.baked_image = matches[-1]
+        return self.baked_image
+
+    def _record_prepare_hidden(self):
+        self.timings['prepare_hidden'] = min(self.timings['prepare'], self.timings['boot'])
+        logger.info('{0:.2f}s of {1:.2f}s preparation hidden behind boot'.format(
+                self.timings['prepare_hidden'], self.timings['prepare']))
+
+    def _ssh_client(self, node, password):
+        return ssh_client(node, password)
+
+    def _deployed(self, driver, node, image):
+        node.script_deployments = self.script_deployments # retain exit_status, stdout, stderr
+        node.trace = self.tracer
+        node.placement = {'provider': self.provider or getattr(driver, 'name', None),
+                          'location_id': getattr(self.location, 'id', None),
+                          'location_name': getattr(self.location, 'name', None),
+                          'country': getattr(self.location, 'country', None)}
+
+        logger.debug('node.extra["imageId"] %s' % node.extra['imageId'])
+
+        return NodeProxy(node, image)
+
+    def _deploy(self, driver, location_id, size_id, catalog, pipeline):
+        tracer = self.tracer
+
+        if catalog is None:
+            with tracer.span('catalog'):
+                catalog = get_catalog(driver)
+
+        args = self._node_args(driver, catalog, location_id, size_id)
+
+        if not pipeline:
+            self.prepare()
+
         logger.debug('creating node with args: %s' % args)
-        node = driver.create_node(**args)
+        with tracer.span('create_node'):
+            node = driver.create_node(**args)
         logger.debug('node created')
+        created = time.time()
+
+        if pipeline:
+            preparation = provision.workers.Background(
+                self.prepare, 'provision-prepare-{0}'.format(self.name))
 
         password = node.extra.get('password') \
             if 'generates_password' in driver.features['create_node'] else None
 
         logger.debug('waiting for node to obtain public IP address')
-        node = driver.wait_until_running(node)
+        with tracer.span('wait_until_running'):
+            node = driver.wait_until_running(node)
+        self.timings['boot'] = time.time() - created
 
-        ssh_args = {'hostname': node.public_ip[0],
-                    'port': 22,
-                    'timeout': 10}
-        if password:
-            ssh_args['password'] = password
-        else:
-            ssh_args['key'] = config.SSH_KEY_PATH
+        if pipeline:
+            try:
+                with tracer.span('wait_for_prepare'):
+                    preparation.wait()
+            except Exception:
+                logger.error('preparation of {0} failed, destroying node'.format(self.name))
+                NodeProxy(node, args['image']).destroy()
+                raise
+            self._record_prepare_hidden()
+
+        return self._run(driver, node, password, args['image'])
+
+    def deploy_existing(self, driver, node, password=None, image=None, tracer=None):
+
+        """Run the deployment on node, which is already running, such
+        as one claimed from a pool, and return NodeProxy.  Without a
+        password, ssh authenticates with config.SSH_KEY_PATH."""
 
-        logger.debug('initializing ssh client with %s' % ssh_args)
-        ssh_client = libcloud.compute.ssh.SSHClient(**ssh_args)
+        self.tracer = tracer or provision.trace.Tracer(self.name)
+        with provision.trace.activate(self.tracer):
+            self.prepare()
+            return self._run(driver, node, password, image)
+
+    def _run(self, driver, node, password, image):
+        tracer = self.tracer
+        ssh_client = self._ssh_client(node, password)
 
         logger.debug('ssh client attempting to connect')
-        ssh_client = driver.connect_ssh_client(ssh_client)
+        with tracer.span('connect_ssh_client'):
+            ssh_client = driver.connect_ssh_client(ssh_client)
         logger.debug('ssh client connected')
 
         logger.debug('starting node deployment with %s steps' % len(self.deployment.steps))
-        driver.run_deployment_script(self.deployment, node, ssh_client)
+        with tracer.span('run_deployment_script'):
+            driver.run_deployment_script(self.deployment, node, ssh_client)
 
-        node.script_deployments = self.script_deployments # retain exit_status, stdout, stderr
+        return self._deployed(driver, node, image)
+
+    def deploy_async(self, loop, driver, location_id=config.DEFAULT_LOCATION_ID,
+                     size_id=config.DEFAULT_SIZE_ID, catalog=None, pipeline=False,
+                     tracer=None):
+
+        """Coroutine counterpart of deploy(), to be run by loop, an
+        engine.Loop.  Waiting for the node to boot and for ssh to come
+        up takes no thread, while provider API calls, preparation and
+        the deployment steps themselves are run by the loop's executor.
+
+        Deploying many nodes this way needs only as many threads as the
+        loop has executor workers, however long their nodes take to
+        boot."""
+
+        self.tracer = tracer or provision.trace.Tracer(self.name)
+        tracer = self.tracer
+
+        def call(func, *args, **kwargs):
+            return loop.run_in_executor(provision.trace.traced(tracer, func), *args, **kwargs)
+
+        if catalog is None:
+            with tracer.span('catalog'):
+                catalog = yield call(get_catalog, driver)
+
+        args = self._node_args(driver, catalog, location_id, size_id)
+
+        if not pipeline:
+            yield call(self.prepare)
+
+        logger.debug('creating node with args: %s' % args)
+        with tracer.span('create_node'):
+            node = yield call(driver.create_node, **args)
+        logger.debug('node created')
+        created = time.time()
+
+        if pipeline:
+            preparation = call(self.prepare)
+
+        password = node.extra.get('password') \
+            if 'generates_password' in driver.features['create_node'] else None
+
+        logger.debug('waiting for node to obtain public IP address')
+        with tracer.span('wait_until_running'):
+            node = yield provision.engine.wait_until_running(loop, driver, node)
+        self.timings['boot'] = time.time() - created
+
+        if pipeline:
+            try:
+                with tracer.span('wait_for_prepare'):
+                    yield preparation
+            except Exception:
+                logger.error('preparation of {0} failed, destroying node'.format(self.name))
+                yield call(NodeProxy(node, args['image']).destroy)
+                raise
+            self._record_prepare_hidden()
+
+        ssh_client = self._ssh_client(node, password)
+
+        logger.debug('ssh client attempting to connect')
+        with tracer.span('connect_ssh_client'):
+            ssh_client = yield provision.engine.connect_ssh_client(loop, driver, ssh_client,
+                                                                   tracer=tracer)
+        logger.debug('ssh client connected')
+
+        logger.debug('starting node deployment with %s steps' % len(self.deployment.steps))
+        with tracer.span('run_deployment_script'):
+            yield provision.engine.run_deployment_script(loop, driver, self.deployment, node,
+                                                         ssh_client, tracer=tracer)
+
+        raise provision.engine.Return(self._deployed(driver, node, args['image']))
 
-        logger.debug('node.extra["imageId"] %s' % node.extra['imageId'])
 
-        return NodeProxy(node, args['image'])
+def deploy_many(deployments, driver_factory, location_id=config.DEFAULT_LOCATION_ID,
+                size_id=config.DEFAULT_SIZE_ID, workers=config.DEFAULT_WORKERS,
+                callback=None, catalog=None, pipeline=False):
+
+    """Deploy each of deployments concurrently, using at most workers
+    threads.  Since drivers are neither long lived nor safe to share
+    between threads, each deployment obtains its own driver by calling
+    driver_factory.
+
+    Return a list of workers.Result, in the same order as
+    deployments, whose values are the deployed NodeProxy objects.  A
+    deployment which fails does not prevent the others from
+    completing.  If callback is given, it is called with each Result
+    as soon as its deployment finishes.
+
+    The catalog, if not given, is obtained once for all deployments."""
+
+    if catalog is None:
+        catalog = get_catalog(driver_factory())
+    return _deploy_threads(deployments, lambda d: (driver_factory, location_id, catalog),
+                           size_id, workers, callback, pipeline)
+
+
+def _deploy_threads(deployments, place, size_id, workers, callback, pipeline):
+
+    """Deploy each of deployments from a thread, to the driver factory,
+    location id and catalog returned by place(deployment)"""
+
+    def deploy(deployment):
+        driver_factory, location_id, catalog = place(deployment)
+        return deployment.deploy(driver_factory(), location_id, size_id, catalog, pipeline)
+
+    logger.debug('deploying {0} nodes with {1} workers'.format(len(deployments), workers))
+    return provision.workers.map_bounded(deploy, deployments, workers, callback)
+
+
+def deploy_many_async(deployments, driver_factory, location_id=config.DEFAULT_LOCATION_ID,
+                      size_id=config.DEFAULT_SIZE_ID, workers=config.DEFAULT_WORKERS,
+                      callback=None, catalog=None, pipeline=False):
+
+    """Like deploy_many(), but all of deployments proceed at once, on
+    a single engine.Loop, and workers only bounds the number of threads
+    making blocking calls, such as to the provider API or over ssh.
+    The callback is called from the calling thread."""
+
+    if catalog is None:
+        catalog = get_catalog(driver_factory())
+    return _deploy_loop(deployments, lambda d: (driver_factory, location_id, catalog),
+                        size_id, workers, callback, pipeline)
+
+
+def _deploy_loop(deployments, place, size_id, workers, callback, pipeline):
+
+    """Deploy all of deployments from one engine.Loop, to the driver
+    factory, location id and catalog returned by place(deployment)"""
+
+    loop = provision.engine.Loop(workers)
+    try:
+        def deploy(deployment):
+            try:
+                driver_factory, location_id, catalog = place(deployment)
+                driver = yield loop.run_in_executor(driver_factory)
+                node = yield deployment.deploy_async(loop, driver, location_id, size_id,
+                                                     catalog, pipeline)
+            except Exception:
+                result = provision.workers.Result(deployment, error=sys.exc_info()[1],
+                                                  tb=traceback.format_exc())
+            else:
+                result = provision.workers.Result(deployment, value=node)
+            if callback is not None:
+                callback(result)
+            raise provision.engine.Return(result)
+
+        logger.debug('deploying {0} nodes with {1} executor workers'.format(
+                len(deployments), workers))
+        futures = loop.run_until_complete(
+            provision.engine.gather(loop, [deploy(d) for d in deployments]))
+        return [f.result() for f in futures]
+    finally:
+        loop.close()
+
+
+class Target(object):
+
+    """A provider account and location to deploy nodes to, and the
+    weight of its share of a fleet.  Credentials for the provider in
+    config.CREDENTIALS take precedence over userid and secret_key."""
+
+    def __init__(self, provider, location_id=config.DEFAULT_LOCATION_ID, weight=1,
+                 userid=None, secret_key=None):
+        if weight < 1:
+            raise ValueError('target {0} has weight {1}, which is not positive'.format(
+                    provider, weight))
+        self.provider = provider
+        self.location_id = location_id
+        self.weight = weight
+        self.userid, self.secret_key = config.CREDENTIALS.get(provider, (userid, secret_key))
+
+    @classmethod
+    def parse(cls, text, userid=None, secret_key=None):
+
+        """Return the Target described by text, which is
+        provider[/location][=weight], where location is an index into
+        the provider's list of locations"""
+
+        spec, _, weight = text.partition('=')
+        provider, _, location = spec.partition('/')
+        try:
+            return cls(provider, int(location) if location else config.DEFAULT_LOCATION_ID,
+                       int(weight) if weight else 1, userid, secret_key)
+        except ValueError as e:
+            raise ValueError('invalid target {0}: {1}'.format(text, e))
+
+    def account(self):
+        return (self.provider, self.userid)
+
+    def driver_factory(self):
+        return lambda: get_driver(self.secret_key, self.userid, self.provider)
+
+    def __repr__(self):
+        return '<Target {0}/{1}={2}>'.format(self.provider, self.location_id, self.weight)
+
+
+def spread(targets, count):
+
+    """Return a list of count targets, chosen by smooth weighted
+    round robin, so that each target's share is proportional to its
+    weight and its turns are interleaved with the others'"""
+
+    total = sum(t.weight for t in targets)
+    current = [0] * len(targets)
+    chosen = []
+    for i in range(count):
+        for j, target in enumerate(targets):
+            current[j] += target.weight
+        best = current.index(max(current))
+        current[best] -= total
+        chosen.append(targets[best])
+    return chosen
+
+
+def deploy_to_targets(deployments, targets, size_id=config.DEFAULT_SIZE_ID,
+                      workers=config.DEFAULT_WORKERS, callback=None, pipeline=False,
+                      event_loop=False, refresh=False):
+
+    """Deploy deployments across targets, a list of Target, spread in
+    proportion to their weights, like deploy_many(), or
+    deploy_many_async() if event_loop is True.
+
+    The catalog of each account is obtained concurrently, before
+    any node is created.  If that fails, the deployments to the
+    account's targets fail with the error, without affecting the
+    others.  Each deployed node's description records the provider
+    and location it landed in."""
+
+    if not targets:
+        raise ValueError('no targets to deploy to')
+    accounts = dict((t.account(), t) for t in targets)
+    catalogs = dict(
+        (r.item, r) for r in provision.workers.map_bounded(
+            lambda a: get_catalog(accounts[a].driver_factory()(), refresh),
+            list(accounts), workers))
+    placements = {}
+    for deployment, target in zip(deployments, spread(targets, len(deployments))):
+        deployment.provider = target.provider
+        placements[id(deployment)] = target
+    logger.debug('deploying {0} nodes to {1}'.format(len(deployments), targets))
+
+    def place(deployment):
+        target = placements[id(deployment)]
+        catalog = catalogs[target.account()]
+        if not catalog.ok:
+            raise catalog.error
+        return target.driver_factory(), target.location_id, catalog.value
+
+    deploy = _deploy_loop if event_loop else _deploy_threads
+    return deploy(deployments, place, size_id, workers, callback, pipeline)
+
+
+def ssh_client(node, password=None):
+
+    """Return an unconnected ssh client for node, which authenticates
+    with password, if given, otherwise with config.SSH_KEY_PATH"""
+
+    ssh_args = {'hostname': node.public_ip[0],
+                'port': config.SSH_PORT,
+                'timeout': 10}
+    if password:
+        ssh_args['password'] = password
+    else:
+        ssh_args['key'] = config.SSH_KEY_PATH
+
+    logger.debug('initializing ssh client with %s' % ssh_args)
+    return libcloud.compute.ssh.SSHClient(**ssh_args)
+
+
+def run_command(driver, node, command, password=None):
+
+    """Run command on node over ssh, once it accepts connections, and
+    return its [stdout, stderr, exit status]"""
+
+    client = driver.connect_ssh_client(ssh_client(node, password))
+    try:
+        return client.run(command)
+    finally:
+        client.close()
+
+
+def run_on_node(driver, node, command=None, deployment=None, timeout=config.RUN_TIMEOUT):
+
+    """Run command over ssh on node, which is already running, or else
+    the steps of deployment, waiting at most timeout seconds for its
+    ssh server.  Return a list of [name, stdout, stderr, exit status],
+    for the command, or for each script of the deployment, named by
+    its path.  ssh authenticates with the node's password, where the
+    provider lists it, and otherwise with config.SSH_KEY_PATH."""
+
+    if not node.public_ip:
+        raise ValueError('node {0} has no public IP address'.format(node.name))
+    password = (node.extra or {}).get('password')
+    end = time.time() + timeout
+    client = driver.connect_ssh_client(ssh_client(node, password), timeout=timeout)
+    try:
+        if deployment is None:
+            stdout, stderr, status = client.run(command)
+            return [[command, stdout, stderr, status]]
+        driver.run_deployment_script(deployment.deployment, node, client,
+                                     timeout=max(0, end - time.time()))
+    finally:
+        client.close()
+    return [[sd.name, sd.stdout, sd.stderr, sd.exit_status]
+            for sd in deployment.script_deployments]
+
+
+def run_many(nodes, driver_factory, command=None, bundles=(), subvars=[],
+             workers=config.DEFAULT_WORKERS, callback=None, timeout=config.RUN_TIMEOUT):
+
+    """Run command, or else the scripts of bundles after uploading
+    their files, on each of nodes concurrently, using at most workers
+    threads, each with its own driver obtained once by calling
+    driver_factory.  Scripts are templated for each node as by
+    Deployment, with node_name its name and subvars, but neither the
+    default bundles nor public keys are installed, and nothing is
+    journaled, so that bundles run again each time.
+
+    Return a list of workers.Result, in the same order as nodes, whose
+    values are as returned by run_on_node().  If callback is given, it
+    is called with each Result as soon as it is available."""
+
+    # Deployments are created up front, since they update config.SUBMAP,
+    # and keyed by node rather than by name, since names need not be unique
+    deployments = dict((id(node), Deployment(node.name, bundles, subvars=subvars,
+                                             journal=False, keys=False, defaults=False))
+                       for node in nodes) if command is None else {}
+    driver = thread_drivers(driver_factory)
+
+    def run(node):
+        return run_on_node(driver(), node, command, deployments.get(id(node)), timeout)
+
+    logger.debug('running on {0} nodes with {1} workers'.format(len(nodes), workers))
+    return provision.workers.map_bounded(run, nodes, workers, callback)
+
+
+def rename_node(driver, node, name):
+
+    """Rename node to name, if the provider allows it, and return
+    whether it did"""
+
+    if hasattr(driver, 'ex_create_tags'): # EC2 names are tags
+        driver.ex_create_tags(node, {'Name': name})
+    else:
+        return False
+    node.name = name
+    return True
 
 
 def image_from_name(name, images):
 
-    """Return an image from a list of images.  If the name is an exact
-    match, return the last exactly matching image.  Otherwise, sort
-    images by 'natural' order, using decorate-sort-undecorate, and
-    return the largest.
+    """Return an image from a list of images, or from a prebuilt
+    catalog.ImageIndex, which is much faster when called repeatedly.
+    If the name is an exact match, return the last exactly matching
+    image.  Otherwise, return the image starting with name which is
+    largest in 'natural' order, determined by the first number in the
+    image name.
 
     see:
     http://code.activestate.com/recipes/285264-natural-string-sorting/
     """
 
+    if isinstance(images, provision.catalog.ImageIndex):
+        return images.lookup(name)
+
     prefixed_images = [i for i in images if i.name.startswith(name)]
 
     if name in [i.name for i in prefixed_images]:
         return [i for i in prefixed_images if i.name == name][-1]
 
     decorated = sorted(
-        [(int(re.search('\d+', i.name).group(0)), i) for i in prefixed_images])
-    return [i[1] for i in decorated][-1]
+        [(provision.catalog.natural_key(i.name), n, i) for n, i in enumerate(prefixed_images)])
+    return [i[2] for i in decorated][-1]
 
 
 def destroy_by_name(name, driver):
@@ -300,3 +975,52 @@ def destroy_by_name(name, driver):
         return False
     else:
         return all([node.destroy() for node in matches])
+
+
+def select_nodes(nodes, names=(), prefixes=(), patterns=()):
+
+    """Return the nodes named one of names, or starting with one of
+    prefixes, or matching one of the shell style patterns, in the
+    order of nodes"""
+
+    names = set(names)
+    return [node for node in nodes
+            if node.name in names or
+            any(node.name.startswith(p) for p in prefixes) or
+            any(fnmatch.fnmatchcase(node.name, p) for p in patterns)]
+
+
+def thread_drivers(driver_factory):
+
+    """Return a function which returns a driver obtained by calling
+    driver_factory, once in each thread which calls it, since drivers
+    are not safe to share between threads"""
+
+    local = threading.local()
+
+    def driver():
+        if getattr(local, 'driver', None) is None:
+            local.driver = driver_factory()
+        return local.driver
+    return driver
+
+
+def destroy_many(nodes, driver_factory, workers=config.DEFAULT_WORKERS, callback=None):
+
+    """Destroy each of nodes concurrently, using at most workers
+    threads, each with its own driver obtained once by calling
+    driver_factory.  Nodes without a destroyable name are left alone.
+
+    Return a list of workers.Result, in the same order as nodes, whose
+    values are whether the node was destroyed.  If callback is given,
+    it is called with each Result as soon as it is available."""
+
+    driver = thread_drivers(driver_factory)
+
+    def destroy(node):
+        node = copy.copy(node) # don't share the driver between threads
+        node.driver = driver()
+        return NodeProxy(node, None).destroy()
+
+    logger.debug('destroying {0} nodes with {1} workers'.format(len(nodes), workers))
+    return provision.workers.map_bounded(destroy, nodes, workers, callback)
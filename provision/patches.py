@@ -7,6 +7,9 @@ see: http://stackoverflow.com/questions/3765222/monkey-patch-python-class
 # Monkey patch libcloud.compute.ssh.ParamikoSSHClient to:
 #   accept key filenames in connect()
 #   parameterize file open mode in put()
+#   share one SFTP session, and cache created directories, across put()s
+#   stream file-like contents in put()
+#   feed a command's standard input with run_stdin()
 
 import logging
 logging.basicConfig(level=logging.DEBUG,
@@ -33,33 +36,130 @@ def ParamikoSSHClient_connect(self):
     self.client.connect(**conninfo)
     return True
 
-from os.path import split as psplit
+import posixpath
+import threading
+
+_sftp_lock_lock = threading.Lock()
+
+def ParamikoSSHClient_sftp_lock(self):
+    """Return the lock which serializes transfers on this connection,
+    so that scripts run from several threads share its SFTP session
+    safely."""
+    with _sftp_lock_lock:
+        if getattr(self, '_sftp_lock', None) is None:
+            self._sftp_lock = threading.RLock()
+    return self._sftp_lock
+
+def ParamikoSSHClient_sftp(self):
+    """Return the SFTP session shared by every transfer on this
+    connection, opening it on first use, along with the set of remote
+    directories known to exist."""
+    with self.sftp_lock():
+        if getattr(self, '_sftp', None) is None:
+            self._sftp = self.client.open_sftp()
+            self._sftp_dirs = set()
+        return self._sftp
+
+def ParamikoSSHClient_makedirs(self, head):
+    """Create each component of remote directory head, at most once
+    per session.  Relative paths are relative to the login directory."""
+    sftp = self.sftp()
+    path = '/' if head.startswith('/') else ''
+    for part in head.split('/'):
+        if part == '':
+            continue
+        path = posixpath.join(path, part)
+        if path in self._sftp_dirs:
+            continue
+        try:
+            sftp.mkdir(path)
+        except IOError:
+            # so, there doesn't seem to be a way to
+            # catch EEXIST consistently *sigh*
+            pass
+        self._sftp_dirs.add(path)
+
+UPLOAD_BUFSIZE = 64 * 1024
+
+def ParamikoSSHClient_put(self, path, contents=None, chmod=None, mode='w',
+                          bufsize=UPLOAD_BUFSIZE):
+    """Write contents to remote path.  If contents is a file-like
+    object, it is streamed bufsize bytes at a time rather than read
+    into memory at once."""
+    with self.sftp_lock():
+        sftp = self.sftp()
+        # less than ideal, but we need to mkdir stuff otherwise file() fails
+        self.makedirs(posixpath.dirname(path))
+        ak = sftp.file(path, mode=mode)
+        ak.set_pipelined(True)
+        if hasattr(contents, 'read'):
+            while True:
+                chunk = contents.read(bufsize)
+                if not chunk:
+                    break
+                ak.write(chunk)
+        else:
+            ak.write(contents)
+        if chmod is not None:
+            ak.chmod(chmod)
+        ak.close()
 
-def ParamikoSSHClient_put(self, path, contents=None, chmod=None, mode='w'):
-    sftp = self.client.open_sftp()
-    # less than ideal, but we need to mkdir stuff otherwise file() fails
-    head, tail = psplit(path)
-    if path[0] == "/":
-        sftp.chdir("/")
-    for part in head.split("/"):
-        if part != "":
-            try:
-                sftp.mkdir(part)
-            except IOError:
-                # so, there doesn't seem to be a way to
-                # catch EEXIST consistently *sigh*
-                pass
-            sftp.chdir(part)
-    ak = sftp.file(tail, mode=mode)
-    ak.write(contents)
-    if chmod is not None:
-        ak.chmod(chmod)
-    ak.close()
-    sftp.close()
+def ParamikoSSHClient_delete(self, path):
+    with self.sftp_lock():
+        self.sftp().unlink(path)
+
+def ParamikoSSHClient_close(self):
+    if getattr(self, '_sftp', None) is not None:
+        try:
+            self._sftp.close()
+        except (IOError, EOFError):
+            pass
+        self._sftp = None
+    self.client.close()
+
+def ParamikoSSHClient_run_stdin(self, cmd, stdin, bufsize=UPLOAD_BUFSIZE):
+    """Like run(), but stream stdin, a string or file-like object, to
+    the command's standard input, then close it.  Standard input is
+    written from a separate thread while stdout is read, so that a
+    command which writes as it reads can't stall the channel."""
+    chan = self.client.get_transport().open_session()
+    chan.exec_command(cmd)
+    errors = []
+
+    def feed():
+        try:
+            if hasattr(stdin, 'read'):
+                while True:
+                    chunk = stdin.read(bufsize)
+                    if not chunk:
+                        break
+                    chan.sendall(chunk)
+            else:
+                chan.sendall(stdin)
+            chan.shutdown_write()
+        except Exception as e:
+            errors.append(e)
+
+    feeder = threading.Thread(target=feed, name='provision-stdin')
+    feeder.daemon = True
+    feeder.start()
+    so = chan.makefile('rb', -1).read()
+    se = chan.makefile_stderr('rb', -1).read()
+    status = chan.recv_exit_status()
+    feeder.join()
+    if errors and status == 0:
+        raise errors[0]
+    return [so, se, status]
 
 import libcloud.compute.ssh
 libcloud.compute.ssh.ParamikoSSHClient.connect = ParamikoSSHClient_connect
 libcloud.compute.ssh.ParamikoSSHClient.put = ParamikoSSHClient_put
+libcloud.compute.ssh.ParamikoSSHClient.delete = ParamikoSSHClient_delete
+libcloud.compute.ssh.ParamikoSSHClient.close = ParamikoSSHClient_close
+libcloud.compute.ssh.ParamikoSSHClient.sftp = ParamikoSSHClient_sftp
+libcloud.compute.ssh.ParamikoSSHClient.sftp_lock = ParamikoSSHClient_sftp_lock
+libcloud.compute.ssh.ParamikoSSHClient.makedirs = ParamikoSSHClient_makedirs
+libcloud.compute.ssh.ParamikoSSHClient.run_stdin = ParamikoSSHClient_run_stdin
 
 # Monkey patch libcloud.compute.drivers.ec2.EC2NodeDriver
 import libcloud.compute.drivers.ec2
@@ -95,6 +195,7 @@ class SSHKeyDeployment(Deployment):
 
 # FileDeployment can be used by all drivers, a general replacement for ex_files param
 
+import mmap
 import os
 
 class FileDeployment(Deployment):
@@ -102,25 +203,43 @@ class FileDeployment(Deployment):
     Install a file.
     """
 
-    def __init__(self, target, source):
+    def __init__(self, target, source, bufsize=UPLOAD_BUFSIZE, mmap_threshold=None):
         """
         @type target: C{str}
         @keyword target: Location on node to install file
 
         @type source: C{str}
         @keyword source: Local path of file to be installed
+
+        @type bufsize: C{int}
+        @keyword bufsize: Bytes read from source per write to the node
+
+        @type mmap_threshold: C{int}
+        @keyword mmap_threshold: Memory map sources of at least this many bytes
         """
         self.target = target
         self.source = source
+        self.bufsize = bufsize
+        self.mmap_threshold = mmap_threshold
 
     def run(self, node, client):
         """
-        Upload the file, retaining permissions
+        Stream the file to the node, retaining permissions, so memory
+        use is independent of the file's size
 
         See also L{Deployment.run}
         """
-        perms = os.stat(self.source).st_mode
-        client.put(path=self.target, chmod=perms, contents=open(self.source).read())
+        st = os.stat(self.source)
+        with open(self.source, 'rb') as f:
+            contents = f
+            if self.mmap_threshold is not None and st.st_size >= max(self.mmap_threshold, 1):
+                contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                client.put(path=self.target, chmod=st.st_mode, contents=contents,
+                           mode='wb', bufsize=self.bufsize)
+            finally:
+                if contents is not f:
+                    contents.close()
         return node
 
 import libcloud.compute.deployment
@@ -131,16 +250,22 @@ libcloud.compute.deployment.FileDeployment = FileDeployment
 import socket
 import time
 from libcloud.common.types import LibcloudError
-from libcloud.compute.types import NodeState
 
-def NodeDriver_wait_until_running(self, node, wait_period=3, timeout=600):
+import provision.poller
+
+def NodeDriver_wait_until_running(self, node, wait_period=provision.poller.MIN_WAIT_PERIOD,
+                                  timeout=600):
     """
     Block until node is fully booted and has an IP address assigned.
 
+    Nodes waiting on the same account share one list_nodes() call per
+    polling interval, see L{provision.poller}.
+
     @keyword    node: Node instance.
     @type       node: C{Node}
 
-    @keyword    wait_period: Seconds to sleep between each loop iteration
+    @keyword    wait_period: Initial seconds to sleep between polls, which
+                             backs off while the node is still booting
     @type       wait_period: C{int}
 
     @keyword    timeout: Seconds to wait before timing out
@@ -149,42 +274,41 @@ def NodeDriver_wait_until_running(self, node, wait_period=3, timeout=600):
     @return: C{Node} Node instance on success.
     """
 
-    end = time.time() + timeout
-
-    while time.time() < end:
-        nodes = [n for n in self.list_nodes() if n.uuid == node.uuid]
-
-        if len(nodes) == 0:
-            raise LibcloudError(value=('Booted node[%s] ' % node
-                                + 'is missing from list_nodes.'),
-                                driver=self)
-
-        if len(nodes) > 1:
-            raise LibcloudError(value=('Booted single node[%s], ' % node
-                                + 'but multiple nodes have same UUID'),
-                                driver=self)
-
-        node = nodes[0]
-
-        if (node.public_ip is not None
-            and node.public_ip != ""
-            and node.state == NodeState.RUNNING):
-            return node
-        else:
-            time.sleep(wait_period)
-            continue
-
-    raise LibcloudError(value='Timed out after %s seconds' % (timeout),
-                        driver=self)
+    return provision.poller.poller_for(self).wait(self, node, wait_period, timeout)
 
 
 import socket
 import time
 import traceback
 
+import provision.probe
+import provision.trace
+
 class LoginDisabledError(Exception):
     pass
 
+def ssh_connect_once(ssh_client):
+    """
+    Connect ssh_client, and check that root login is enabled.
+    """
+    ssh_client.connect()
+    logger.debug('client provisionally connected')
+    if 'Please login as the user' in ssh_client.run('pwd')[0]:
+        raise LoginDisabledError('%s login disabled' % ssh_client.username)
+
+def connect_retryable_errors():
+    """
+    Return the exceptions after which connecting is retried.
+    """
+    from paramiko.sftp import SFTPError
+    # Retry if a connection is refused or timeout occurred
+    # Catch EOFError, for reasons outlined in
+    # https://bugs.launchpad.net/paramiko/+bug/567330
+    # Catch SFTPError, in case root login not yet
+    # re-enabled by user-data script
+    return (LoginDisabledError, SFTPError, EOFError, IOError,
+            socket.gaierror, socket.error)
+
 def NodeDriver_connect_ssh_client(self, ssh_client, wait_period=3, timeout=300):
     """
     Try to connect to the remote SSH server. Each time a connection fails,
@@ -197,39 +321,46 @@ def NodeDriver_connect_ssh_client(self, ssh_client, wait_period=3, timeout=300):
     @type       timeout: C{int}
 
     @return: C{SSHClient} on success
+
+    Before each attempt, the server is probed until it sends its banner,
+    see L{provision.probe}, so that no handshake is attempted while the
+    node is still booting.  Each attempt is timed as a span of the
+    current tracer, see L{provision.trace}.
     """
     start = time.time()
     end = start + timeout
 
-    from paramiko.sftp import SFTPError
+    attempt = 0
     while time.time() < end:
-        try:
-            ssh_client.connect()
-            logger.debug('client provisionally connected')
-            if 'Please login as the user' in ssh_client.run('pwd')[0]:
-                raise LoginDisabledError('%s login disabled' % ssh_client.username)
-        except (LoginDisabledError, SFTPError, EOFError, IOError,
-                socket.gaierror, socket.error) as e:
-            # Retry if a connection is refused or timeout occurred
-            # Catch EOFError, for reasons outlined in
-            # https://bugs.launchpad.net/paramiko/+bug/567330
-            # Catch SFTPError, in case root login not yet
-            # re-enabled by user-data script
-            logger.exception(traceback.format_exc())
-            ssh_client.close()
-            time.sleep(wait_period)
-            continue
-        except:
-            logger.exception(traceback.format_exc())
-            raise
-        else:
-            return ssh_client
+        attempt += 1
+        with provision.trace.current().span('ssh_connect_attempt', attempt=attempt) as span:
+            try:
+                probe = provision.probe.prober().wait(ssh_client.hostname, ssh_client.port,
+                                                      end - time.time())
+                span['probes'] = probe.attempts
+                ssh_connect_once(ssh_client)
+            except provision.probe.NotReadyError as e:
+                span['error'] = str(e)
+                raise LibcloudError(value='Could not connect to the remote SSH ' +
+                                    'server: {0}. Giving up.'.format(e), driver=self)
+            except connect_retryable_errors() as e:
+                logger.debug('ssh connection to {0} failed: {1}'.format(
+                        ssh_client.hostname, e))
+                span['error'] = str(e)
+                ssh_client.close()
+            except:
+                logger.exception(traceback.format_exc())
+                raise
+            else:
+                return ssh_client
+        time.sleep(wait_period)
 
     raise LibcloudError(value='Could not connect to the remote SSH ' +
                         'server. Giving up.', driver=self)
 
 
-def NodeDriver_run_deployment_script(self, task, node, ssh_client, max_tries=3):
+def NodeDriver_run_deployment_script(self, task, node, ssh_client, max_tries=3,
+                                     timeout=None):
     """
     Run the deployment script on the provided node. At this point it is
     assumed that SSH connection has already been established.
@@ -246,12 +377,24 @@ def NodeDriver_run_deployment_script(self, task, node, ssh_client, max_tries=3):
     @keyword    max_tries: How many times to retry if a deployment fails
     @type       max_tries: C{int}
 
+    @keyword    timeout: Seconds from the first try until reconnecting
+                         gives up, by default connect_ssh_client()'s own
+                         timeout for each reconnection
+    @type       timeout: C{int}
+
+    Before each retry the SSH connection is reestablished, in case the
+    failure was a dropped connection.  A task which keeps a journal on
+    the node, see L{provision.steps.JournaledDeployment}, resumes from
+    the step which failed.
+
     @return:    None on success.
     """
+    end = None if timeout is None else time.time() + timeout
     tries = 0
     while tries < max_tries:
         try:
-            node = task.run(node, ssh_client)
+            with provision.trace.current().span('deployment_try', attempt=tries + 1):
+                node = task.run(node, ssh_client)
         except Exception:
             logger.exception(traceback.format_exc())
             tries += 1
@@ -259,6 +402,12 @@ def NodeDriver_run_deployment_script(self, task, node, ssh_client, max_tries=3):
                 raise LibcloudError(value='Failed after %d tries'
                                     % (max_tries), driver=self)
             time.sleep(1)
+            ssh_client.close()
+            if end is None:
+                ssh_client = self.connect_ssh_client(ssh_client)
+            else:
+                ssh_client = self.connect_ssh_client(ssh_client,
+                                                     timeout=max(0, end - time.time()))
         else:
             ssh_client.close()
             return
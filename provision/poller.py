@@ -0,0 +1,189 @@
+"""Shared node state polling.
+
+Many nodes booting at once would otherwise each call list_nodes()
+every few seconds, quickly exhausting provider rate limits.  Instead,
+all nodes waiting on the same account share a single poller thread,
+which calls list_nodes() once per interval and hands each waiting node
+its own entry.  Each waiter starts polling quickly, then backs off,
+since a node which isn't ready after a few seconds typically takes
+minutes."""
+
+from __future__ import absolute_import
+
+import sys
+import threading
+import time
+
+from libcloud.common.types import LibcloudError
+from libcloud.compute.types import NodeState
+
+import logging
+logger = logging.getLogger('provision')
+
+MIN_WAIT_PERIOD = 1
+MAX_WAIT_PERIOD = 15
+BACKOFF = 1.5
+
+
+class Waiter(object):
+
+    """A node waiting to be running with a public IP address"""
+
+    def __init__(self, driver, node, wait_period):
+        self.driver = driver
+        self.node = node
+        self.wait_period = wait_period
+        self.due = time.time()
+        self.error = None
+        self.event = threading.Event()
+
+
+def is_running(node):
+    return (node.public_ip is not None
+            and node.public_ip != ""
+            and node.state == NodeState.RUNNING)
+
+
+def update(waiters, nodes, backoff=BACKOFF, max_wait_period=MAX_WAIT_PERIOD):
+
+    """Update each of waiters from the result of list_nodes(), and
+    return those which are done, because their node is running or an
+    error occurred.  The others are due again after backing off."""
+
+    byuuid = {}
+    for node in nodes:
+        byuuid.setdefault(node.uuid, []).append(node)
+    now = time.time()
+    done = []
+    for waiter in waiters:
+        matches = byuuid.get(waiter.node.uuid, [])
+        if len(matches) == 0:
+            waiter.error = LibcloudError(
+                value=('Booted node[%s] ' % waiter.node
+                       + 'is missing from list_nodes.'),
+                driver=waiter.driver)
+        elif len(matches) > 1:
+            waiter.error = LibcloudError(
+                value=('Booted single node[%s], ' % waiter.node
+                       + 'but multiple nodes have same UUID'),
+                driver=waiter.driver)
+        elif is_running(matches[0]):
+            waiter.node = matches[0]
+        else:
+            waiter.node = matches[0]
+            waiter.wait_period = min(waiter.wait_period * backoff, max_wait_period)
+            waiter.due = now + waiter.wait_period
+            continue
+        done.append(waiter)
+    return done
+
+
+class NodeStatePoller(object):
+
+    """Poll list_nodes() on behalf of all nodes waiting on one account"""
+
+    def __init__(self, max_wait_period=MAX_WAIT_PERIOD, backoff=BACKOFF):
+        self.max_wait_period = max_wait_period
+        self.backoff = backoff
+        self.cond = threading.Condition()
+        self.waiters = []
+        self.thread = None
+        self.polls = 0
+
+    def wait(self, driver, node, wait_period=MIN_WAIT_PERIOD, timeout=600):
+
+        """Block until node is running and has a public IP address, and
+        return its updated Node instance.  Raise LibcloudError if it
+        goes missing, is duplicated, or times out."""
+
+        waiter = Waiter(driver, node, wait_period)
+        self.cond.acquire()
+        try:
+            self.waiters.append(waiter)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='provision-poller')
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+        waiter.event.wait(timeout)
+
+        self.cond.acquire()
+        try:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+        finally:
+            self.cond.release()
+
+        if waiter.error is not None:
+            raise waiter.error
+        if not waiter.event.is_set():
+            raise LibcloudError(value='Timed out after %s seconds' % (timeout),
+                                driver=driver)
+        return waiter.node
+
+    def run(self):
+
+        """Poll whenever the earliest waiter is due, until none remain"""
+
+        while True:
+            self.cond.acquire()
+            try:
+                while True:
+                    if not self.waiters:
+                        self.thread = None
+                        return
+                    delay = min(w.due for w in self.waiters) - time.time()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                waiters = self.waiters[:]
+            finally:
+                self.cond.release()
+            self.poll(waiters)
+
+    def poll(self, waiters):
+
+        """Call list_nodes() once, and update every waiter from the
+        result.  The driver of a waiting node is used, since its owner
+        is blocked until the node is ready."""
+
+        self.polls += 1
+        try:
+            nodes = waiters[0].driver.list_nodes()
+        except Exception:
+            error = sys.exc_info()[1]
+            for waiter in waiters:
+                waiter.error = error
+            done = waiters
+        else:
+            done = update(waiters, nodes, self.backoff, self.max_wait_period)
+
+        self.cond.acquire()
+        try:
+            for waiter in done:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        finally:
+            self.cond.release()
+        for waiter in done:
+            waiter.event.set()
+
+
+_pollers = {}
+_pollers_lock = threading.Lock()
+
+def poller_for(driver):
+
+    """Return the poller shared by all drivers for the same account"""
+
+    key = (driver.type, driver.key)
+    _pollers_lock.acquire()
+    try:
+        if key not in _pollers:
+            _pollers[key] = NodeStatePoller()
+        return _pollers[key]
+    finally:
+        _pollers_lock.release()
@@ -0,0 +1,320 @@
+"""Warm standby pool of nodes, for deploying without waiting for a
+node to be created and boot.
+
+pool-nodes keeps config.POOL_SIZE nodes of an image running, named
+with config.POOL_PREFIX and deployed with the image's default bundles.
+deploy-node --from-pool claims one of them, renames it where the
+provider allows, and installs only the requested bundles.  Standby
+nodes which nobody claims within config.POOL_TTL seconds are
+destroyed.  Typically, pool-nodes watch runs in the background,
+refilling and reaping the pool every config.POOL_INTERVAL seconds.
+
+The pool's state, including each node's password where the provider
+generates one, is kept in a file in config.CACHE_DIR, which processes
+on the same host update under an exclusive lock.  A node is also
+claimed on the node itself, by creating config.POOL_CLAIM_NAME, so
+that it is never handed out twice."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import contextlib
+import fcntl
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import argparse
+
+from libcloud.compute.base import NodeImage
+from libcloud.compute.types import NodeState
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+import provision.config as config
+import provision.nodelib as nodelib
+import provision.workers
+
+logger = config.logger
+
+BOOTING = 'booting'
+READY = 'ready'
+CLAIMED = 'claimed'
+
+
+def pool_path(driver, cachedir):
+
+    """Return the pool state file path for the driver's provider and account"""
+
+    key = re.sub(r'[^\w.-]', '_', '{0}-{1}'.format(driver.type, driver.key))
+    return os.path.join(cachedir, 'pool-{0}.json'.format(key))
+
+
+class Pool(object):
+
+    """The standby nodes of one image, for one account"""
+
+    def __init__(self, driver_factory, image_name=config.DEFAULT_IMAGE_NAME,
+                 size=config.POOL_SIZE, ttl=config.POOL_TTL,
+                 location_id=config.DEFAULT_LOCATION_ID, size_id=config.DEFAULT_SIZE_ID,
+                 catalog=None):
+
+        """Since drivers aren't safe to share between threads, each
+        node is deployed with a driver from calling driver_factory"""
+
+        self.driver_factory = driver_factory
+        self.driver = driver_factory()
+        self.image_name = image_name
+        self.size = size
+        self.ttl = ttl
+        self.location_id = location_id
+        self.size_id = size_id
+        self.catalog = catalog
+        self.path = pool_path(self.driver, config.CACHE_DIR)
+
+    @contextlib.contextmanager
+    def entries(self):
+
+        """Lock the state file, and yield its list of entries, one dict
+        per node, which is saved when the block exits normally"""
+
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = []
+                if os.path.exists(self.path):
+                    try:
+                        with open(self.path) as f:
+                            entries = json.load(f)
+                    except ValueError as e:
+                        logger.warn('ignoring unreadable pool state {0}: {1}'.format(
+                                self.path, e))
+                yield entries
+                fd, tmp = tempfile.mkstemp(dir=dirname)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entries, f, indent=1)
+                os.rename(tmp, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def mine(self, entries, state=None):
+
+        """Return the entries of this pool's image, in state if given,
+        oldest first"""
+
+        return sorted([e for e in entries if e['image'] == self.image_name and
+                       (state is None or e['state'] == state)],
+                      key=lambda e: e['created'])
+
+    def get_catalog(self):
+        if self.catalog is None:
+            self.catalog = nodelib.get_catalog(self.driver)
+        return self.catalog
+
+    def fill(self, workers=config.DEFAULT_WORKERS):
+
+        """Deploy enough standby nodes that the pool has its full size,
+        counting nodes still being deployed, and return the list of
+        workers.Result of deploying them"""
+
+        with self.entries() as entries:
+            needed = self.size - len([e for e in self.mine(entries) if e['state'] != CLAIMED])
+            added = []
+            for i in range(needed):
+                added.append({'name': '{0}{1}-{2}'.format(
+                            config.POOL_PREFIX, self.image_name, config.random_str()),
+                              'image': self.image_name,
+                              'state': BOOTING,
+                              'created': time.time()})
+            entries.extend(added)
+        if not added:
+            return []
+        logger.info('adding {0} standby nodes to the {1} pool'.format(len(added),
+                                                                    self.image_name))
+        catalog = self.get_catalog()
+
+        def deploy(entry):
+            driver = self.driver_factory()
+            try:
+                deployment = nodelib.Deployment(name=entry['name'], image_name=self.image_name)
+                node = deployment.deploy(driver, self.location_id, self.size_id, catalog)
+                if node.sum_exit_status() != 0:
+                    raise Exception('scripts failed on standby node {0}'.format(node.name))
+            except Exception:
+                self.update(entry['name'], None)
+                nodelib.destroy_by_name(entry['name'], driver)
+                raise
+            password = node.extra.get('password') \
+                if 'generates_password' in driver.features['create_node'] else None
+            self.update(entry['name'], {'state': READY, 'id': node.id, 'password': password,
+                                        'image_id': node.image.id,
+                                        'image_name': node.image.name})
+            return node
+
+        return provision.workers.map_bounded(deploy, added, workers)
+
+    def update(self, name, changes):
+
+        """Update the entry of the named node with changes, or remove
+        it if changes is None"""
+
+        with self.entries() as entries:
+            for entry in list(entries):
+                if entry['name'] == name:
+                    if changes is None:
+                        entries.remove(entry)
+                    else:
+                        entry.update(changes)
+
+    def reap(self):
+
+        """Destroy standby nodes of this pool's image which have gone
+        unclaimed for longer than the ttl, or failed to be deployed by
+        then, forget nodes which no longer exist, and return the names
+        of the destroyed nodes"""
+
+        nodes = dict((n.name, n) for n in nodelib.list_nodes(self.driver))
+        expired = []
+        with self.entries() as entries:
+            now = time.time()
+            for entry in self.mine(entries):
+                if entry['state'] == BOOTING and now - entry['created'] < self.ttl:
+                    continue
+                if entry['name'] not in nodes:
+                    entries.remove(entry)
+                elif entry['state'] != CLAIMED and now - entry['created'] >= self.ttl:
+                    entries.remove(entry)
+                    expired.append(nodes[entry['name']])
+        for node in expired:
+            logger.info('destroying unclaimed standby node {0}'.format(node.name))
+            nodelib.NodeProxy(node, None).destroy()
+        return [node.name for node in expired]
+
+    def claim(self):
+
+        """Claim the oldest ready standby node, and return the entry
+        and the node, or (None, None) if there is none"""
+
+        nodes = dict((n.name, n) for n in nodelib.list_nodes(self.driver)
+                     if n.state == NodeState.RUNNING)
+        command = 'mkdir -p {0} && mkdir {1}'.format(
+            quote(config.DEFAULT_TARGETDIR),
+            quote(os.path.join(config.DEFAULT_TARGETDIR, config.POOL_CLAIM_NAME)))
+        while True:
+            with self.entries() as entries:
+                ready = [e for e in self.mine(entries, READY) if e['name'] in nodes]
+                if not ready:
+                    return None, None
+                entry = ready[0]
+                entry['state'] = CLAIMED
+                entry['claimed'] = time.time()
+            node = nodes[entry['name']]
+            try:
+                stdout, stderr, status = nodelib.run_command(
+                    self.driver, node, command, entry.get('password'))
+            except Exception as e:
+                logger.warn('destroying unreachable standby node {0}: {1}'.format(
+                        node.name, e))
+                self.update(entry['name'], None)
+                nodelib.NodeProxy(node, None).destroy()
+                continue
+            if status == 0:
+                logger.info('claimed standby node {0}'.format(node.name))
+                return entry, node
+            logger.warn('standby node {0} was already claimed'.format(node.name))
+
+    def deploy(self, deployment):
+
+        """Deploy deployment to a claimed standby node, skipping the
+        default bundles the pool already installed, and return the
+        NodeProxy, or None if the pool is empty"""
+
+        entry, node = self.claim()
+        if node is None:
+            logger.info('no standby node in the {0} pool'.format(self.image_name))
+            return None
+        if nodelib.rename_node(self.driver, node, deployment.name):
+            self.update(entry['name'], {'name': deployment.name})
+        else:
+            logger.info('{0} cannot rename nodes, so {1} keeps its name'.format(
+                    self.driver.name, node.name))
+            deployment.rename(node.name)
+        defaults = len(nodelib.default_bundles(self.image_name))
+        deployment.install_bundles = deployment.install_bundles[defaults:]
+        matches = [i for i in self.get_catalog().images
+                   if str(i.id) == str(entry.get('image_id'))]
+        image = matches[-1] if matches else NodeImage(entry.get('image_id'),
+                                                      entry.get('image_name'), self.driver)
+        return deployment.deploy_existing(self.driver, node, entry.get('password'), image)
+
+    def list(self):
+        with self.entries() as entries:
+            return self.mine(entries)
+
+
+def parser():
+    parser = argparse.ArgumentParser(description='Keep a pool of standby nodes')
+    config.add_auth_args(parser, config)
+    parser.add_argument('action', choices=['fill', 'reap', 'watch', 'list'],
+                        help='fill or reap the pool once, do both every interval, '
+                        'or list the standby nodes')
+    parser.add_argument('-i', '--image', default=config.DEFAULT_IMAGE_NAME)
+    parser.add_argument('-l', '--location', default=config.DEFAULT_LOCATION_ID, type=int)
+    parser.add_argument('-s', '--size', default=config.DEFAULT_SIZE_ID, type=int)
+    parser.add_argument('--pool-size', default=config.POOL_SIZE, type=int,
+                        help='number of standby nodes to keep')
+    parser.add_argument('--ttl', default=config.POOL_TTL, type=float,
+                        help='seconds before an unclaimed standby node is destroyed')
+    parser.add_argument('--interval', default=config.POOL_INTERVAL, type=float,
+                        help='seconds between refills and reaps when watching')
+    parser.add_argument('--workers', default=config.DEFAULT_WORKERS, type=int,
+                        help='maximum number of nodes deployed at the same time')
+    return parser
+
+def driver_factory(parsed):
+    return lambda: nodelib.get_driver(parsed.secret_key, parsed.userid, parsed.provider)
+
+def pool(parsed):
+    return Pool(driver_factory(parsed), parsed.image, parsed.pool_size, parsed.ttl,
+                parsed.location, parsed.size)
+
+def fill(standby, workers):
+    results = standby.fill(workers)
+    for result in results:
+        if not result.ok:
+            print('{0}:\n{1}'.format(result.item['name'], result.tb), file=sys.stderr)
+    return len([r for r in results if not r.ok])
+
+def pool_nodes(parsed):
+    standby = pool(parsed)
+    if parsed.action == 'list':
+        for entry in standby.list():
+            print('{0} {1} {2}'.format(entry['name'], entry['state'], time.strftime(
+                        '%Y-%m-%d %H:%M:%S', time.localtime(entry['created']))))
+        return 0
+    if parsed.action == 'reap':
+        standby.reap()
+        return 0
+    if parsed.action == 'fill':
+        return fill(standby, parsed.workers)
+    while True:
+        try:
+            standby.reap()
+            fill(standby, parsed.workers)
+        except Exception:
+            logger.exception('refilling the {0} pool failed'.format(parsed.image))
+        time.sleep(parsed.interval)
+
+def main():
+    return config.handle_errors(pool_nodes, config.reconfig(parser))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,324 @@
+"""Cheap readiness probes of booting nodes' ssh servers.
+
+A node which is running may still refuse, or accept and drop,
+connections to its ssh port for a minute or more while it boots.
+Attempting a full ssh handshake, with its key exchange, every few
+seconds until one succeeds costs the deploying host CPU for every
+node, and logs a failure each time.  So connect_ssh_client() first
+waits for the node's ssh server to send its banner, which costs one
+TCP connection and a read.
+
+A single thread probes every node being waited on at once, with
+non-blocking connects multiplexed by poll(), or select() where poll()
+is missing.  Each failed probe is retried after backing off
+exponentially, with jitter, so that nodes booted together don't all
+probe in lockstep."""
+
+from __future__ import absolute_import
+
+import errno
+import math
+import os
+import random
+import select
+import socket
+import threading
+import time
+
+import logging
+logger = logging.getLogger('provision')
+
+MIN_WAIT_PERIOD = 0.25
+MAX_WAIT_PERIOD = 2 # probes are cheap, so this is less than a handshake retry's wait
+BACKOFF = 1.5
+JITTER = 0.5 # fraction of each wait period which is randomized away
+ATTEMPT_TIMEOUT = 5 # seconds to connect and receive the banner
+SLACK = 0.05 # probes due within this many seconds of each other are started together
+BANNER_LIMIT = 8192 # bytes read without a banner before giving up on a probe
+IDENTIFICATION = b'SSH-2.0-provision_probe\r\n' # sent back, so servers log a clean disconnect
+
+CONNECTING = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+class NotReadyError(Exception):
+
+    """A host's ssh server did not send its banner in time"""
+
+
+class Probe(object):
+
+    """A host and port being probed until its ssh server sends its
+    banner, or until deadline"""
+
+    def __init__(self, host, port, deadline, callback, wait_period=MIN_WAIT_PERIOD):
+        self.host = host
+        self.port = port
+        self.deadline = deadline
+        self.callback = callback
+        self.wait_period = wait_period
+        self.due = time.time()
+        self.attempt_end = None
+        self.attempts = 0
+        self.sock = None
+        self.connected = False
+        self.received = b''
+        self.error = None
+        self.done = False
+
+    def start(self, now, attempt_timeout=ATTEMPT_TIMEOUT):
+
+        """Start connecting, without waiting for the connection"""
+
+        self.attempts += 1
+        self.attempt_end = now + attempt_timeout
+        self.connected = False
+        self.received = b''
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            self.host, self.port, 0, socket.SOCK_STREAM)[0]
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        code = self.sock.connect_ex(address)
+        if code not in CONNECTING:
+            raise socket.error(code, os.strerror(code))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def ready(self):
+
+        """Continue the attempt once the socket is ready, and return
+        True if the banner has been received"""
+
+        if not self.connected:
+            code = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if code:
+                raise socket.error(code, os.strerror(code))
+            self.connected = True
+            return False
+        data = self.sock.recv(1024)
+        if not data:
+            raise EOFError('connection closed before the ssh banner')
+        self.received += data
+        # servers may send other lines before the banner
+        if any(l.startswith(b'SSH-') for l in self.received.split(b'\n')[:-1]):
+            return True
+        if len(self.received) > BANNER_LIMIT:
+            raise EOFError('no ssh banner in the first {0} bytes'.format(BANNER_LIMIT))
+        return False
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def back_off(self, now, error, backoff=BACKOFF, max_wait_period=MAX_WAIT_PERIOD):
+
+        """Give up on the current attempt, and retry after the wait
+        period, less up to JITTER of it, which then grows"""
+
+        self.close()
+        self.error = error
+        self.due = now + self.wait_period * (1 - JITTER * random.random())
+        self.wait_period = min(self.wait_period * backoff, max_wait_period)
+
+
+def ready_fds(readers, writers, timeout):
+
+    """Return the set of file descriptors of readers and writers which
+    are ready, waiting at most timeout seconds for one"""
+
+    try:
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            for fd in readers:
+                poller.register(fd, select.POLLIN)
+            for fd in writers:
+                poller.register(fd, select.POLLOUT)
+            return set(fd for fd, event in poller.poll(int(math.ceil(timeout * 1000))))
+        readable, writable, failed = select.select(readers, writers, writers, timeout)
+        return set(readable) | set(writable) | set(failed)
+    except (select.error, OSError) as e:
+        if e.args[0] != errno.EINTR:
+            raise
+        return set()
+
+
+class ReadinessProber(object):
+
+    """Probes, from one thread, every host and port waited on"""
+
+    def __init__(self, backoff=BACKOFF, max_wait_period=MAX_WAIT_PERIOD,
+                 attempt_timeout=ATTEMPT_TIMEOUT):
+        self.backoff = backoff
+        self.max_wait_period = max_wait_period
+        self.attempt_timeout = attempt_timeout
+        self.lock = threading.Lock()
+        self.probes = []
+        self.thread = None
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.attempts = 0
+
+    def watch(self, host, port, timeout, callback, wait_period=MIN_WAIT_PERIOD):
+
+        """Probe host and port until its ssh server sends its banner,
+        or for timeout seconds, then call callback(probe, error) from
+        the probing thread, where error is None if the server is ready,
+        and otherwise a NotReadyError.  Return the Probe."""
+
+        probe = Probe(host, port, time.time() + timeout, callback, wait_period)
+        self.lock.acquire()
+        try:
+            self.probes.append(probe)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='provision-prober')
+                self.thread.daemon = True
+                self.thread.start()
+        finally:
+            self.lock.release()
+        os.write(self.wakeup_w, b'x')
+        return probe
+
+    def wait(self, host, port, timeout, wait_period=MIN_WAIT_PERIOD):
+
+        """Block until the ssh server on host and port sends its
+        banner, and return the Probe.  Raise NotReadyError if it
+        doesn't within timeout seconds."""
+
+        # python 2 waits on an Event with a timeout by polling, which
+        # for many waiting threads costs more than probing, so wait on
+        # a pipe, bounded in case the probing thread never calls back
+        errors = []
+        lock = threading.Lock()
+        r, w = os.pipe()
+        def done(probe, error):
+            with lock:
+                errors.append(error)
+                if w is not None:
+                    os.write(w, b'x')
+        try:
+            probe = self.watch(host, port, timeout, done, wait_period)
+            end = time.time() + timeout + self.attempt_timeout + 1
+            while not errors and time.time() < end:
+                ready_fds([r], [], max(0, end - time.time()))
+        finally:
+            with lock:
+                os.close(r)
+                os.close(w)
+                w = None
+        if not errors:
+            raise NotReadyError('probing {0}:{1} did not finish'.format(host, port))
+        if errors[0] is not None:
+            raise errors[0]
+        return probe
+
+    def run(self):
+
+        """Probe until no probes remain, and if probing fails
+        unexpectedly, fail every probe rather than leave them waiting"""
+
+        try:
+            self.probe_all()
+        except Exception as e:
+            logger.exception('probing failed')
+            self.lock.acquire()
+            try:
+                probes, self.probes, self.thread = self.probes, [], None
+            finally:
+                self.lock.release()
+            for probe in probes:
+                probe.close()
+                probe.done = True
+                probe.callback(probe, e)
+
+    def probe_all(self):
+
+        """Step every probe, then wait for a socket or the earliest
+        due probe, until none remain"""
+
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.probes:
+                    self.thread = None
+                    return
+                probes = self.probes[:]
+            finally:
+                self.lock.release()
+
+            now = time.time()
+            for probe in probes:
+                self.step(probe, now, False)
+            probes = [p for p in probes if not p.done]
+            if not probes:
+                continue
+            readers = [p.fileno() for p in probes if p.sock is not None and p.connected]
+            writers = [p.fileno() for p in probes if p.sock is not None and not p.connected]
+            due = [p.attempt_end if p.sock is not None else p.due for p in probes]
+            timeout = max(SLACK, min(due + [p.deadline for p in probes]) - now)
+            ready = ready_fds(readers + [self.wakeup_r], writers, timeout)
+            if self.wakeup_r in ready:
+                os.read(self.wakeup_r, 4096)
+
+            now = time.time()
+            for probe in probes:
+                if probe.sock is not None and probe.fileno() in ready:
+                    self.step(probe, now, True)
+
+    def step(self, probe, now, ready):
+
+        """Advance probe, whose socket is ready if ready is True, and
+        remove it and call back if it is done"""
+
+        try:
+            if probe.sock is None:
+                if probe.due <= now + SLACK:
+                    self.attempts += 1
+                    probe.start(now, self.attempt_timeout)
+            elif ready:
+                if probe.ready():
+                    try:
+                        probe.sock.send(IDENTIFICATION)
+                    except EnvironmentError:
+                        pass
+                    probe.close()
+                    return self.finish(probe, None)
+            elif now >= probe.attempt_end:
+                raise socket.timeout('timed out')
+        except (EnvironmentError, EOFError) as e:
+            probe.back_off(now, e, self.backoff, self.max_wait_period)
+        except Exception as e:
+            probe.close()
+            return self.finish(probe, e)
+        if now >= probe.deadline:
+            probe.close()
+            self.finish(probe, NotReadyError(
+                    'no ssh server on {0}:{1} after {2} probes: {3}'.format(
+                        probe.host, probe.port, probe.attempts, probe.error or 'timed out')))
+
+    def finish(self, probe, error):
+        self.lock.acquire()
+        try:
+            if probe.done:
+                return
+            probe.done = True
+            self.probes.remove(probe)
+        finally:
+            self.lock.release()
+        probe.callback(probe, error)
+
+
+_prober = None
+_prober_lock = threading.Lock()
+
+def prober():
+
+    """Return the ReadinessProber shared by every connecting node"""
+
+    global _prober
+    _prober_lock.acquire()
+    try:
+        if _prober is None:
+            _prober = ReadinessProber()
+        return _prober
+    finally:
+        _prober_lock.release()
@@ -0,0 +1,146 @@
+"""On-disk registry of baked images.
+
+A baked image is a snapshot of a node on which a list of bundles has
+already been installed.  The registry records, for each provider
+account, which base image every baked image started from, and the
+bundles baked into it along with a fingerprint of their contents, so
+that a deployment can start from the baked image and skip those
+bundles, for as long as none of them has changed."""
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from provision.steps import file_digest
+import provision.manifest
+import provision.templates
+
+import logging
+logger = logging.getLogger('provision')
+
+
+def bundle_fingerprint(bundle, submap=None):
+
+    """Return a hex SHA1 digest of the targets and contents of the
+    files of bundle, a config.Bundle, and of its scripts as rendered
+    with submap, which changes whenever what installing it would do
+    changes.  Return None if a script uses a variable which differs
+    per node, such as node_name, since a baked image could only have
+    it installed with the values of the node it was baked from."""
+
+    if submap is None:
+        submap = {}
+    digest = hashlib.sha1()
+    items = []
+    for target, source in bundle.scriptmap.items():
+        script = provision.manifest.read_script(source)
+        template = provision.templates.CACHE.compile(script)
+        if template.keys & provision.templates.NODE_KEYS:
+            return None
+        items.append(('script', target, provision.templates.digest(
+                    provision.templates.render(script, submap))))
+    for target, source in sorted(bundle.filemap.items()):
+        items.append(('file', target, file_digest(source)))
+    for item in items:
+        for text in item:
+            digest.update(text.encode('utf-8'))
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class BakedImage(object):
+
+    """A snapshot of a node, taken after installing bundles, a list
+    of (bundle name, fingerprint) pairs, on a node of image base"""
+
+    def __init__(self, id, name, base, bundles, created=None):
+        self.id = id
+        self.name = name
+        self.base = base
+        self.bundles = [tuple(b) for b in bundles]
+        self.created = time.time() if created is None else created
+
+    def to_dict(self):
+        return {'id': self.id,
+                'name': self.name,
+                'base': self.base,
+                'bundles': [list(b) for b in self.bundles],
+                'created': self.created}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['id'], d['name'], d['base'], d['bundles'], d['created'])
+
+    def __repr__(self):
+        return '<BakedImage: id={0}, name={1}, base={2}, bundles={3}>'.format(
+            self.id, self.name, self.base, ', '.join(b[0] for b in self.bundles))
+
+
+def registry_path(driver, cachedir):
+
+    """Return the registry file path for the driver's provider and account"""
+
+    key = re.sub(r'[^\w.-]', '_', '{0}-{1}'.format(driver.type, driver.key))
+    return os.path.join(cachedir, 'baked-{0}.json'.format(key))
+
+_lock = threading.Lock()
+
+def load(path):
+
+    """Return the list of BakedImages registered in path, oldest first,
+    or an empty list if there is no readable registry"""
+
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path) as f:
+            return [BakedImage.from_dict(d) for d in json.load(f)]
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        logger.warn('ignoring unreadable baked image registry {0}: {1}'.format(path, e))
+        return []
+
+def add(path, image):
+
+    """Atomically add image to the registry in path, replacing any
+    image with the same id"""
+
+    _lock.acquire()
+    try:
+        images = [i for i in load(path) if i.id != image.id]
+        images.append(image)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'w') as f:
+            json.dump([i.to_dict() for i in images], f, indent=1)
+        os.rename(tmp, path)
+    finally:
+        _lock.release()
+
+def select(images, base, bundles):
+
+    """Return the BakedImage of base among images which has the longest
+    list of baked bundles forming a prefix of bundles, a list of
+    (bundle name, fingerprint) pairs, along with the length of that
+    prefix.  Ties go to the most recently created image.  Return
+    (None, 0) if no image has any bundle to offer.  Bundles without a
+    fingerprint, and those after them, are never baked in."""
+
+    for i, (name, fingerprint) in enumerate(bundles):
+        if fingerprint is None:
+            bundles = bundles[:i]
+            break
+    best, length = None, 0
+    for image in sorted(images, key=lambda i: i.created, reverse=True):
+        n = len(image.bundles)
+        if image.base == base and length < n <= len(bundles) and \
+                list(image.bundles) == list(bundles[:n]):
+            best, length = image, n
+    return best, length
@@ -0,0 +1,121 @@
+"""Run a command, or bundles, on many existing nodes at once.
+
+Nodes are selected by name, shell style pattern or prefix, as by
+destroy-node, then each is connected to over ssh and run on
+concurrently, up to --workers at a time.  Each node's output and exit
+status is written as soon as it finishes, so a fleet takes about as
+long as its slowest node."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import sys
+import threading
+import argparse
+
+import provision.config as config
+import provision.destroy
+
+FORMATS = ['text', 'json']
+
+def parser():
+    parser = argparse.ArgumentParser(description='Run a command or bundles on existing nodes')
+    config.add_auth_args(parser, config)
+    parser.add_argument('names', nargs='*', default=[],
+                        help='names of nodes to run on, or shell style patterns such as '
+                        '"web-*"')
+    parser.add_argument('-f', '--file', default=[], action='append',
+                        help='file of names or patterns, one per line, or - for stdin')
+    parser.add_argument('-x', '--prefix', default=[], action='append',
+                        help='run on every node whose name starts with this')
+    parser.add_argument('-e', '--command',
+                        help='shell command to run on each node')
+    parser.add_argument('-b', '--bundles', default=[], action='append',
+                        help='bundle whose files to upload and scripts to run on each node, '
+                        'instead of a command.  Can be used multiple times.')
+    parser.add_argument('-t', '--subvars', default=[], action='append',
+                        help='key=value pairs of template substitution variables')
+    parser.add_argument('--format', default='text', choices=FORMATS)
+    parser.add_argument('--timeout', default=config.RUN_TIMEOUT, type=float,
+                        help='seconds to wait for each node\'s ssh server')
+    parser.add_argument('--workers', default=config.DEFAULT_WORKERS, type=int,
+                        help='maximum number of nodes run on at the same time')
+    return parser
+
+def prefixed(name, text):
+
+    """Return text with each of its lines prefixed by name"""
+
+    return ''.join('{0}: {1}\n'.format(name, line) for line in text.splitlines())
+
+def writer(format, out, err):
+
+    """Return a function which writes a workers.Result of running on a
+    node in format, stdout to out and stderr to err, one node at a
+    time"""
+
+    lock = threading.Lock()
+
+    def write_json(result):
+        record = {'name': result.item.name,
+                  'error': None if result.ok else str(result.error),
+                  'results': [{'name': n, 'stdout': o, 'stderr': e, 'exit_status': s}
+                              for n, o, e, s in result.value or []]}
+        with lock:
+            print(json.dumps(record, sort_keys=True), file=out)
+            out.flush()
+
+    def write_text(result):
+        name = result.item.name
+        with lock:
+            if not result.ok:
+                print('{0}: ERROR {1}'.format(name, result.error), file=err)
+                return
+            for script, stdout, stderr, status in result.value:
+                out.write(prefixed(name, stdout))
+                err.write(prefixed(name, stderr))
+                if status != 0:
+                    print('{0}: {1} exited with {2}'.format(name, script, status), file=err)
+            out.flush()
+
+    return write_json if format == 'json' else write_text
+
+def run(parsed, out=sys.stdout, err=sys.stderr):
+    names, patterns = provision.destroy.selectors(parsed)
+    if not (names or patterns or parsed.prefix):
+        print('ERROR: no names, patterns or prefixes given', file=err)
+        return 1
+    if bool(parsed.command) == bool(parsed.bundles):
+        print('ERROR: give either a command or bundles to run', file=err)
+        return 1
+    for bundle in parsed.bundles:
+        if bundle not in config.BUNDLEMAP:
+            print('ERROR: unknown bundle {0}'.format(bundle), file=err)
+            return 1
+    import provision.nodelib as nodelib # imports paramiko, so not for --help or errors
+    driver_factory = lambda: nodelib.get_driver(parsed.secret_key, parsed.userid,
+                                                parsed.provider)
+    nodes = nodelib.select_nodes(nodelib.list_nodes(driver_factory()), names,
+                                 parsed.prefix, patterns)
+    missing = sorted(set(names) - set(n.name for n in nodes))
+    for name in missing:
+        print('ERROR: no node named {0}'.format(name), file=err)
+
+    results = nodelib.run_many(nodes, driver_factory, parsed.command, parsed.bundles,
+                               parsed.subvars, parsed.workers, writer(parsed.format, out, err),
+                               parsed.timeout)
+    failed = [r for r in results if not r.ok]
+    nonzero = [r for r in results if r.ok and any(s != 0 for n, o, e, s in r.value)]
+    print('ran on {0} of {1} nodes: {2} failed, {3} exited nonzero, {4} names not '
+          'found'.format(len(results) - len(failed), len(nodes), len(failed), len(nonzero),
+                         len(missing)), file=err)
+    if failed or nonzero or missing or not results:
+        return 1
+    return 0
+
+def main():
+    return config.handle_errors(run, config.reconfig(parser))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,670 @@
+"""Deployment steps beyond the ones provided by libcloud, which are
+concerned with reducing the number of round trips to the node."""
+
+from __future__ import absolute_import
+
+import hashlib
+import os
+import sys
+import tarfile
+import tempfile
+import threading
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from libcloud.compute.deployment import (
+    Deployment, MultiStepDeployment, ScriptDeployment, SSHKeyDeployment)
+
+from provision.patches import FileDeployment, UPLOAD_BUFSIZE
+import provision.manifest
+import provision.trace
+
+import logging
+logger = logging.getLogger('provision')
+
+
+SPOOL_SIZE = 1024 * 1024 # archives larger than this are built on disk
+
+
+class RemoteCommandError(Exception):
+    pass
+
+def run_checked(client, cmd):
+
+    """Run cmd on the node, and return its stdout, raising
+    RemoteCommandError if it exits with a non-zero status"""
+
+    stdout, stderr, status = client.run(cmd)
+    if status != 0:
+        raise RemoteCommandError('{0!r} exited with status {1}: {2}'.format(
+                cmd, status, stderr))
+    return stdout
+
+
+def prepare(step):
+
+    """Do whatever work step, or the steps it contains, can do before
+    connecting to the node, such as packing archives and hashing files"""
+
+    if hasattr(step, 'prepare'):
+        step.prepare()
+    elif hasattr(step, 'steps'):
+        for s in step.steps:
+            prepare(s)
+
+
+class ArchiveDeployment(Deployment):
+    """
+    Install many files by uploading them as one compressed tar
+    archive, then extracting it on the node.
+    """
+
+    def __init__(self, filemap, target, bufsize=UPLOAD_BUFSIZE):
+        """
+        @type filemap: C{dict}
+        @keyword filemap: Maps absolute target path to local source path
+
+        @type target: C{str}
+        @keyword target: Location on node to upload the archive
+
+        @type bufsize: C{int}
+        @keyword bufsize: Bytes read from the archive per write to the node
+        """
+        self.filemap = filemap
+        self.target = target
+        self.bufsize = bufsize
+        self.archive = None
+        self.size = None
+
+    def pack(self):
+        """
+        Return the compressed archive as a file positioned at its
+        start, building it on first use.  Small archives are kept in
+        memory, larger ones spill to a temporary file.  Each file keeps
+        its local permissions, but is owned by root as if it had been
+        uploaded individually.
+        """
+        if self.archive is None:
+            buf = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            tar = tarfile.open(fileobj=buf, mode='w:gz')
+            for target, source in sorted(self.filemap.items()):
+                info = tar.gettarinfo(source, arcname=target.lstrip('/'))
+                info.uid = info.gid = 0
+                info.uname = info.gname = 'root'
+                with open(source, 'rb') as f:
+                    tar.addfile(info, f)
+            tar.close()
+            self.archive = buf
+            self.size = buf.tell()
+            logger.debug('packed {0} files into {1} bytes'.format(
+                    len(self.filemap), self.size))
+        self.archive.seek(0)
+        return self.archive
+
+    def prepare(self):
+        self.pack()
+
+    def run(self, node, client):
+        """
+        Stream the archive to the node as a single file and extract it
+        relative to the root directory.
+
+        See also L{Deployment.run}
+        """
+        client.put(path=self.target, contents=self.pack(), mode='wb', bufsize=self.bufsize)
+        run_checked(client, 'tar -xzpf {0} -C / && rm -f {0}'.format(quote(self.target)))
+        return node
+
+
+def file_steps(filemap, archive_target=None, bufsize=UPLOAD_BUFSIZE, mmap_threshold=None):
+
+    """Return the list of steps installing the files in filemap.  If
+    archive_target is given, files with absolute target paths are
+    uploaded together as an archive to that location on the node,
+    otherwise every file is uploaded individually."""
+
+    archived = {}
+    if archive_target is not None:
+        archived = dict((target, source) for target, source in filemap.items()
+                        if os.path.isabs(target))
+    steps = [FileDeployment(target, source, bufsize, mmap_threshold)
+             for target, source in filemap.items() if target not in archived]
+    if archived:
+        steps.append(ArchiveDeployment(archived, archive_target, bufsize))
+    return steps
+
+
+def file_digest(path, bufsize=UPLOAD_BUFSIZE):
+
+    """Return the hex SHA1 digest of the contents of local file path,
+    computed once per process while the file is unchanged, or restored
+    from the configuration manifest"""
+
+    return provision.manifest.file_digest(path, bufsize)
+
+def remote_digests(client, targets):
+
+    """Return a dict mapping each of targets which exists on the node
+    to the hex SHA1 digest of its contents, using a single command"""
+
+    if not targets:
+        return {}
+    stdout = run_checked(client, 'sha1sum -- {0} 2>/dev/null; true'.format(
+            ' '.join(quote(t) for t in targets)))
+    digests = {}
+    for line in stdout.splitlines():
+        # <40 hex digits><space><space or '*' for binary mode><path>
+        if len(line) > 42:
+            digests[line[42:]] = line[:40]
+    return digests
+
+
+class IncrementalFileDeployment(Deployment):
+    """
+    Install a set of files, skipping those whose content on the node
+    already matches the local source.
+    """
+
+    def __init__(self, filemap, archive_target=None, bufsize=UPLOAD_BUFSIZE,
+                 mmap_threshold=None):
+        """
+        @type filemap: C{dict}
+        @keyword filemap: Maps target path to local source path
+
+        @type archive_target: C{str}
+        @keyword archive_target: If given, upload changed files with absolute
+                                 target paths as an archive to this location
+
+        See also L{file_steps}
+        """
+        self.filemap = filemap
+        self.archive_target = archive_target
+        self.bufsize = bufsize
+        self.mmap_threshold = mmap_threshold
+        self.digests = None
+        self.uploaded = None
+
+    def local_digests(self):
+        """
+        Return a dict mapping each target to the digest of its source,
+        computing them on first use
+        """
+        if self.digests is None:
+            self.digests = dict((target, file_digest(source, self.bufsize))
+                                for target, source in self.filemap.items())
+        return self.digests
+
+    def prepare(self):
+        self.local_digests()
+
+    def changed(self, client):
+        """
+        Return the subset of filemap whose content differs on the node
+        """
+        local = self.local_digests()
+        remote = remote_digests(client, sorted(self.filemap))
+        return dict((target, source) for target, source in self.filemap.items()
+                    if remote.get(target) != local[target])
+
+    def run(self, node, client):
+        """
+        Upload only the changed files.
+
+        See also L{Deployment.run}
+        """
+        changed = self.changed(client)
+        logger.debug('{0} of {1} files changed'.format(len(changed), len(self.filemap)))
+        self.uploaded = changed
+        for step in file_steps(changed, self.archive_target, self.bufsize,
+                               self.mmap_threshold):
+            node = step.run(node, client)
+        return node
+
+
+RUNNER_HEAD = '''tmp=$(mktemp -d "${TMPDIR:-/tmp}/provision.XXXXXX") || exit 1
+trap 'rm -rf "$tmp"' 0
+'''
+
+RUNNER_SCRIPT = '''mkdir -p {dir} && cat > {path} <<'{delimiter}'
+{script}
+{delimiter}
+chmod 755 {path}
+{path} < /dev/null > "$tmp/out" 2> "$tmp/err"
+status=$?
+printf '{token} {index} %d %d %d\\n' $status $(wc -c < "$tmp/out") $(wc -c < "$tmp/err")
+cat "$tmp/out" "$tmp/err"
+'''
+
+class ScriptBatchDeployment(Deployment):
+    """
+    Install and run a sequence of scripts through a single shell
+    reading from one exec channel, instead of an upload and an exec
+    round trip for each script.  Each script's stdout, stderr and exit
+    status are still captured, into its own ScriptDeployment.
+    """
+
+    def __init__(self, scripts, shell='/bin/sh'):
+        """
+        @type scripts: C{list}
+        @keyword scripts: ScriptDeployments, to run in order
+
+        @type shell: C{str}
+        @keyword shell: Shell on the node which reads the runner from stdin
+        """
+        self.scripts = scripts
+        self.shell = shell
+        self.token = None
+        self.runner = None
+
+    @property
+    def exit_status(self):
+        """
+        The first non-zero exit status of the scripts, or 0, or None
+        if they haven't run
+        """
+        statuses = [s.exit_status for s in self.scripts]
+        if None in statuses:
+            return None
+        return ([s for s in statuses if s] or [0])[0]
+
+    def build(self):
+        """
+        Return the shell program which installs and runs each script,
+        and frames its output with a random token, building it on
+        first use
+        """
+        if self.runner is None:
+            text = ''.join(s.script for s in self.scripts)
+            token = 'PROVISION_' + hashlib.sha1(os.urandom(16)).hexdigest()
+            while token in text:
+                token = 'PROVISION_' + hashlib.sha1(os.urandom(16)).hexdigest()
+            parts = [RUNNER_HEAD]
+            for index, step in enumerate(self.scripts):
+                parts.append(RUNNER_SCRIPT.format(
+                        dir=quote(os.path.dirname(step.name) or '.'), path=quote(step.name),
+                        delimiter=token, script=step.script.rstrip('\n'), token=token,
+                        index=index))
+            self.token = token
+            self.runner = ''.join(parts)
+        return self.runner
+
+    def prepare(self):
+        self.build()
+
+    def parse(self, stdout):
+        """
+        Set the stdout, stderr and exit status of each script from the
+        runner's framed output, returning the number of scripts found
+        """
+        header = (self.token + ' ').encode('ascii')
+        found = 0
+        pos = 0
+        while True:
+            start = stdout.find(header, pos)
+            if start < 0:
+                return found
+            end = stdout.find(b'\n', start)
+            index, status, outlen, errlen = [
+                int(f) for f in stdout[start + len(header):end].split()]
+            out = stdout[end + 1:end + 1 + outlen]
+            err = stdout[end + 1 + outlen:end + 1 + outlen + errlen]
+            step = self.scripts[index]
+            step.stdout, step.stderr, step.exit_status = out, err, status
+            found += 1
+            pos = end + 1 + outlen + errlen
+
+    def run(self, node, client):
+        """
+        Stream the runner to a shell on the node, and collect each
+        script's output.  Raise RemoteCommandError if the runner
+        stopped before running every script.
+
+        See also L{Deployment.run}
+        """
+        stdout, stderr, status = client.run_stdin('{0} -s'.format(self.shell), self.build())
+        found = self.parse(stdout)
+        if found < len(self.scripts) or status != 0:
+            raise RemoteCommandError(
+                'script runner ran {0} of {1} scripts, exited with status {2}: {3}'.format(
+                    found, len(self.scripts), status, stderr))
+        return node
+
+
+class ScriptGroup(object):
+    """
+    A bundle's share of the script steps, which run in order, once the
+    groups it depends on have finished, while holding its locks.
+    """
+
+    def __init__(self, name, steps, depends=(), locks=()):
+        """
+        @type name: C{str}
+        @keyword name: Name of the group, usually its bundle's
+
+        @type steps: C{list}
+        @keyword steps: ScriptDeployments, or ScriptBatchDeployments
+
+        @type depends: C{list}
+        @keyword depends: Names of groups which must finish first
+
+        @type locks: C{list}
+        @keyword locks: Names of resources which no other running group
+                        may hold
+        """
+        self.name = name
+        self.steps = steps
+        self.depends = frozenset(depends)
+        self.locks = frozenset(locks)
+
+    @property
+    def scripts(self):
+        scripts = []
+        for step in self.steps:
+            scripts.extend(getattr(step, 'scripts', [step]))
+        return scripts
+
+
+class ParallelScriptDeployment(Deployment):
+    """
+    Run groups of scripts concurrently, each over its own channels of
+    the one ssh connection, as soon as the groups they depend on have
+    finished and no running group holds any of their locks.  Groups
+    which are ready at the same time start in the order given, so with
+    no dependencies or locks declared, at most channels groups run at
+    once.  If a group raises an exception, no further groups are
+    started, and the exception is raised once the running ones finish.
+    """
+
+    def __init__(self, groups, channels=4):
+        """
+        @type groups: C{list}
+        @keyword groups: ScriptGroups, in install order
+
+        @type channels: C{int}
+        @keyword channels: Maximum number of groups running at once
+        """
+        names = set(g.name for g in groups)
+        for group in groups:
+            unknown = group.depends - names
+            if unknown:
+                raise ValueError('script group {0} depends on unknown {1}'.format(
+                        group.name, ', '.join(sorted(unknown))))
+        order = []
+        while len(order) < len(groups):
+            ready = [g for g in groups if g not in order and group_ready(g, order)]
+            if not ready:
+                raise ValueError('script groups depend on each other: {0}'.format(
+                        ', '.join(g.name for g in groups if g not in order)))
+            order.extend(ready)
+        self.groups = groups
+        self.channels = max(1, channels)
+
+    @property
+    def scripts(self):
+        scripts = []
+        for group in self.groups:
+            scripts.extend(group.scripts)
+        return scripts
+
+    @property
+    def exit_status(self):
+        """
+        The first non-zero exit status of the scripts, or 0, or None
+        if they haven't run
+        """
+        statuses = [s.exit_status for s in self.scripts]
+        if None in statuses:
+            return None
+        return ([s for s in statuses if s] or [0])[0]
+
+    def prepare(self):
+        for group in self.groups:
+            for step in group.steps:
+                prepare(step)
+
+    def run_group(self, group, node, client):
+        """
+        Run the steps of group in order, each within its own span
+        """
+        tracer = provision.trace.current()
+        with tracer.span('ScriptGroup', group=group.name, scripts=len(group.scripts)):
+            for step in group.steps:
+                with tracer.span(type(step).__name__) as args:
+                    step.run(node, client)
+                    args.update(step_args(step))
+
+    def run(self, node, client):
+        """
+        Run each group in its own thread, as allowed by their
+        dependencies and locks.
+
+        See also L{Deployment.run}
+        """
+        tracer = provision.trace.current()
+        condition = threading.Condition()
+        pending = list(self.groups)
+        running = []
+        done = []
+        errors = []
+
+        def work(group):
+            try:
+                self.run_group(group, node, client)
+            except Exception:
+                errors.append(sys.exc_info())
+            condition.acquire()
+            try:
+                running.remove(group)
+                done.append(group)
+                condition.notify()
+            finally:
+                condition.release()
+
+        condition.acquire()
+        try:
+            while pending or running:
+                held = set()
+                for group in running:
+                    held.update(group.locks)
+                for group in list(pending):
+                    if errors or len(running) >= self.channels:
+                        break
+                    if group_ready(group, done) and not group.locks & held:
+                        pending.remove(group)
+                        running.append(group)
+                        held.update(group.locks)
+                        thread = threading.Thread(
+                            target=provision.trace.traced(tracer, work), args=(group,),
+                            name='provision-scripts-{0}'.format(group.name))
+                        thread.daemon = True
+                        thread.start()
+                if not running:
+                    break
+                condition.wait()
+        finally:
+            condition.release()
+
+        if errors:
+            raise errors[0][1]
+        return node
+
+
+def group_ready(group, done):
+
+    """Return whether every group which group depends on is in done"""
+
+    return group.depends <= set(g.name for g in done)
+
+
+def _update(digest, text):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    digest.update(text)
+    digest.update(b'\0')
+
+def step_digest(step):
+
+    """Return a hex SHA1 digest which changes whenever what step would
+    do to the node changes"""
+
+    digest = hashlib.sha1()
+    _update(digest, type(step).__name__)
+    if isinstance(step, ScriptDeployment):
+        _update(digest, step.name)
+        _update(digest, step.script)
+    elif isinstance(step, SSHKeyDeployment):
+        _update(digest, step.key)
+    elif isinstance(step, FileDeployment):
+        _update(digest, step.target)
+        _update(digest, file_digest(step.source))
+    elif hasattr(step, 'filemap'):
+        for target, source in sorted(step.filemap.items()):
+            _update(digest, target)
+            _update(digest, file_digest(source))
+    elif isinstance(step, ScriptBatchDeployment):
+        for script in step.scripts:
+            _update(digest, script.name)
+            _update(digest, script.script)
+    elif isinstance(step, ParallelScriptDeployment):
+        for group in step.groups:
+            _update(digest, group.name)
+            _update(digest, ' '.join(sorted(group.depends)))
+            _update(digest, ' '.join(sorted(group.locks)))
+            for script in group.scripts:
+                _update(digest, script.name)
+                _update(digest, script.script)
+    return digest.hexdigest()
+
+
+def step_args(step):
+
+    """Return a dict describing step, for its trace span: what it
+    installs, how many bytes it sends and, for scripts, how it exited"""
+
+    args = {}
+    if isinstance(step, ScriptDeployment):
+        args['target'] = step.name
+        args['bytes'] = len(step.script)
+        args['exit_status'] = step.exit_status
+    elif isinstance(step, SSHKeyDeployment):
+        args['bytes'] = len(step.key)
+    elif isinstance(step, FileDeployment):
+        args['target'] = step.target
+        args['bytes'] = os.path.getsize(step.source)
+    elif isinstance(step, ArchiveDeployment):
+        args['target'] = step.target
+        args['files'] = len(step.filemap)
+        args['bytes'] = step.size
+    elif isinstance(step, ScriptBatchDeployment):
+        args['scripts'] = len(step.scripts)
+        args['bytes'] = len(step.build())
+        args['exit_status'] = step.exit_status
+    elif isinstance(step, ParallelScriptDeployment):
+        args['scripts'] = len(step.scripts)
+        args['bytes'] = sum(len(s.script) for s in step.scripts)
+        args['exit_status'] = step.exit_status
+    elif isinstance(step, IncrementalFileDeployment) and step.uploaded is not None:
+        args['files'] = len(step.uploaded)
+        args['bytes'] = sum(os.path.getsize(s) for s in step.uploaded.values())
+    return args
+
+
+class TracedDeployment(MultiStepDeployment):
+    """
+    Runs a chain of Deployment steps, timing each of them as a span of
+    the current tracer.
+    """
+
+    def run_step(self, index, step, node, client):
+        """
+        Run a single step within its own span
+        """
+        with provision.trace.current().span(type(step).__name__, index=index) as args:
+            node = step.run(node, client)
+            args.update(step_args(step))
+        return node
+
+    def run(self, node, client):
+        """
+        Run each step in turn.
+
+        See also L{Deployment.run}
+        """
+        for index, step in enumerate(self.steps):
+            node = self.run_step(index, step, node, client)
+        return node
+
+
+class JournaledDeployment(TracedDeployment):
+    """
+    Runs a chain of Deployment steps, recording the index, digest and
+    exit status of each completed step in a journal on the node.  When
+    run again, steps are skipped for as long as the journal shows them
+    unchanged and successful, so a retry resumes from the first failed
+    or changed step instead of starting over.
+    """
+
+    def __init__(self, add=None, path=None):
+        """
+        @type add: C{list}
+        @keyword add: Deployment steps to add.
+
+        @type path: C{str}
+        @keyword path: Location of the journal on the node
+        """
+        TracedDeployment.__init__(self, add)
+        self.path = path
+        self.digests = None
+
+    def prepare(self):
+        """
+        Prepare each step, and compute its digest
+        """
+        for step in self.steps:
+            prepare(step)
+        self.digests = [step_digest(step) for step in self.steps]
+
+    def read_journal(self, client):
+        """
+        Return a dict mapping step index to (digest, exit status) of
+        the last recorded run of that step
+        """
+        stdout = run_checked(client, 'cat {0} 2>/dev/null; true'.format(quote(self.path)))
+        journal = {}
+        for line in stdout.splitlines():
+            try:
+                index, digest, status = line.split()
+                journal[int(index)] = (digest, int(status))
+            except ValueError:
+                logger.warn('ignoring journal line {0!r}'.format(line))
+        return journal
+
+    def record(self, client, index, digest, status):
+        run_checked(client, 'mkdir -p {0} && echo {1} {2} {3} >> {4}'.format(
+                quote(os.path.dirname(self.path)), index, digest, status, quote(self.path)))
+
+    def run(self, node, client):
+        """
+        Run each step which hasn't already completed.
+
+        See also L{Deployment.run}
+        """
+        if self.digests is None:
+            self.prepare()
+        journal = self.read_journal(client)
+        resuming = True
+        for index, step in enumerate(self.steps):
+            digest = self.digests[index]
+            if resuming and journal.get(index) == (digest, 0):
+                logger.debug('skipping completed step {0}'.format(index))
+                for script in getattr(step, 'scripts', [step]):
+                    if isinstance(script, ScriptDeployment) and script.exit_status is None:
+                        script.stdout, script.stderr, script.exit_status = '', '', 0
+                continue
+            resuming = False
+            node = self.run_step(index, step, node, client)
+            self.record(client, index, digest, getattr(step, 'exit_status', None) or 0)
+        return node
@@ -0,0 +1,290 @@
+"""Scripts parsed once into compiled templates, shared by every
+deployment which renders them.
+
+Across a fleet, the substitution map usually differs between nodes
+only in node_name.  So each script is parsed, by content hash, into a
+list of literal text and fields, and then bound, by the values of the
+fields it uses, to everything but NODE_KEYS.  Rendering a script for
+each node then only formats the node's own values into a format string
+of the bound template, instead of scanning and reformatting the whole
+script.
+
+Rendering gives the same result as config.TEMPLATE_TYPEMAP:
+format-string scripts raise KeyError for missing variables, and
+template-string scripts leave them as they are.  Other template types
+added to config.TEMPLATE_TYPEMAP are rendered by calling their
+function each time."""
+
+from __future__ import absolute_import
+
+import hashlib
+import re
+import string
+import threading
+
+import provision.config as config
+
+logger = config.logger
+
+NODE_KEYS = frozenset(['node_name']) # substitution variables which differ per node
+
+FORMATTER = string.Formatter()
+FIELD_KEY_RE = re.compile(r'[^.\[]*')
+
+MISSING = object()
+
+FIELD_COST = 1000 # roughly, characters str.format() scans in the time join renders a field
+
+
+class Field(object):
+
+    """A variable of a template, rendered from a substitution map"""
+
+    def __init__(self, key):
+        self.key = key
+
+
+class FormatField(Field):
+
+    """A replacement field of a format string, such as {name!r:>10}"""
+
+    def __init__(self, field_name, conversion, format_spec):
+        Field.__init__(self, FIELD_KEY_RE.match(field_name).group())
+        self.field_name = field_name
+        self.conversion = conversion
+        self.format_spec = format_spec
+
+    def render(self, submap):
+        if self.field_name == self.key:
+            value = submap[self.key]
+        else:
+            value = FORMATTER.get_field(self.field_name, (), submap)[0]
+        if self.conversion:
+            value = FORMATTER.convert_field(value, self.conversion)
+        return format(value, self.format_spec)
+
+    def format_field(self):
+        return '{{{0}{1}{2}}}'.format(self.field_name,
+                                      '!' + self.conversion if self.conversion else '',
+                                      ':' + self.format_spec if self.format_spec else '')
+
+
+class TemplateField(Field):
+
+    """A $name or ${name} placeholder of a string.Template, which is
+    left as it is if name is missing"""
+
+    def __init__(self, key, text):
+        Field.__init__(self, key)
+        self.text = text
+
+    def render(self, submap):
+        value = submap.get(self.key, MISSING)
+        if value is MISSING:
+            return self.text
+        return '%s' % (value,)
+
+    def format_field(self):
+        return '{{{0}!s}}'.format(self.key)
+
+
+class Template(object):
+
+    """A script as a list of literal strings and Fields"""
+
+    def __init__(self, segments, digest=None):
+        self.segments = []
+        for segment in segments:
+            if self.segments and not isinstance(segment, Field) and \
+                    not isinstance(self.segments[-1], Field):
+                self.segments[-1] += segment
+            elif segment or isinstance(segment, Field):
+                self.segments.append(segment)
+        self.digest = digest
+        self.keys = frozenset(s.key for s in self.segments if isinstance(s, Field))
+        fields = len([s for s in self.segments if isinstance(s, Field)])
+        self.formatted = fields * FIELD_COST > sum(len(s) for s in self.segments
+                                                   if not isinstance(s, Field))
+        self._format = None
+
+    def format_string(self):
+
+        """Return the template as a str.format() format string, built
+        on first use"""
+
+        if self._format is None:
+            self._format = ''.join([s.format_field() if isinstance(s, Field) else
+                                    s.replace('{', '{{').replace('}', '}}')
+                                    for s in self.segments])
+        return self._format
+
+    def bind(self, submap, exclude=NODE_KEYS):
+
+        """Return a Template in which the fields whose variable is in
+        submap, and not in exclude, are rendered into literal text"""
+
+        return Template([s.render(submap) if isinstance(s, Field) and s.key in submap
+                         and s.key not in exclude else s
+                         for s in self.segments], self.digest)
+
+    def render(self, submap):
+
+        """Return the template rendered with submap.  Templates with
+        many fields for their size are rendered in one call to
+        str.format(), unless some of their variables are missing, and
+        others by joining their literal text with each field"""
+
+        if self.formatted and all(k in submap for k in self.keys):
+            return self.format_string().format(**submap)
+        return ''.join([s.render(submap) if isinstance(s, Field) else s
+                        for s in self.segments])
+
+
+class FunctionTemplate(object):
+
+    """A script of a template type without a compiler, rendered by
+    calling its function from config.TEMPLATE_TYPEMAP"""
+
+    def __init__(self, text, function, digest=None):
+        self.text = text
+        self.function = function
+        self.digest = digest
+        self.keys = frozenset()
+
+    def bind(self, submap, exclude=NODE_KEYS):
+        return self
+
+    def render(self, submap):
+        return self.function(self.text, submap)
+
+
+def compile_format_string(text, digest=None):
+
+    """Return a Template of a str.format() format string, or a
+    FunctionTemplate if it nests fields inside format specs, or has
+    positional fields, which str.format() rejects with IndexError"""
+
+    segments = []
+    for literal, field_name, format_spec, conversion in FORMATTER.parse(text):
+        segments.append(literal)
+        if field_name is not None:
+            field = FormatField(field_name, conversion, format_spec)
+            if '{' in format_spec or not field.key or field.key.isdigit():
+                return FunctionTemplate(text, config.TEMPLATE_TYPEMAP['format-string'],
+                                        digest)
+            segments.append(field)
+    return Template(segments, digest)
+
+
+def compile_template_string(text, digest=None):
+
+    """Return a Template of a string.Template, rendered as by
+    safe_substitute()"""
+
+    segments = []
+    end = 0
+    for match in string.Template.pattern.finditer(text):
+        segments.append(text[end:match.start()])
+        end = match.end()
+        name = match.group('named') or match.group('braced')
+        if name is not None:
+            segments.append(TemplateField(name, match.group()))
+        elif match.group('escaped') is not None:
+            segments.append(string.Template.delimiter)
+        else:
+            segments.append(match.group())
+    segments.append(text[end:])
+    return Template(segments, digest)
+
+
+COMPILERS = {
+    'format-string': compile_format_string,
+    'template-string': compile_template_string,
+    }
+
+
+def template_type(script):
+
+    """Return the template type declared in script, or None"""
+
+    match = config.TEMPLATE_RE.search(script)
+    return match.groupdict()['type'] if match else None
+
+
+def digest(script):
+    if not isinstance(script, bytes):
+        script = script.encode('utf-8')
+    return hashlib.sha1(script).hexdigest()
+
+
+class TemplateCache(object):
+
+    """Compiled templates by script, and bound templates by content
+    hash and the values of their node-invariant variables, each
+    holding at most size entries"""
+
+    def __init__(self, size=config.TEMPLATE_CACHE_SIZE):
+        self.size = size
+        self.compiled = {}
+        self.bound = {}
+        self.lock = threading.Lock()
+
+    def put(self, cache, key, value):
+        with self.lock:
+            if len(cache) >= self.size:
+                cache.clear()
+            cache[key] = value
+
+    def compile(self, script):
+
+        """Return the compiled template of script, raising KeyError if
+        its template type is unsupported"""
+
+        template = self.compiled.get(script)
+        if template is None:
+            key = digest(script)
+            kind = template_type(script)
+            if kind is None:
+                template = Template([script], key)
+            elif kind in COMPILERS:
+                template = COMPILERS[kind](script, key)
+            else:
+                try:
+                    template = FunctionTemplate(script, config.TEMPLATE_TYPEMAP[kind], key)
+                except KeyError:
+                    logger.error('Unsupported template type: %s' % kind)
+                    raise
+            self.put(self.compiled, script, template)
+        return template
+
+    def render(self, script, submap, node_keys=NODE_KEYS):
+
+        """Return script with variables substituted from submap"""
+
+        template = self.compile(script)
+        invariant = sorted(template.keys - node_keys)
+        values = [submap.get(k, MISSING) for k in invariant]
+        try:
+            # values which compare equal, such as True and 1, render differently
+            key = (template.digest, tuple(zip(invariant, map(type, values), values)))
+            bound = self.bound.get(key)
+        except TypeError: # unhashable values
+            return template.render(submap)
+        if bound is None:
+            bound = template.bind(submap, node_keys)
+            self.put(self.bound, key, bound)
+        return bound.render(submap)
+
+    def clear(self):
+        with self.lock:
+            self.compiled.clear()
+            self.bound.clear()
+
+
+CACHE = TemplateCache()
+
+def render(script, submap, node_keys=NODE_KEYS):
+
+    """Render script with submap using the shared TemplateCache"""
+
+    return CACHE.render(script, submap, node_keys)
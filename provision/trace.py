@@ -0,0 +1,139 @@
+"""Per phase timing of deployments.
+
+A Tracer records the start and end of each phase of deploying one
+node (catalog lookup, node creation, boot, ssh connection attempts,
+and every deployment step) so that slow phases can be found across
+many deploys.  Traces can be saved with the node description, or
+written in the Chrome trace event format, which chrome://tracing and
+similar viewers display as a timeline."""
+
+from __future__ import absolute_import
+
+import contextlib
+import json
+import threading
+import time
+
+
+class Span(object):
+
+    """A named, timed phase, with arbitrary JSON serializable args"""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.end = None
+
+    def to_dict(self):
+        return {'name': self.name,
+                'start': self.start,
+                'end': self.end,
+                'duration': None if self.end is None else self.end - self.start,
+                'thread': self.thread,
+                'args': self.args}
+
+
+class Tracer(object):
+
+    """Records the spans of one node's deployment, from any thread"""
+
+    def __init__(self, name):
+        self.name = name
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+
+        """Time the enclosed block.  The yielded dict of args can be
+        updated within the block, e.g. with results"""
+
+        span = Span(name, args)
+        try:
+            yield span.args
+        finally:
+            span.end = time.time()
+            self.lock.acquire()
+            try:
+                self.spans.append(span)
+            finally:
+                self.lock.release()
+
+    def to_dicts(self):
+        return [s.to_dict() for s in sorted(self.spans, key=lambda s: s.start)]
+
+
+class NullTracer(Tracer):
+
+    """Discards everything, for code running outside any deployment"""
+
+    def __init__(self):
+        Tracer.__init__(self, None)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        yield args
+
+
+NULL = NullTracer()
+
+_local = threading.local()
+
+def current():
+
+    """Return the tracer activated in this thread, or NULL"""
+
+    return getattr(_local, 'tracer', NULL)
+
+@contextlib.contextmanager
+def activate(tracer):
+
+    """Make tracer current in this thread for the enclosed block, so
+    that code without access to the deployment, such as the libcloud
+    patches, can add spans to it"""
+
+    previous = current()
+    _local.tracer = tracer
+    try:
+        yield tracer
+    finally:
+        _local.tracer = previous
+
+def traced(tracer, func):
+
+    """Return a function which calls func with tracer activated, for
+    running func in another thread"""
+
+    def call(*args, **kwargs):
+        with activate(tracer):
+            return func(*args, **kwargs)
+    return call
+
+
+def chrome_events(tracers):
+
+    """Return the Chrome trace events for tracers, with a separate
+    timeline for each thread of each traced node"""
+
+    events = []
+    tids = {}
+    for tracer in tracers:
+        for span in tracer.spans:
+            key = (tracer.name, span.thread)
+            if key not in tids:
+                tids[key] = len(tids) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                               'tid': tids[key],
+                               'args': {'name': '{0} ({1})'.format(*key)}})
+            events.append({'name': span.name, 'cat': 'provision', 'ph': 'X', 'pid': 1,
+                           'tid': tids[key],
+                           'ts': int(span.start * 1e6),
+                           'dur': int((span.end - span.start) * 1e6),
+                           'args': span.args})
+    return events
+
+def write_chrome_trace(path, tracers):
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': chrome_events(tracers)}, f)
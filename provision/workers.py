@@ -0,0 +1,115 @@
+"""Bounded thread pool for running many slow, mostly blocking cloud
+operations (node creation, ssh sessions, destroys) concurrently.
+
+The work done per item is dominated by network latency, so threads
+are sufficient, and the bound keeps providers from rate limiting us."""
+
+from __future__ import absolute_import
+
+import sys
+import threading
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import logging
+logger = logging.getLogger('provision')
+
+
+class Result(object):
+
+    """The outcome of calling a function on a single item: either a
+    value, or the exception it raised along with its formatted
+    traceback"""
+
+    def __init__(self, item, value=None, error=None, tb=None):
+        self.item = item
+        self.value = value
+        self.error = error
+        self.tb = tb
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return '<Result {0!r}: {1!r}>'.format(self.item, self.value)
+        return '<Result {0!r}: {1!r}>'.format(self.item, self.error)
+
+
+def map_bounded(func, items, workers, callback=None):
+
+    """Call func on each of items using at most workers threads, and
+    return a list of Results in the same order as items.
+
+    Exceptions are captured in their Result rather than propagated,
+    so that one failure does not abort the remaining items.  If
+    callback is given, it is called with each Result as soon as it is
+    available, from the worker thread which produced it."""
+
+    items = list(items)
+    results = [None] * len(items)
+    todo = queue.Queue()
+    for i, item in enumerate(items):
+        todo.put((i, item))
+
+    def work():
+        while True:
+            try:
+                i, item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = Result(item, value=func(item))
+            except Exception:
+                error = sys.exc_info()[1]
+                logger.debug('{0!r} failed: {1}'.format(item, error))
+                result = Result(item, error=error, tb=traceback.format_exc())
+            results[i] = result
+            if callback is not None:
+                callback(result)
+
+    threads = [threading.Thread(target=work, name='provision-worker-{0}'.format(n))
+               for n in range(max(1, min(workers, len(items))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+class Background(object):
+
+    """Call a function in a separate thread, so that the caller can
+    do other work and collect the outcome later"""
+
+    def __init__(self, func, name='provision-background'):
+        self.func = func
+        self.result = None
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.result = Result(self.func, value=self.func())
+        except Exception:
+            error = sys.exc_info()[1]
+            logger.debug('{0!r} failed: {1}'.format(self.func, error))
+            self.result = Result(self.func, error=error, tb=traceback.format_exc())
+
+    def wait(self):
+
+        """Block until the function returns, then return its value or
+        raise its exception"""
+
+        self.thread.join()
+        if not self.result.ok:
+            logger.error(self.result.tb)
+            raise self.result.error
+        return self.result.value
@@ -14,6 +14,9 @@ setup(
             'list-nodes = provision.list:main',
             'deploy-node = provision.deploy:main',
             'destroy-node = provision.destroy:main',
+            'run-nodes = provision.run:main',
+            'bake-image = provision.bake:main',
+            'pool-nodes = provision.pool:main',
             ]},
     install_requires=['apache-libcloud>=0.5.2',
                       'argparse>=1.1',
@@ -0,0 +1,9 @@
+import atexit
+import shutil
+import tempfile
+
+import provision.config as config
+
+# so that no test writes to the real cache, even by loading the configuration
+config.CACHE_DIR = tempfile.mkdtemp(prefix='provision-test-cache-')
+atexit.register(shutil.rmtree, config.CACHE_DIR, True)
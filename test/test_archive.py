@@ -0,0 +1,61 @@
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import unittest
+
+import provision.config as config
+import provision.nodelib as nodelib
+import provision.steps as steps
+
+class MockClient(object):
+    def __init__(self, status=0):
+        self.puts = []
+        self.commands = []
+        self.status = status
+    def put(self, path, contents=None, chmod=None, mode='w', bufsize=None):
+        self.puts.append((path, contents, mode))
+    def run(self, cmd):
+        self.commands.append(cmd)
+        return ['', 'error', self.status]
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tmpdir, 'run.sh')
+        self.dotfile = os.path.join(self.tmpdir, '.screenrc')
+        open(self.script, 'w').write('#!/bin/sh\n')
+        open(self.dotfile, 'w').write('startup_message off\n')
+        os.chmod(self.script, 0o755)
+        self.deployment = steps.ArchiveDeployment(
+            {'/usr/local/bin/run.sh': self.script, '/root/.screenrc': self.dotfile},
+            '/root/deploy/files.tar.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_pack_preserves_paths_and_permissions(self):
+        tar = tarfile.open(fileobj=self.deployment.pack(), mode='r:gz')
+        members = dict((m.name, m) for m in tar.getmembers())
+        assert sorted(members) == ['root/.screenrc', 'usr/local/bin/run.sh']
+        assert stat.S_IMODE(members['usr/local/bin/run.sh'].mode) == 0o755
+        assert members['root/.screenrc'].uid == 0
+
+    def test_run_uploads_once_and_extracts(self):
+        client = MockClient()
+        self.deployment.run(None, client)
+        assert [p[0] for p in client.puts] == ['/root/deploy/files.tar.gz']
+        assert client.commands[0].startswith('tar -xzpf /root/deploy/files.tar.gz -C /')
+
+    def test_failed_extract_raises(self):
+        self.assertRaises(steps.RemoteCommandError, self.deployment.run, None,
+                          MockClient(status=2))
+
+    def test_deployment_archives_bundle_files(self):
+        nd = nodelib.Deployment(bundles=['dev'], archive=True)
+        archives = [s for s in nd.deployment.steps if isinstance(s, steps.ArchiveDeployment)]
+        assert len(archives) == 1
+        assert sorted(archives[0].filemap) == \
+            sorted(config.BUNDLEMAP['dev'].filemap)
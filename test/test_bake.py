@@ -0,0 +1,169 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import provision.bake as bake
+import provision.config as config
+import provision.nodelib as nodelib
+import provision.registry as registry
+
+from bench.fakecloud import FakeAPIError, FakeCloud
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_select(self):
+        images = [registry.BakedImage(1, 'one', 'lucid', [('a', '1')], created=1),
+                  registry.BakedImage(2, 'two', 'lucid', [('a', '1'), ('b', '2')], created=2),
+                  registry.BakedImage(3, 'changed', 'lucid', [('a', 'x')], created=3),
+                  registry.BakedImage(4, 'other', 'maverick', [('a', '1')], created=4),
+                  registry.BakedImage(5, 'newer', 'lucid', [('a', '1')], created=5)]
+        assert registry.select(images, 'lucid', [('a', '1'), ('b', '2'), ('c', '3')]) \
+            == (images[1], 2)
+        assert registry.select(images, 'lucid', [('a', '1'), ('c', '3')]) == (images[4], 1)
+        assert registry.select(images, 'lucid', [('a', '1')]) == (images[4], 1)
+        assert registry.select(images, 'lucid', [('b', '2')]) == (None, 0)
+        assert registry.select(images, 'lucid', []) == (None, 0)
+
+    def test_add_and_load(self):
+        path = os.path.join(self.dir, 'cache', 'baked.json')
+        assert registry.load(path) == []
+        registry.add(path, registry.BakedImage(1, 'one', 'lucid', [('a', '1')]))
+        registry.add(path, registry.BakedImage(2, 'two', 'lucid', []))
+        registry.add(path, registry.BakedImage(1, 'one again', 'lucid', [('a', '2')]))
+        images = registry.load(path)
+        assert [(i.id, i.name, i.bundles) for i in images] == [
+            (2, 'two', []), (1, 'one again', [('a', '2')])]
+        with open(path, 'w') as f:
+            f.write('garbage')
+        assert registry.load(path) == []
+
+    def test_fingerprint(self):
+        script = os.path.join(self.dir, 'script.sh')
+        with open(script, 'w') as f:
+            f.write('echo 1')
+        bundle = config.Bundle({'/root/deploy/script.sh': script})
+        fingerprint = registry.bundle_fingerprint(bundle)
+        assert fingerprint == registry.bundle_fingerprint(bundle)
+        with open(script, 'w') as f:
+            f.write('echo 2')
+        assert fingerprint != registry.bundle_fingerprint(bundle)
+
+    def test_fingerprint_templated(self):
+        script = os.path.join(self.dir, 'script.sh')
+        with open(script, 'w') as f:
+            f.write('# provision-template-type: format-string\necho {greeting}')
+        bundle = config.Bundle({'/root/deploy/script.sh': script})
+        hello = registry.bundle_fingerprint(bundle, {'greeting': 'hello', 'node_name': 'a'})
+        assert hello == registry.bundle_fingerprint(bundle, {'greeting': 'hello',
+                                                             'node_name': 'b'})
+        assert hello != registry.bundle_fingerprint(bundle, {'greeting': 'bye'})
+        with open(script, 'w') as f:
+            f.write('# provision-template-type: format-string\nhostname {node_name}')
+        assert registry.bundle_fingerprint(bundle, {'node_name': 'a'}) is None
+
+    def test_select_unfingerprinted(self):
+        images = [registry.BakedImage(1, 'one', 'lucid', [('a', '1'), ('b', None)])]
+        assert registry.select(images, 'lucid', [('a', '1'), ('b', None)]) == (None, 0)
+        images.append(registry.BakedImage(2, 'two', 'lucid', [('a', '1')]))
+        assert registry.select(images, 'lucid', [('a', '1'), ('b', None)]) == (images[1], 1)
+
+class TestBake(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k)) for k in
+                          ['PROVIDERS', 'SSH_PORT', 'CACHE_DIR', 'DEFAULT_BOOTSTRAP_BUNDLES',
+                           'SUBMAP'])
+        config.PROVIDERS = dict(config.PROVIDERS)
+        config.SUBMAP = dict(config.SUBMAP)
+        config.DEFAULT_BOOTSTRAP_BUNDLES = []
+        self.cloud = FakeCloud(seed=0)
+        self.provider = self.cloud.install()
+        config.CACHE_DIR = os.path.join(self.cloud.dir, 'cache')
+        self.scripts = {}
+        for name in ('bake-a', 'bake-b'):
+            self.scripts[name] = os.path.join(self.cloud.dir, name + '.sh')
+            self.write(name, '#!/bin/sh\necho {0} >> $HOME/installed\n'.format(name))
+            config.new_bundle(name, {'/root/deploy/{0}.sh'.format(name): self.scripts[name]})
+        self.driver = nodelib.get_driver(None, 'test', self.provider)
+
+    def tearDown(self):
+        self.cloud.close()
+        for name in self.scripts:
+            del config.BUNDLEMAP[name]
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+
+    def write(self, name, text):
+        with open(self.scripts[name], 'w') as f:
+            f.write(text)
+
+    def installed(self, node):
+        root = self.cloud.roots[node.extra['password']]
+        with open(os.path.join(root, 'root/installed')) as f:
+            return f.read().split()
+
+    def test_bake_and_deploy(self):
+        baked = bake.bake(self.driver, ['bake-a'])
+        assert baked.name.startswith(config.BAKED_IMAGE_PREFIX + 'lucid-')
+        assert [b[0] for b in baked.bundles] == ['bake-a']
+        assert self.cloud.calls['destroy_node'] == 1
+
+        deployment = nodelib.Deployment(bundles=['bake-a', 'bake-b'])
+        node = deployment.deploy(self.driver, 0, 0)
+        assert node.image.name == baked.name
+        assert deployment.install_bundles == ['bake-b']
+        assert [sd.stdout for sd in node.script_deployments] == ['']
+        assert self.installed(node) == ['bake-a', 'bake-b']
+
+        node = nodelib.Deployment(bundles=['bake-a', 'bake-b'], baked=False).deploy(
+            self.driver, 0, 0)
+        assert node.image.name == config.IMAGE_NAMES['lucid']
+        assert self.installed(node) == ['bake-a', 'bake-b']
+
+    def test_changed_bundle(self):
+        bake.bake(self.driver, ['bake-a'], name='baked-a')
+        self.write('bake-a', '#!/bin/sh\necho changed >> $HOME/installed\n')
+        deployment = nodelib.Deployment(bundles=['bake-a', 'bake-b'])
+        node = deployment.deploy(self.driver, 0, 0)
+        assert node.image.name == config.IMAGE_NAMES['lucid']
+        assert self.installed(node) == ['changed', 'bake-b']
+
+    def test_templated_bundle(self):
+        self.write('bake-a', '#!/bin/sh\n# provision-template-type: format-string\n'
+                   'echo {greeting} >> $HOME/installed\n')
+        bake.bake(self.driver, ['bake-a'], subvars=['greeting=hello'])
+        node = nodelib.Deployment(bundles=['bake-a'], subvars=['greeting=bye']).deploy(
+            self.driver, 0, 0)
+        assert node.image.name == config.IMAGE_NAMES['lucid']
+        assert self.installed(node) == ['bye']
+
+        self.write('bake-a', '#!/bin/sh\n# provision-template-type: format-string\n'
+                   'echo {node_name} >> $HOME/installed\n')
+        bake.bake(self.driver, ['bake-a', 'bake-b'])
+        deployment = nodelib.Deployment(bundles=['bake-a', 'bake-b'])
+        node = deployment.deploy(self.driver, 0, 0)
+        assert node.image.name == config.IMAGE_NAMES['lucid']
+        assert self.installed(node) == [node.name, 'bake-b']
+
+    def test_failed_scripts(self):
+        self.write('bake-a', '#!/bin/sh\nexit 3\n')
+        self.assertRaises(bake.BakeError, bake.bake, self.driver, ['bake-a'])
+        assert 'ex_save_image' not in self.cloud.calls
+
+    def test_failed_save(self):
+        self.cloud.failure_rates['ex_save_image'] = 1
+        self.assertRaises(FakeAPIError, bake.bake, self.driver, ['bake-a'])
+        assert self.cloud.calls['destroy_node'] == 1
+        self.cloud.calls.clear()
+        self.assertRaises(FakeAPIError, bake.bake, self.driver, ['bake-a'], keep_node=True)
+        assert 'destroy_node' not in self.cloud.calls
+
+if __name__ == '__main__':
+    unittest.main()
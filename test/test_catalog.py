@@ -0,0 +1,55 @@
+import shutil
+import tempfile
+import unittest
+
+from libcloud.compute.drivers.dummy import DummyNodeDriver
+
+import provision.catalog as catalog
+
+class CountingDriver(DummyNodeDriver):
+
+    """Counts catalog API calls"""
+
+    key = 'user@example.com'
+
+    def __init__(self):
+        DummyNodeDriver.__init__(self, 0)
+        self.calls = 0
+    def list_images(self, location=None):
+        self.calls += 1
+        return DummyNodeDriver.list_images(self, location)
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def test_cached_between_drivers(self):
+        first = CountingDriver()
+        fetched = catalog.get_catalog(first, self.cachedir, 60)
+        second = CountingDriver()
+        cached = catalog.get_catalog(second, self.cachedir, 60)
+        assert (first.calls, second.calls) == (1, 0)
+        assert [i.id for i in cached.images] == [i.id for i in fetched.images]
+        assert all(e.driver is second for e in cached.entries())
+
+    def test_expired(self):
+        catalog.get_catalog(CountingDriver(), self.cachedir, 60)
+        driver = CountingDriver()
+        catalog.get_catalog(driver, self.cachedir, 0)
+        assert driver.calls == 1
+
+    def test_refresh(self):
+        catalog.get_catalog(CountingDriver(), self.cachedir, 60)
+        driver = CountingDriver()
+        catalog.get_catalog(driver, self.cachedir, 60, refresh=True)
+        assert driver.calls == 1
+
+    def test_unreadable_cache_refetched(self):
+        driver = CountingDriver()
+        open(catalog.catalog_path(driver, self.cachedir), 'w').write('garbage')
+        assert len(catalog.get_catalog(driver, self.cachedir, 60).sizes) > 0
+        assert driver.calls == 1
@@ -1,9 +1,17 @@
+import argparse
 import unittest
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 import libcloud.compute.deployment
 
 import provision.config as config
+import provision.deploy as deploy
 import provision.nodelib as nodelib
+import provision.workers as workers
 
 class TestDeploy(unittest.TestCase):
 
@@ -18,3 +26,17 @@ class TestDeploy(unittest.TestCase):
         nd = nodelib.Deployment(bundles=['mta'])
         assert nd.name.startswith(config.DEFAULT_NAME_PREFIX)
         assert libcloud.compute.deployment.SSHKeyDeployment == type(nd.deployment.steps[0])
+
+    def test_count_must_be_positive(self):
+        assert 3 == deploy.positive_int('3')
+        for value in ('0', '-2'):
+            self.assertRaises(argparse.ArgumentTypeError, deploy.positive_int, value)
+
+    def test_fleet_retcode_does_not_wrap(self):
+        class Value(object):
+            def sum_exit_status(self):
+                return 128
+        class Item(object):
+            name = 'deploy-test'
+        results = [workers.Result(Item(), Value(), None, None)] * 2
+        assert 255 == deploy.fleet_retcode(results, out=StringIO())
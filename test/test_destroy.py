@@ -0,0 +1,102 @@
+import argparse
+import os
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import provision.config as config
+import provision.destroy as destroy
+import provision.nodelib as nodelib
+
+from bench.fakecloud import FakeCloud
+
+class MockNode(object):
+    def __init__(self, name):
+        self.name = name
+
+class TestSelect(unittest.TestCase):
+
+    def test_select_nodes(self):
+        nodes = [MockNode(n) for n in ['deploy-test-a', 'deploy-test-b', 'web-1', 'web-10',
+                                       'db']]
+        select = lambda *args: [n.name for n in nodelib.select_nodes(nodes, *args)]
+        assert select(['db', 'missing']) == ['db']
+        assert select([], ['deploy-test-']) == ['deploy-test-a', 'deploy-test-b']
+        assert select([], [], ['web-?']) == ['web-1']
+        assert select(['db'], [], ['*-a', 'web-*']) == ['deploy-test-a', 'web-1', 'web-10', 'db']
+        assert select() == []
+
+class TestDestroy(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k)) for k in ['PROVIDERS', 'SSH_PORT'])
+        config.PROVIDERS = dict(config.PROVIDERS)
+        self.cloud = FakeCloud(seed=0)
+        self.provider = self.cloud.install()
+        driver = nodelib.get_driver(None, 'test', self.provider)
+        image = driver.list_images()[0]
+        for name in ['deploy-test-a', 'deploy-test-b', 'deploy-test-c', 'keep-me']:
+            self.cloud.create_node(driver, name, image)
+
+    def tearDown(self):
+        self.cloud.close()
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+
+    def run_destroy(self, names=[], prefix=[], files=[]):
+        parsed = argparse.Namespace(names=names, prefix=prefix, file=files, workers=4,
+                                    secret_key=None, userid='test', provider=self.provider,
+                                    verbose=False)
+        self.cloud.calls.clear()
+        out = StringIO()
+        retcode = destroy.destroy(parsed, out)
+        return retcode, out.getvalue()
+
+    def remaining(self):
+        return sorted(n.name for n in self.cloud.nodes.values())
+
+    def test_names_and_globs(self):
+        retcode, out = self.run_destroy(['deploy-test-a', 'deploy-test-[bz]'])
+        assert retcode == 0, out
+        assert self.remaining() == ['deploy-test-c', 'keep-me']
+        assert self.cloud.calls == {'list_nodes': 1, 'destroy_node': 2}
+
+    def test_driver_per_worker(self):
+        drivers = []
+        def factory():
+            drivers.append(nodelib.get_driver(None, 'test', self.provider))
+            return drivers[-1]
+        nodes = nodelib.select_nodes(nodelib.list_nodes(factory()), prefixes=['deploy-'])
+        results = nodelib.destroy_many(nodes, factory, workers=2)
+        assert all(r.value for r in results), results
+        assert len(drivers) <= 3
+        assert self.remaining() == ['keep-me']
+
+    def test_prefix_and_refusal(self):
+        retcode, out = self.run_destroy(['keep-me'], prefix=['deploy-'])
+        assert retcode == 1
+        assert 'non-destroyable' in out
+        assert 'destroyed 3 of 4 nodes' in out
+        assert self.remaining() == ['keep-me']
+
+    def test_file_and_missing(self):
+        path = os.path.join(self.cloud.dir, 'names')
+        with open(path, 'w') as f:
+            f.write('# fleet\ndeploy-test-a\n\ndeploy-test-missing\n')
+        retcode, out = self.run_destroy(files=[path])
+        assert retcode == 1
+        assert 'no node named deploy-test-missing' in out
+        assert self.remaining() == ['deploy-test-b', 'deploy-test-c', 'keep-me']
+
+    def test_failure(self):
+        self.cloud.failure_rates['destroy_node'] = 1
+        retcode, out = self.run_destroy(prefix=['deploy-test-'])
+        assert retcode == 1
+        assert 'injected failure' in out
+        assert 'destroyed 0 of 3 nodes: 3 failed' in out
+
+if __name__ == '__main__':
+    unittest.main()
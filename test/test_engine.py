@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+import unittest
+
+from libcloud.common.types import LibcloudError
+
+import provision.config as config
+import provision.engine as engine
+import provision.nodelib as nodelib
+
+from bench.fakecloud import FakeCloud
+
+def double_later(loop, x, delay):
+    yield loop.sleep(delay)
+    raise engine.Return(2 * x)
+
+def failing(loop):
+    yield loop.sleep(0)
+    raise ValueError('failed')
+
+class MockNode(object):
+    def __init__(self, uuid, state, public_ip):
+        self.uuid = uuid
+        self.state = state
+        self.public_ip = public_ip
+
+class MockDriver(object):
+
+    """Reports a node as running after a number of list_nodes() calls"""
+
+    type = 'mock'
+    key = 'key'
+
+    def __init__(self, calls_until_running):
+        self.calls_until_running = calls_until_running
+        self.calls = 0
+    def list_nodes(self):
+        self.calls += 1
+        running = self.calls >= self.calls_until_running
+        return [MockNode('a', 0 if running else 3, ['127.0.0.1'] if running else [])]
+
+class TestLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = engine.Loop(workers=2)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_return(self):
+        assert self.loop.run_until_complete(double_later(self.loop, 21, 0)) == 42
+
+    def test_nested_coroutine(self):
+        def outer(loop):
+            a = yield double_later(loop, 1, 0)
+            b = yield double_later(loop, a, 0)
+            raise engine.Return(b)
+        assert self.loop.run_until_complete(outer(self.loop)) == 4
+
+    def test_exception(self):
+        self.assertRaises(ValueError, self.loop.run_until_complete, failing(self.loop))
+
+    def test_catch_exception(self):
+        def catching(loop):
+            try:
+                yield failing(loop)
+            except ValueError as e:
+                raise engine.Return(str(e))
+        assert self.loop.run_until_complete(catching(self.loop)) == 'failed'
+
+    def test_timers_run_concurrently(self):
+        start = time.time()
+        futures = self.loop.run_until_complete(engine.gather(
+                self.loop, [double_later(self.loop, i, 0.2) for i in range(50)]))
+        assert [f.result() for f in futures] == [2 * i for i in range(50)]
+        assert time.time() - start < 1
+
+    def test_executor(self):
+        threads = set()
+        def work(x):
+            threads.add(threading.current_thread().name)
+            time.sleep(0.05)
+            return x + 1
+        futures = self.loop.run_until_complete(engine.gather(
+                self.loop, [self.loop.run_in_executor(work, i) for i in range(6)]))
+        assert [f.result() for f in futures] == list(range(1, 7))
+        assert len(threads) <= 2
+        assert threading.current_thread().name not in threads
+
+    def test_executor_exception(self):
+        def fail():
+            raise KeyError('x')
+        future = self.loop.run_in_executor(fail)
+        self.assertRaises(KeyError, self.loop.run_until_complete, future)
+        assert 'KeyError' in future.tb
+
+    def test_gather_keeps_failures(self):
+        futures = self.loop.run_until_complete(engine.gather(
+                self.loop, [failing(self.loop), double_later(self.loop, 1, 0)]))
+        assert isinstance(futures[0].exception(), ValueError)
+        assert futures[1].result() == 2
+
+    def test_wait_until_running(self):
+        driver = MockDriver(3)
+        node = MockNode('a', 3, [])
+        running = self.loop.run_until_complete(
+            engine.wait_until_running(self.loop, driver, node, wait_period=0.01))
+        assert running.public_ip == ['127.0.0.1']
+        assert driver.calls == 3
+
+    def test_shared_polls(self):
+        driver = MockDriver(2)
+        nodes = [MockNode('a', 3, []) for i in range(10)]
+        self.loop.run_until_complete(engine.gather(
+                self.loop, [engine.wait_until_running(self.loop, driver, n, wait_period=0.01)
+                            for n in nodes]))
+        assert driver.calls == 2
+
+    def test_wait_timeout(self):
+        driver = MockDriver(1000)
+        node = MockNode('a', 3, [])
+        self.assertRaises(LibcloudError, self.loop.run_until_complete,
+                          engine.wait_until_running(self.loop, driver, node,
+                                                    wait_period=0.01, timeout=0.1))
+
+class TestDeployAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k)) for k in
+                          ['PROVIDERS', 'SSH_PORT', 'CACHE_DIR', 'DEFAULT_BOOTSTRAP_BUNDLES'])
+        config.PROVIDERS = dict(config.PROVIDERS)
+        config.DEFAULT_BOOTSTRAP_BUNDLES = []
+        self.cloud = FakeCloud(boot_time=0.2, seed=0)
+        self.provider = self.cloud.install()
+        config.CACHE_DIR = os.path.join(self.cloud.dir, 'cache')
+        script = os.path.join(self.cloud.dir, 'script.sh')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\necho $HOME\n')
+        config.new_bundle('engine-test', {'/root/deploy/script.sh': script})
+
+    def tearDown(self):
+        self.cloud.close()
+        del config.BUNDLEMAP['engine-test']
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+
+    def test_deploy_many_async(self):
+        deployments = [nodelib.Deployment(bundles=['engine-test']) for i in range(5)]
+        done = []
+        results = nodelib.deploy_many_async(
+            deployments, lambda: nodelib.get_driver(None, 'test', self.provider),
+            workers=2, callback=done.append, pipeline=True)
+        assert [r.item for r in results] == deployments
+        assert all(r.ok for r in results), [r.tb for r in results]
+        assert len(done) == 5
+        for result in results:
+            assert result.value.sum_exit_status() == 0
+            names = [s['name'] for s in result.value.trace.to_dicts()]
+            assert 'ScriptDeployment' in names
+        assert self.cloud.calls['create_node'] == 5
+
+    def test_failures_isolated(self):
+        self.cloud.failure_rates['create_node'] = 1
+        deployments = [nodelib.Deployment(bundles=['engine-test']) for i in range(2)]
+        results = nodelib.deploy_many_async(
+            deployments, lambda: nodelib.get_driver(None, 'test', self.provider), workers=2)
+        assert not any(r.ok for r in results)
+        assert 'injected failure' in results[0].tb
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import tempfile
+import shutil
+import unittest
+
+import provision.config as config
+import provision.nodelib as nodelib
+
+from bench.fakecloud import FakeCloud, FakeAPIError
+from bench.sshserver import NodeRoot
+
+class TestNodeRoot(unittest.TestCase):
+
+    def test_translation(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            node = NodeRoot(dirname)
+            assert node.path('/root/a') == dirname + '/root/a'
+            assert node.path('.ssh/authorized_keys') == dirname + '/root/.ssh/authorized_keys'
+            assert node.command('tar -xzpf /root/deploy/f.tgz -C / && rm -f /root/deploy/f.tgz') \
+                == 'tar -xzpf {0}/root/deploy/f.tgz -C {0} && rm -f {0}/root/deploy/f.tgz'.format(
+                dirname)
+            assert node.command('cat /rootless /root 2>/dev/null') \
+                == 'cat /rootless {0}/root 2>/dev/null'.format(dirname)
+            assert node.output('{0}/root/a  {0}/root/b'.format(dirname)) == '/root/a  /root/b'
+        finally:
+            shutil.rmtree(dirname)
+
+class TestFakeCloud(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k)) for k in
+                          ['PROVIDERS', 'SSH_PORT', 'CACHE_DIR', 'DEFAULT_BOOTSTRAP_BUNDLES'])
+        config.PROVIDERS = dict(config.PROVIDERS)
+        config.DEFAULT_BOOTSTRAP_BUNDLES = []
+        self.cloud = FakeCloud(seed=0)
+        self.provider = self.cloud.install()
+        config.CACHE_DIR = os.path.join(self.cloud.dir, 'cache')
+        self.source = os.path.join(self.cloud.dir, 'source')
+        with open(self.source, 'w') as f:
+            f.write('contents')
+        script = os.path.join(self.cloud.dir, 'script.sh')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\ncat $HOME/dir/file\n')
+        config.new_bundle('fake-test', {'/root/deploy/script.sh': script},
+                          {'/root/dir/file': self.source})
+
+    def tearDown(self):
+        self.cloud.close()
+        del config.BUNDLEMAP['fake-test']
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+
+    def test_deploy(self):
+        driver = nodelib.get_driver(None, 'test', self.provider)
+        deployment = nodelib.Deployment(bundles=['fake-test'], archive=True, journal=True)
+        node = deployment.deploy(driver, 0, 0)
+        assert node.sum_exit_status() == 0
+        assert node.script_deployments[0].stdout == 'contents'
+        root = self.cloud.roots[node.extra['password']]
+        with open(os.path.join(root, 'root/dir/file')) as f:
+            assert f.read() == 'contents'
+        assert os.path.exists(os.path.join(root, 'root/.ssh/authorized_keys'))
+        assert os.path.exists(os.path.join(root, 'root/deploy/.journal'))
+        assert self.cloud.calls['create_node'] == 1
+
+    def test_injected_failure(self):
+        self.cloud.failure_rates['create_node'] = 1
+        driver = nodelib.get_driver(None, 'test', self.provider)
+        deployment = nodelib.Deployment(bundles=['fake-test'])
+        self.assertRaises(FakeAPIError, deployment.deploy, driver, 0, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
+import random
 import unittest
 
+import provision.catalog as catalog
 import provision.nodelib as nodelib
 
 class MockImage(object):
@@ -32,6 +34,11 @@ class Test(unittest.TestCase):
                 'default-image_12',
                 'default-image13'])
 
+        self.undigited_images = map(MockImage, [
+                'default-image-beta',
+                'default-image2',
+                'default-image-rc'])
+
     def test_image_from_name_numbered(self):
         assert 'default-image10' == nodelib.image_from_name(
             self.name, self.numbered_images).name
@@ -43,3 +50,27 @@ class Test(unittest.TestCase):
     def test_image_from_name_inconsistent(self):
         assert 'default-image13' == nodelib.image_from_name(
             self.name, self.inconsistently_numbered_images).name
+
+    def test_image_from_name_undigited(self):
+        assert 'default-image2' == nodelib.image_from_name(
+            self.name, self.undigited_images).name
+
+    def test_image_from_name_missing(self):
+        self.assertRaises(IndexError, nodelib.image_from_name,
+                          'other-image', self.numbered_images)
+
+    def test_index_matches_linear_scan(self):
+        rng = random.Random(0)
+        images = [MockImage('%s%d' % (rng.choice(['ubuntu-', 'ubuntu-1', 'centos-', 'u']),
+                                      rng.randint(0, 50)))
+                  for i in range(300)]
+        index = catalog.ImageIndex(images)
+        for name in ['u', 'ubuntu-', 'ubuntu-1', 'ubuntu-13', 'centos-4', 'c']:
+            prefixed = [i for i in images if i.name.startswith(name)]
+            exact = [i for i in prefixed if i.name == name]
+            best = max(enumerate(prefixed), key=lambda p: (catalog.natural_key(p[1].name),
+                                                            p[0]))[1]
+            expected = exact[-1] if exact else best
+            assert index.lookup(name) is expected
+            assert nodelib.image_from_name(name, images) is expected
+            assert nodelib.image_from_name(name, index) is expected
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import provision.steps as steps
+
+class MockClient(object):
+
+    """Answers sha1sum with the digests of files previously put"""
+
+    def __init__(self, remote=None):
+        self.remote = remote or {}
+        self.puts = []
+    def put(self, path, contents=None, chmod=None, mode='w', bufsize=None):
+        self.puts.append(path)
+    def run(self, cmd):
+        assert cmd.startswith('sha1sum')
+        stdout = ''.join('{0}  {1}\n'.format(digest, path)
+                         for path, digest in sorted(self.remote.items()))
+        return [stdout, '', 0]
+
+class TestIncremental(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filemap = {}
+        for name in ['a', 'b', 'c']:
+            source = os.path.join(self.tmpdir, name)
+            open(source, 'w').write(name * 10)
+            self.filemap['/etc/' + name] = source
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def digest(self, target):
+        return steps.file_digest(self.filemap[target])
+
+    def test_new_node_uploads_everything(self):
+        client = MockClient()
+        steps.IncrementalFileDeployment(self.filemap).run(None, client)
+        assert sorted(client.puts) == ['/etc/a', '/etc/b', '/etc/c']
+
+    def test_unchanged_files_skipped(self):
+        client = MockClient({'/etc/a': self.digest('/etc/a'),
+                             '/etc/b': '0' * 40,
+                             '/etc/c': self.digest('/etc/c')})
+        steps.IncrementalFileDeployment(self.filemap).run(None, client)
+        assert client.puts == ['/etc/b']
+
+    def test_changed_files_archived(self):
+        client = MockClient({'/etc/a': self.digest('/etc/a')})
+        deployment = steps.IncrementalFileDeployment(self.filemap, '/root/deploy/f.tar.gz')
+        changed = deployment.changed(client)
+        assert sorted(changed) == ['/etc/b', '/etc/c']
+        archives = steps.file_steps(changed, '/root/deploy/f.tar.gz')
+        assert len(archives) == 1
+        assert sorted(archives[0].filemap) == ['/etc/b', '/etc/c']
+
+    def test_remote_digests_parses_paths_with_spaces(self):
+        client = MockClient({'/root/my file': 'f' * 40})
+        assert steps.remote_digests(client, ['/root/my file']) == {'/root/my file': 'f' * 40}
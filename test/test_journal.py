@@ -0,0 +1,59 @@
+import unittest
+
+import libcloud.compute.deployment
+
+import provision.steps as steps
+
+class MockClient(object):
+
+    """Keeps the journal in memory, and records which scripts ran"""
+
+    def __init__(self):
+        self.journal = ''
+        self.ran = []
+    def put(self, path, contents=None, chmod=None, mode='w', bufsize=None):
+        pass
+    def run(self, cmd):
+        if cmd.startswith('cat '):
+            return [self.journal, '', 0]
+        if cmd.startswith('mkdir -p '):
+            self.journal += cmd.split(' echo ')[1].split(' >> ')[0] + '\n'
+            return ['', '', 0]
+        self.ran.append(cmd)
+        return ['', '', 0]
+
+class Flaky(libcloud.compute.deployment.Deployment):
+    def __init__(self):
+        self.failed = False
+    def run(self, node, client):
+        if not self.failed:
+            self.failed = True
+            raise IOError('connection dropped')
+        return node
+
+def script(name, text='true'):
+    return libcloud.compute.deployment.ScriptDeployment(text, name)
+
+class TestJournal(unittest.TestCase):
+
+    def test_retry_resumes_at_failed_step(self):
+        client = MockClient()
+        deployment = steps.JournaledDeployment(
+            [script('/a.sh'), Flaky(), script('/b.sh')], '/root/deploy/.journal')
+        self.assertRaises(IOError, deployment.run, None, client)
+        assert client.ran == ['/a.sh']
+        deployment.run(None, client)
+        assert client.ran == ['/a.sh', '/b.sh']
+        assert [s.exit_status for s in (deployment.steps[0], deployment.steps[2])] == [0, 0]
+
+    def test_changed_step_reruns_remainder(self):
+        client = MockClient()
+        steps.JournaledDeployment([script('/a.sh'), script('/b.sh'), script('/c.sh')],
+                                  '/j').run(None, client)
+        steps.JournaledDeployment([script('/a.sh'), script('/b.sh', 'false'), script('/c.sh')],
+                                  '/j').run(None, client)
+        assert client.ran == ['/a.sh', '/b.sh', '/c.sh', '/b.sh', '/c.sh']
+
+    def test_step_digest(self):
+        assert steps.step_digest(script('/a.sh')) == steps.step_digest(script('/a.sh'))
+        assert steps.step_digest(script('/a.sh')) != steps.step_digest(script('/a.sh', 'ls'))
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import provision.config as config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def imported(module):
+
+    """Return whether importing module, in a fresh interpreter, loads
+    the configuration and imports paramiko"""
+
+    code = ('import sys; import provision.config as config; config.CACHE_DIR = {1!r}; '
+            'import {0}; '
+            'sys.stdout.write("%s %s" % (config.LOADED, "paramiko" in sys.modules))')
+    out = subprocess.Popen([sys.executable, '-c', code.format(module, config.CACHE_DIR)],
+                           cwd=ROOT, stdout=subprocess.PIPE).communicate()[0]
+    return out.decode().split() == ['True', 'True']
+
+class TestLazyConfig(unittest.TestCase):
+
+    def test_imports(self):
+        assert not imported('provision.config')
+        assert not imported('provision.list')
+        assert not imported('provision.destroy')
+        assert not imported('provision.run')
+        assert imported('provision.nodelib')
+
+    def test_default_pubkey(self):
+        saved = config.DEFAULT_PUBKEY, config.DEFAULT_PUBKEY_PATH
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, b'ssh-rsa AAAA test')
+            os.close(fd)
+            config.DEFAULT_PUBKEY = None
+            config.DEFAULT_PUBKEY_PATH = path
+            assert config.default_pubkey() == 'ssh-rsa AAAA test'
+            config.DEFAULT_PUBKEY_PATH = '/nonexistent'
+            assert config.default_pubkey() == 'ssh-rsa AAAA test'
+        finally:
+            os.remove(path)
+            config.DEFAULT_PUBKEY, config.DEFAULT_PUBKEY_PATH = saved
+
+if __name__ == '__main__':
+    unittest.main()
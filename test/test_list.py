@@ -0,0 +1,113 @@
+import argparse
+import csv
+import json
+import os
+import time
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import provision.config as config
+import provision.list as list_nodes
+import provision.nodelib as nodelib
+
+from bench.fakecloud import FakeCloud
+
+class TestList(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k)) for k in
+                          ['PROVIDERS', 'SSH_PORT', 'CACHE_DIR', 'CREDENTIALS'])
+        config.PROVIDERS = dict(config.PROVIDERS)
+        self.cloud = FakeCloud(seed=0)
+        self.provider = self.cloud.install()
+        self.cloud.install('fake-west')
+        config.CREDENTIALS = {'fake-west': ('west', None)}
+        config.CACHE_DIR = os.path.join(self.cloud.dir, 'cache')
+        driver = nodelib.get_driver(None, 'test', self.provider)
+        images = driver.list_images()
+        self.image = images[1]
+        self.cloud.create_node(driver, 'web-1', images[0])
+        self.cloud.create_node(driver, 'web-2', images[1])
+        self.cloud.create_node(driver, 'db-1', images[1])
+        self.cloud.boot_time = 3600
+        self.cloud.create_node(driver, 'web-3', images[1]) # no public ip yet
+
+    def tearDown(self):
+        self.cloud.close()
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+
+    def run_list(self, **kwargs):
+        args = dict(secret_key=None, userid='test', provider=self.provider, providers=[],
+                    prefix=[], state=[], image=[], format='text', refresh=False, workers=4)
+        args.update(kwargs)
+        out = StringIO()
+        retcode = list_nodes.print_list(argparse.Namespace(**args), out)
+        assert retcode == 0
+        return out.getvalue()
+
+    def test_text_without_public_ip(self):
+        assert self.run_list() == 'web-1 127.0.0.1\nweb-2 127.0.0.1\ndb-1 127.0.0.1\nweb-3 -\n'
+
+    def test_filters(self):
+        assert self.run_list(prefix=['web-'], state=['running']) == \
+            'web-1 127.0.0.1\nweb-2 127.0.0.1\n'
+        assert self.run_list(state=['pending']) == 'web-3 -\n'
+        expected = 'web-2 127.0.0.1\ndb-1 127.0.0.1\nweb-3 -\n'
+        assert self.run_list(image=[self.image.name]) == expected
+        assert self.run_list(image=[str(self.image.id)]) == expected
+
+    def test_terminated_not_a_state(self):
+        assert 'terminated' not in list_nodes.STATES
+        self.assertRaises(SystemExit, list_nodes.parser().parse_args,
+                          ['--state', 'terminated'])
+
+    def test_json_and_csv(self):
+        records = [json.loads(line) for line in self.run_list(format='json').splitlines()]
+        assert [r['name'] for r in records] == ['web-1', 'web-2', 'db-1', 'web-3']
+        assert records[3]['public_ip'] == [] and records[3]['state'] == 'pending'
+        rows = list(csv.reader(StringIO(self.run_list(format='csv', prefix=['db']))))
+        assert rows[0] == list_nodes.FIELDS
+        assert rows[1][:5] == [self.provider, 'db-1', '3', 'running', '127.0.0.1']
+
+    def test_cache(self):
+        self.run_list()
+        self.cloud.create_node(nodelib.get_driver(None, 'test', self.provider), 'web-4',
+                               self.image)
+        assert 'web-4' not in self.run_list()
+        assert self.cloud.calls['list_nodes'] == 1
+        assert 'web-4' in self.run_list(refresh=True)
+        assert self.cloud.calls['list_nodes'] == 2
+
+    def test_several_providers(self):
+        out = self.run_list(providers=[self.provider, 'fake-west'], prefix=['db'])
+        assert sorted(out.splitlines()) == ['{0} db-1 127.0.0.1'.format(self.provider),
+                                            'fake-west db-1 127.0.0.1']
+        assert os.path.exists(list_nodes.cache_path('fake-west', 'west', config.CACHE_DIR))
+
+    def test_streamed(self):
+        out = StringIO()
+        list_account = list_nodes.list_account
+        def slow_west(parsed, provider):
+            if provider == 'fake-west':
+                deadline = time.time() + 5
+                while 'db-1' not in out.getvalue() and time.time() < deadline:
+                    time.sleep(0.01)
+            return list_account(parsed, provider)
+        list_nodes.list_account = slow_west
+        try:
+            args = dict(secret_key=None, userid='test', provider=self.provider,
+                        providers=['fake-west', self.provider], prefix=['db'], state=[],
+                        image=[], format='text', refresh=False, workers=4)
+            assert list_nodes.print_list(argparse.Namespace(**args), out) == 0
+        finally:
+            list_nodes.list_account = list_account
+        assert out.getvalue() == '{0} db-1 127.0.0.1\nfake-west db-1 127.0.0.1\n'.format(
+            self.provider)
+
+if __name__ == '__main__':
+    unittest.main()
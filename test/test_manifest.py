@@ -0,0 +1,119 @@
+import copy
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import provision.config as config
+import provision.manifest as manifest
+
+INIT = '''def init(config):
+    config.DEFAULT_USERID = 'site-user'
+    config.add_bundle('site-web', ['web.sh'], ['/etc/web.conf'])
+'''
+
+NAMES = ['BUNDLEMAP', 'PUBKEYS', 'DEFAULT_USERID', 'PATH', 'TEMPLATE_TYPEMAP', 'MANIFEST_CACHE',
+         'DEFAULT_SECRET_KEY']
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((n, copy.copy(getattr(config, n))) for n in NAMES)
+        self.dir = tempfile.mkdtemp()
+        # imported as a module, named uniquely since imports are cached
+        self.site = os.path.join(self.dir, 'site_' + os.path.basename(self.dir))
+        self.cachedir = os.path.join(self.dir, 'cache')
+        for sub in ['scripts', 'files', 'pubkeys']:
+            os.makedirs(os.path.join(self.site, sub))
+        self.write('__init__.py', INIT)
+        self.write('scripts/web.sh', 'echo web\n')
+        self.write('files/web.conf', 'listen 80\n')
+        self.write('pubkeys/admin.pub', 'ssh-rsa AAAA admin\n')
+
+    def tearDown(self):
+        self.reset()
+        shutil.rmtree(self.dir)
+
+    def reset(self):
+        for n in NAMES:
+            setattr(config, n, copy.copy(self.saved[n]))
+
+    def write(self, name, text):
+        with open(os.path.join(self.site, name), 'w') as f:
+            f.write(text)
+
+    def configure(self):
+        self.reset()
+        config.MANIFEST_CACHE = True
+        used = manifest.configure([self.site], '/', self.cachedir)
+        assert config.DEFAULT_USERID == 'site-user'
+        assert config.PUBKEYS[-1] == 'ssh-rsa AAAA admin\n'
+        return used
+
+    def test_restore_and_invalidate(self):
+        assert not self.configure()
+        assert len(os.listdir(self.cachedir)) == 1
+        assert self.configure()
+        script = os.path.join(self.site, 'scripts/web.sh')
+        assert config.BUNDLEMAP['site-web'].scriptmap['/root/deploy/web.sh'] == script
+        assert manifest.read_script(script) == 'echo web\n'
+
+        time.sleep(0.01)
+        self.write('scripts/web.sh', 'echo changed\n')
+        assert not self.configure()
+        assert manifest.read_script(script) == 'echo changed\n'
+        assert self.configure()
+
+        self.write('scripts/new.sh', 'echo new\n') # changes the directory
+        assert not self.configure()
+
+    def test_other_starting_settings(self):
+        self.configure()
+        self.reset()
+        config.DEFAULT_USERID = 'someone'
+        assert not manifest.configure([self.site], '/', self.cachedir)
+
+    def test_unpicklable_settings(self):
+        self.write('__init__.py', INIT + '''
+    config.TEMPLATE_TYPEMAP['upper'] = lambda text, submap: text.upper()
+''')
+        assert not self.configure()
+        assert not self.configure()
+        assert 'upper' in config.TEMPLATE_TYPEMAP
+        assert not os.path.exists(self.cachedir)
+
+    def test_disabled_by_configuration(self):
+        self.write('__init__.py', INIT + '''
+    config.MANIFEST_CACHE = False
+''')
+        assert not self.configure()
+        assert not os.path.exists(self.cachedir)
+
+    def test_off_by_default(self):
+        assert self.saved['MANIFEST_CACHE'] is False
+        assert not self.configure()
+        assert self.configure()
+        self.reset()
+        assert not manifest.configure([self.site], '/', self.cachedir)
+        assert os.listdir(self.cachedir) == [] # the stale manifest is discarded
+
+    def test_credentials_not_recorded(self):
+        self.write('__init__.py', INIT + '''
+    config.DEFAULT_SECRET_KEY = 'hunter2'
+''')
+        assert not self.configure()
+        assert config.DEFAULT_SECRET_KEY == 'hunter2'
+        assert not self.configure()
+        assert not os.path.exists(self.cachedir)
+
+    def test_file_cache(self):
+        files = manifest.FileCache()
+        path = os.path.join(self.site, 'files/web.conf')
+        digest = files.digest(path)
+        assert files.digest(path) == digest and files.text(path) == 'listen 80\n'
+        self.write('files/web.conf', 'listen 8080\n')
+        assert files.digest(path) != digest and files.text(path) == 'listen 8080\n'
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from libcloud.compute.deployment import ScriptDeployment
+
+import provision.config as config
+import provision.nodelib as nodelib
+import provision.steps as steps
+
+from bench.fakecloud import FakeCloud
+
+class LocalClient(object):
+
+    """Runs commands with a local shell, feeding them stdin"""
+
+    def __init__(self):
+        self.runs = 0
+    def run_stdin(self, cmd, stdin):
+        self.runs += 1
+        proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate(stdin)
+        return [stdout, stderr, proc.returncode]
+
+class TruncatingClient(LocalClient):
+    def run_stdin(self, cmd, stdin):
+        stdout, stderr, status = LocalClient.run_stdin(self, cmd, stdin)
+        return [stdout[:len(stdout) // 2], stderr, 255]
+
+class TestScriptBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def script(self, name, text):
+        return ScriptDeployment(text, os.path.join(self.dir, 'deploy', name))
+
+    def test_outputs(self):
+        scripts = [self.script('a.sh', '#!/bin/sh\necho out-a\necho err-a >&2\n'),
+                   self.script('b.sh', '#!/bin/sh\nprintf "no newline"\nexit 3'),
+                   self.script('c.sh', '#!/bin/sh\necho c\n')]
+        batch = steps.ScriptBatchDeployment(scripts)
+        client = LocalClient()
+        batch.run(None, client)
+        assert client.runs == 1
+        assert [(s.stdout, s.stderr, s.exit_status) for s in scripts] == [
+            ('out-a\n', 'err-a\n', 0), ('no newline', '', 3), ('c\n', '', 0)]
+        assert batch.exit_status == 3
+        with open(scripts[0].name) as f:
+            assert f.read() == scripts[0].script
+        assert os.access(scripts[0].name, os.X_OK)
+
+    def test_stdin_and_heredocs(self):
+        scripts = [self.script('read.sh', '#!/bin/sh\ncat\necho read\n'),
+                   self.script('here.sh', "#!/bin/sh\ncat <<'EOF'\n$HOME\nEOF\n"),
+                   self.script('last.sh', '#!/bin/sh\necho last\n')]
+        steps.ScriptBatchDeployment(scripts).run(None, LocalClient())
+        assert scripts[0].stdout == 'read\n'
+        assert scripts[1].stdout == '$HOME\n'
+        assert scripts[2].stdout == 'last\n'
+
+    def test_incomplete_run(self):
+        scripts = [self.script('{0}.sh'.format(i), '#!/bin/sh\necho {0}\n'.format(i))
+                   for i in range(4)]
+        batch = steps.ScriptBatchDeployment(scripts)
+        self.assertRaises(steps.RemoteCommandError, batch.run, None, TruncatingClient())
+
+    def test_digest(self):
+        scripts = [self.script('a.sh', 'echo a')]
+        digest = steps.step_digest(steps.ScriptBatchDeployment(scripts))
+        scripts[0].script = 'echo b'
+        assert digest != steps.step_digest(steps.ScriptBatchDeployment(scripts))
+
+class TestMultiplexDeploy(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k)) for k in
+                          ['PROVIDERS', 'SSH_PORT', 'CACHE_DIR', 'DEFAULT_BOOTSTRAP_BUNDLES'])
+        config.PROVIDERS = dict(config.PROVIDERS)
+        config.DEFAULT_BOOTSTRAP_BUNDLES = []
+        self.cloud = FakeCloud(seed=0)
+        self.provider = self.cloud.install()
+        config.CACHE_DIR = os.path.join(self.cloud.dir, 'cache')
+        scriptmap = {}
+        for i in range(3):
+            path = os.path.join(self.cloud.dir, 'script-{0}.sh'.format(i))
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\necho {0}\nexit {0}\n'.format(i))
+            scriptmap['/root/deploy/script-{0}.sh'.format(i)] = path
+        config.new_bundle('multiplex-test', scriptmap)
+
+    def tearDown(self):
+        self.cloud.close()
+        del config.BUNDLEMAP['multiplex-test']
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+
+    def test_deploy(self):
+        deployment = nodelib.Deployment(bundles=['multiplex-test'], multiplex=True)
+        assert isinstance(deployment.deployment.steps[-1], steps.ScriptBatchDeployment)
+        node = deployment.deploy(nodelib.get_driver(None, 'test', self.provider), 0, 0)
+        assert sorted(sd.stdout for sd in node.script_deployments) == ['0\n', '1\n', '2\n']
+        assert node.sum_exit_status() == 3
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os
+import time
+import unittest
+
+from libcloud.compute.deployment import Deployment
+
+import provision.config as config
+import provision.nodelib as nodelib
+import provision.steps as steps
+
+from bench.fakecloud import FakeCloud
+
+class SleepStep(Deployment):
+
+    """Records when it ran, in place of a script"""
+
+    def __init__(self, name, log, delay=0.1, error=None):
+        self.name = name
+        self.log = log
+        self.delay = delay
+        self.error = error
+        self.exit_status = None
+    def run(self, node, client):
+        start = time.time()
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        self.exit_status = 0
+        self.log[self.name] = (start, time.time())
+        return node
+
+def overlap(a, b):
+    return a[0] < b[1] and b[0] < a[1]
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.log = {}
+
+    def group(self, name, depends=(), locks=(), **kwargs):
+        return steps.ScriptGroup(name, [SleepStep(name, self.log, **kwargs)], depends, locks)
+
+    def test_independent_groups_overlap(self):
+        groups = [self.group(n) for n in 'abc']
+        start = time.time()
+        steps.ParallelScriptDeployment(groups, channels=4).run(None, None)
+        assert time.time() - start < 0.25
+        assert overlap(self.log['a'], self.log['c'])
+
+    def test_depends(self):
+        groups = [self.group('a'), self.group('b', depends=['a']), self.group('c')]
+        steps.ParallelScriptDeployment(groups).run(None, None)
+        assert self.log['b'][0] >= self.log['a'][1]
+        assert overlap(self.log['a'], self.log['c'])
+
+    def test_locks(self):
+        groups = [self.group('a', locks=['dpkg']), self.group('b', locks=['dpkg']),
+                  self.group('c')]
+        steps.ParallelScriptDeployment(groups).run(None, None)
+        assert not overlap(self.log['a'], self.log['b'])
+        assert self.log['b'][0] >= self.log['a'][1]
+        assert overlap(self.log['a'], self.log['c'])
+
+    def test_channels(self):
+        groups = [self.group(n) for n in 'abcd']
+        steps.ParallelScriptDeployment(groups, channels=2).run(None, None)
+        for name in 'cd':
+            assert not overlap(self.log['a'], self.log[name]) or \
+                not overlap(self.log['b'], self.log[name])
+
+    def test_error_stops_scheduling(self):
+        groups = [self.group('a', error=KeyError('a')), self.group('b', depends=['a']),
+                  self.group('c', delay=0.2)]
+        self.assertRaises(KeyError, steps.ParallelScriptDeployment(groups).run, None, None)
+        assert 'b' not in self.log
+        assert 'c' in self.log
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, steps.ParallelScriptDeployment,
+                          [self.group('a', depends=['b']), self.group('b', depends=['a'])])
+        self.assertRaises(ValueError, steps.ParallelScriptDeployment,
+                          [self.group('a', depends=['missing'])])
+
+class TestParallelDeploy(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k)) for k in
+                          ['PROVIDERS', 'SSH_PORT', 'CACHE_DIR', 'DEFAULT_BOOTSTRAP_BUNDLES'])
+        config.PROVIDERS = dict(config.PROVIDERS)
+        config.DEFAULT_BOOTSTRAP_BUNDLES = []
+        self.cloud = FakeCloud(seed=0)
+        self.provider = self.cloud.install()
+        config.CACHE_DIR = os.path.join(self.cloud.dir, 'cache')
+        self.bundles = []
+
+    def tearDown(self):
+        self.cloud.close()
+        for name in self.bundles:
+            del config.BUNDLEMAP[name]
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+
+    def bundle(self, name, text, **kwargs):
+        path = os.path.join(self.cloud.dir, name + '.sh')
+        with open(path, 'w') as f:
+            f.write(text)
+        config.new_bundle(name, {'/root/deploy/{0}.sh'.format(name): path}, **kwargs)
+        self.bundles.append(name)
+
+    def test_groups(self):
+        self.bundle('par-a', 'a')
+        self.bundle('par-files', 'f', depends=['par-a'])
+        config.BUNDLEMAP['par-files'].scriptmap.clear()
+        self.bundle('par-b', 'b', depends=['par-files'], locks=['dpkg'])
+        self.bundle('par-c', 'c')
+        deployment = nodelib.Deployment(bundles=self.bundles, parallel=True)
+        groups = deployment.deployment.steps[-1].groups
+        assert [g.name for g in groups] == ['par-a', 'par-b', 'par-c']
+        assert groups[1].depends == frozenset(['par-a'])
+        assert groups[1].locks == frozenset(['dpkg'])
+        assert groups[2].depends == frozenset(['par-a', 'par-b'])
+
+    def test_deploy(self):
+        self.bundle('par-slow', '#!/bin/sh\nsleep 1\necho slow\n', depends=[])
+        self.bundle('par-fast', '#!/bin/sh\necho fast\n', depends=[])
+        self.bundle('par-after', '#!/bin/sh\necho after\n', depends=['par-fast'])
+        for multiplex in (False, True):
+            deployment = nodelib.Deployment(bundles=self.bundles, parallel=True,
+                                            multiplex=multiplex)
+            start = time.time()
+            node = deployment.deploy(nodelib.get_driver(None, 'test', self.provider), 0, 0)
+            assert [sd.stdout for sd in node.script_deployments] == ['slow\n', 'fast\n', 'after\n']
+            assert node.sum_exit_status() == 0
+            spans = dict((s['args'].get('group'), s) for s in node.trace.to_dicts()
+                         if s['name'] == 'ScriptGroup')
+            assert spans['par-after']['start'] >= spans['par-fast']['end']
+            assert spans['par-after']['end'] < spans['par-slow']['end']
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import time
+import unittest
+
+import provision.catalog as catalog
+import provision.config as config
+import provision.nodelib as nodelib
+
+class MockEntry(object):
+    def __init__(self, name):
+        self.id = self.name = name
+
+class MockNode(object):
+    def __init__(self, name):
+        self.name = name
+        self.public_ip = ['127.0.0.1']
+        self.extra = {'imageId': 1}
+        self.destroyed = False
+    def destroy(self):
+        self.destroyed = True
+        return True
+
+class MockDriver(object):
+
+    """Boots nodes slowly, and records the deployment it was asked to run"""
+
+    type = 'mock'
+    key = 'key'
+    features = {'create_node': []}
+
+    def __init__(self, boot_time):
+        self.boot_time = boot_time
+        self.node = None
+        self.prepared_at_boot = None
+    def create_node(self, **kwargs):
+        self.node = MockNode(kwargs['name'])
+        return self.node
+    def wait_until_running(self, node):
+        time.sleep(self.boot_time)
+        return node
+    def connect_ssh_client(self, ssh_client):
+        return ssh_client
+    def run_deployment_script(self, task, node, ssh_client):
+        self.task = task
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = catalog.Catalog([MockEntry('loc')], [MockEntry('size')],
+                                       [MockEntry(config.IMAGE_NAMES['lucid'])])
+        config.SSH_KEY_PATH = '/dev/null/id_rsa.pem'
+
+    def tearDown(self):
+        del config.SSH_KEY_PATH
+
+    def test_prepare_deferred(self):
+        deployment = nodelib.Deployment(bundles=['mta'])
+        assert deployment._deployment is None
+        assert len(deployment.script_deployments) == 1
+
+    def test_unknown_bundle_fails_early(self):
+        self.assertRaises(KeyError, nodelib.Deployment, bundles=['no-such-bundle'])
+
+    def test_prepared_during_boot(self):
+        deployment = nodelib.Deployment(bundles=['hudson'])
+        driver = MockDriver(0.2)
+        node = deployment.deploy(driver, catalog=self.catalog, pipeline=True)
+        assert driver.task is deployment.deployment
+        assert deployment.timings['prepare_hidden'] == deployment.timings['prepare']
+        assert deployment.timings['boot'] >= 0.2
+        assert node.name == deployment.name
+
+    def test_failed_preparation_destroys_node(self):
+        deployment = nodelib.Deployment(bundles=['mta'])
+        def fail():
+            raise IOError('missing script')
+        deployment._build = fail
+        driver = MockDriver(0)
+        self.assertRaises(IOError, deployment.deploy, driver, catalog=self.catalog,
+                          pipeline=True)
+        assert driver.node.destroyed
@@ -0,0 +1,59 @@
+import unittest
+
+from libcloud.common.types import LibcloudError
+from libcloud.compute.types import NodeState
+
+import provision.poller as poller
+import provision.workers as workers
+
+class MockNode(object):
+    def __init__(self, uuid, state=NodeState.PENDING, public_ip=None):
+        self.uuid = uuid
+        self.state = state
+        self.public_ip = public_ip
+
+class MockDriver(object):
+
+    """Nodes become running after a given number of list_nodes calls"""
+
+    type = 0
+    key = 'user'
+
+    def __init__(self, boot_polls):
+        self.boot_polls = boot_polls
+        self.calls = 0
+
+    def list_nodes(self):
+        self.calls += 1
+        return [MockNode(uuid, NodeState.RUNNING, ['10.0.0.1'])
+                if self.calls >= polls else MockNode(uuid)
+                for uuid, polls in self.boot_polls.items()]
+
+class TestPoller(unittest.TestCase):
+
+    def setUp(self):
+        self.poller = poller.NodeStatePoller(max_wait_period=0.02)
+
+    def test_single_list_per_tick(self):
+        boot_polls = dict(('node%d' % i, 3) for i in range(10))
+        driver = MockDriver(boot_polls)
+        results = workers.map_bounded(
+            lambda uuid: self.poller.wait(driver, MockNode(uuid), 0.01, 10),
+            sorted(boot_polls), 10)
+        assert all(r.ok and r.value.state == NodeState.RUNNING for r in results)
+        assert driver.calls < 10
+
+    def test_missing_node(self):
+        driver = MockDriver({'other': 1})
+        self.assertRaises(LibcloudError, self.poller.wait,
+                          driver, MockNode('missing'), 0.01, 10)
+
+    def test_timeout(self):
+        driver = MockDriver({'slow': 1000})
+        self.assertRaises(LibcloudError, self.poller.wait,
+                          driver, MockNode('slow'), 0.01, 0.05)
+
+    def test_polls_until_running(self):
+        driver = MockDriver({'node': 6})
+        self.poller.wait(driver, MockNode('node'), 0.001, 10)
+        assert driver.calls == 6
@@ -0,0 +1,104 @@
+import os
+import unittest
+
+import provision.config as config
+import provision.nodelib as nodelib
+import provision.pool as pool
+
+from bench.fakecloud import FakeCloud
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k)) for k in
+                          ['PROVIDERS', 'SSH_PORT', 'CACHE_DIR', 'DEFAULT_BOOTSTRAP_BUNDLES'])
+        config.PROVIDERS = dict(config.PROVIDERS)
+        self.cloud = FakeCloud(seed=0)
+        self.provider = self.cloud.install()
+        config.CACHE_DIR = os.path.join(self.cloud.dir, 'cache')
+        for name in ('pool-default', 'pool-job'):
+            script = os.path.join(self.cloud.dir, name + '.sh')
+            with open(script, 'w') as f:
+                f.write('#!/bin/sh\necho {0} >> $HOME/installed\n'.format(name))
+            config.new_bundle(name, {'/root/deploy/{0}.sh'.format(name): script})
+        config.DEFAULT_BOOTSTRAP_BUNDLES = ['pool-default']
+        self.factory = lambda: nodelib.get_driver(None, 'test', self.provider)
+
+    def tearDown(self):
+        self.cloud.close()
+        for name in ('pool-default', 'pool-job'):
+            del config.BUNDLEMAP[name]
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+
+    def installed(self, node):
+        root = self.cloud.roots[node.extra['password']]
+        with open(os.path.join(root, 'root/installed')) as f:
+            return f.read().split()
+
+    def test_fill_claim_refill(self):
+        standby = pool.Pool(self.factory, size=2)
+        results = standby.fill()
+        assert len(results) == 2 and all(r.ok for r in results), [r.tb for r in results]
+        assert [e['state'] for e in standby.list()] == [pool.READY, pool.READY]
+        assert standby.fill() == []
+
+        deployment = nodelib.Deployment(bundles=['pool-job'])
+        node = standby.deploy(deployment)
+        assert node.name.startswith(config.POOL_PREFIX + 'lucid-')
+        assert self.installed(node) == ['pool-default', 'pool-job']
+        assert [sd.stdout for sd in node.script_deployments] == ['']
+        assert self.cloud.calls['create_node'] == 2
+        assert sorted(e['state'] for e in standby.list()) == [pool.CLAIMED, pool.READY]
+
+        assert len(standby.fill()) == 1
+        assert self.cloud.calls['create_node'] == 3
+
+    def test_keeps_node_name(self):
+        standby = pool.Pool(self.factory, size=1)
+        standby.fill()
+        with open(config.BUNDLEMAP['pool-job'].scriptmap['/root/deploy/pool-job.sh'], 'w') as f:
+            f.write('#!/bin/sh\n# provision-template-type: format-string\n'
+                    'echo {node_name} >> $HOME/installed\n')
+        deployment = nodelib.Deployment(bundles=['pool-job'])
+        deployment.prepare()
+        node = standby.deploy(deployment)
+        assert deployment.name == node.name
+        assert self.installed(node) == ['pool-default', node.name]
+        assert deployment.tracer.name == node.name
+
+    def test_claimed_elsewhere(self):
+        standby = pool.Pool(self.factory, size=1)
+        standby.fill()
+        entry, node = standby.claim()
+        root = self.cloud.roots[entry['password']]
+        assert os.path.isdir(os.path.join(root, 'root/deploy', config.POOL_CLAIM_NAME))
+        standby.update(entry['name'], {'state': pool.READY})
+        assert standby.claim() == (None, None)
+
+    def test_empty_pool(self):
+        standby = pool.Pool(self.factory, size=1)
+        assert standby.deploy(nodelib.Deployment(bundles=['pool-job'])) is None
+
+    def test_reap(self):
+        standby = pool.Pool(self.factory, size=2, ttl=0)
+        standby.fill()
+        entry, node = standby.claim()
+        reaped = standby.reap()
+        assert len(reaped) == 1 and entry['name'] not in reaped
+        assert [e['name'] for e in standby.list()] == [entry['name']]
+        assert [n.name for n in self.factory().list_nodes()] == [entry['name']]
+
+        self.cloud.destroy_node(node)
+        standby.reap()
+        assert standby.list() == []
+
+    def test_failed_fill(self):
+        self.cloud.failure_rates['create_node'] = 1
+        standby = pool.Pool(self.factory, size=1)
+        results = standby.fill()
+        assert not results[0].ok
+        assert standby.list() == []
+
+if __name__ == '__main__':
+    unittest.main()
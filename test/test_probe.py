@@ -0,0 +1,207 @@
+import socket
+import threading
+import time
+import unittest
+
+from libcloud.common.types import LibcloudError
+
+import provision.engine as engine
+import provision.patches as patches
+import provision.probe as probe
+
+class BannerServer(object):
+
+    """Accepts connections on a local port, sending banner to each,
+    and counting them, once started"""
+
+    def __init__(self, banner=b'SSH-2.0-OpenSSH_5.3\r\n'):
+        self.banner = banner
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.accepted = 0
+
+    def start(self):
+        self.sock.listen(128)
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+        return self
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            self.accepted += 1
+            if self.banner:
+                conn.sendall(self.banner)
+            conn.close()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+def closed_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class MockSSHClient(object):
+
+    def __init__(self, port):
+        self.hostname = '127.0.0.1'
+        self.port = port
+        self.username = 'root'
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+        return True
+
+    def run(self, command):
+        return ['/root\n', '', 0]
+
+    def close(self):
+        pass
+
+class MockDriver(object):
+    pass
+
+class TestProbe(unittest.TestCase):
+
+    def setUp(self):
+        self.prober = probe.ReadinessProber(max_wait_period=0.05, attempt_timeout=0.5)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def server(self, *args):
+        server = BannerServer(*args)
+        self.servers.append(server)
+        return server
+
+    def test_ready(self):
+        server = self.server().start()
+        p = self.prober.wait('127.0.0.1', server.port, 5, 0.01)
+        assert p.attempts == 1
+        assert server.accepted == 1
+        assert p.sock is None
+
+    def test_closed_port(self):
+        start = time.time()
+        try:
+            self.prober.wait('127.0.0.1', closed_port(), 0.2, 0.01)
+        except probe.NotReadyError as e:
+            assert 'refused' in str(e), e
+        else:
+            assert False, 'closed port probed ready'
+        assert time.time() - start < 1
+
+    def test_no_banner(self):
+        server = self.server(b'').start()
+        self.assertRaises(probe.NotReadyError, self.prober.wait,
+                          '127.0.0.1', server.port, 0.2, 0.01)
+        assert server.accepted > 1
+
+    def test_ready_once_listening(self):
+        server = self.server()
+        threading.Timer(0.2, server.start).start()
+        p = self.prober.wait('127.0.0.1', server.port, 5, 0.01)
+        assert p.attempts > 1
+        assert server.accepted == 1
+
+    def test_one_thread_for_many(self):
+        server = self.server()
+        threading.Timer(0.1, server.start).start()
+        before = threading.active_count()
+        waits = []
+        for i in range(50):
+            self.prober.watch('127.0.0.1', server.port, 5,
+                              lambda p, error: waits.append(error), 0.01)
+        assert threading.active_count() <= before + 1
+        deadline = time.time() + 5
+        while len(waits) < 50 and time.time() < deadline:
+            time.sleep(0.01)
+        assert waits == [None] * 50
+        assert server.accepted == 50
+
+    def test_prober_failure(self):
+        def step(probe, now, ready):
+            raise RuntimeError('broken')
+        self.prober.step = step
+        self.assertRaises(RuntimeError, self.prober.wait, '127.0.0.1', closed_port(), 5, 0.01)
+        assert self.prober.thread is None and self.prober.probes == []
+
+    def test_lost_callback(self):
+        self.prober.finish = lambda probe, error: None
+        start = time.time()
+        try:
+            self.prober.wait('127.0.0.1', closed_port(), 0.1, 0.01)
+        except probe.NotReadyError as e:
+            assert 'did not finish' in str(e), e
+        else:
+            assert False, 'closed port probed ready'
+        assert time.time() - start < 0.1 + 0.5 + 1 + 0.5
+        del self.prober.probes[:] # let the probing thread finish
+
+    def test_back_off(self):
+        p = probe.Probe('127.0.0.1', 22, time.time() + 10, None, 1)
+        periods = []
+        for i in range(6):
+            now = time.time()
+            p.back_off(now, None, 2, 10)
+            periods.append(p.wait_period)
+            assert now + 1 - probe.JITTER <= p.due <= now + 10
+        assert periods == [2, 4, 8, 10, 10, 10]
+
+class TestConnect(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = probe._prober
+        probe._prober = probe.ReadinessProber(max_wait_period=0.05, attempt_timeout=0.5)
+        self.server = BannerServer().start()
+
+    def tearDown(self):
+        self.server.close()
+        probe._prober = self.saved
+
+    def test_no_handshake_until_ready(self):
+        client = MockSSHClient(closed_port())
+        self.assertRaises(LibcloudError, patches.NodeDriver_connect_ssh_client,
+                          MockDriver(), client, 0.01, 0.2)
+        assert client.connects == 0
+
+    def test_connect(self):
+        client = MockSSHClient(self.server.port)
+        assert patches.NodeDriver_connect_ssh_client(MockDriver(), client, 0.01, 5) is client
+        assert client.connects == 1
+
+    def test_connect_async(self):
+        loop = engine.Loop(workers=2)
+        try:
+            clients = [MockSSHClient(self.server.port) for i in range(10)]
+            futures = loop.run_until_complete(engine.gather(loop, [
+                        engine.connect_ssh_client(loop, MockDriver(), c, 0.01, 5)
+                        for c in clients]))
+            assert [f.result() for f in futures] == clients
+            assert all(c.connects == 1 for c in clients)
+
+            client = MockSSHClient(closed_port())
+            self.assertRaises(LibcloudError, loop.run_until_complete,
+                              engine.connect_ssh_client(loop, MockDriver(), client, 0.01, 0.2))
+            assert client.connects == 0
+        finally:
+            loop.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import provision.config as config
+import provision.nodelib as nodelib
+import provision.run as run_nodes
+
+from bench.fakecloud import FakeCloud
+
+class MockClient(object):
+    def __init__(self):
+        self.closed = False
+    def close(self):
+        self.closed = True
+
+class MockNode(object):
+    name = 'web-1'
+    public_ip = ['127.0.0.1']
+    extra = {'password': 'secret'}
+
+class FailingDriver(object):
+
+    """Connects, then fails to run the deployment"""
+
+    def __init__(self):
+        self.client = MockClient()
+        self.timeouts = []
+    def connect_ssh_client(self, client, timeout):
+        return self.client
+    def run_deployment_script(self, task, node, client, timeout):
+        self.timeouts.append(timeout)
+        raise Exception('failed after 3 tries')
+
+class TestRunOnNode(unittest.TestCase):
+
+    def test_failure_closes_client(self):
+        driver = FailingDriver()
+        deployment = nodelib.Deployment(bundles=[], keys=False, defaults=False)
+        self.assertRaises(Exception, nodelib.run_on_node, driver, MockNode(), None,
+                          deployment, 10)
+        assert driver.client.closed
+        assert 9 < driver.timeouts[0] <= 10
+
+class TestRun(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k)) for k in
+                          ['PROVIDERS', 'SSH_PORT', 'CACHE_DIR', 'SUBMAP'])
+        config.PROVIDERS = dict(config.PROVIDERS)
+        config.SUBMAP = dict(config.SUBMAP)
+        self.cloud = FakeCloud(seed=0)
+        self.provider = self.cloud.install()
+        config.CACHE_DIR = os.path.join(self.cloud.dir, 'cache')
+        driver = nodelib.get_driver(None, 'test', self.provider)
+        image = driver.list_images()[0]
+        for name in ['web-1', 'web-2', 'web-10', 'db-1']:
+            self.cloud.create_node(driver, name, image)
+
+        source = os.path.join(self.cloud.dir, 'motd')
+        with open(source, 'w') as f:
+            f.write('welcome')
+        script = os.path.join(self.cloud.dir, 'greet.sh')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\n# provision-template-type: format-string\n'
+                    'echo {node_name} {greeting} $(cat $HOME/etc/motd)\n')
+        config.new_bundle('run-test', {'/root/deploy/greet.sh': script},
+                          {'/root/etc/motd': source})
+
+    def tearDown(self):
+        self.cloud.close()
+        del config.BUNDLEMAP['run-test']
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+
+    def run_nodes(self, names=[], prefix=[], command=None, bundles=[], format='text',
+                  subvars=[]):
+        parsed = argparse.Namespace(names=names, prefix=prefix, file=[], command=command,
+                                    bundles=bundles, subvars=subvars, format=format,
+                                    timeout=10, workers=4, secret_key=None, userid='test',
+                                    provider=self.provider)
+        out, err = StringIO(), StringIO()
+        retcode = run_nodes.run(parsed, out, err)
+        return retcode, out.getvalue(), err.getvalue()
+
+    def test_command(self):
+        retcode, out, err = self.run_nodes(['web-?', 'db-1'], command='echo hi; echo oops >&2')
+        assert retcode == 0, err
+        assert sorted(out.splitlines()) == ['db-1: hi', 'web-1: hi', 'web-2: hi']
+        assert 'web-1: oops' in err
+        assert 'ran on 3 of 3 nodes: 0 failed, 0 exited nonzero, 0 names not found' in err
+
+    def test_exit_status_and_missing(self):
+        retcode, out, err = self.run_nodes(['web-1', 'missing'], command='exit 3')
+        assert retcode == 1
+        assert 'no node named missing' in err
+        assert 'web-1: exit 3 exited with 3' in err
+        assert 'ran on 1 of 1 nodes: 0 failed, 1 exited nonzero, 1 names not found' in err
+
+    def test_bundles_json(self):
+        retcode, out, err = self.run_nodes(prefix=['web-1'], bundles=['run-test'],
+                                           format='json', subvars=['greeting=hello'])
+        assert retcode == 0, err
+        records = sorted((json.loads(l) for l in out.splitlines()), key=lambda r: r['name'])
+        assert [r['name'] for r in records] == ['web-1', 'web-10']
+        for record in records:
+            assert record['error'] is None
+            assert record['results'] == [{'name': '/root/deploy/greet.sh',
+                                          'stdout': '{0} hello welcome\n'.format(
+                        record['name']), 'stderr': '', 'exit_status': 0}]
+        for node in self.cloud.nodes.values():
+            keys = os.path.join(self.cloud.roots[node.extra['password']], 'root/.ssh')
+            assert not os.path.exists(keys)
+
+    def test_driver_per_worker(self):
+        drivers = []
+        def factory():
+            drivers.append(nodelib.get_driver(None, 'test', self.provider))
+            return drivers[-1]
+        nodes = nodelib.list_nodes(factory())
+        results = nodelib.run_many(nodes, factory, 'true', workers=2, timeout=10)
+        assert all(r.ok for r in results), results
+        assert len(drivers) <= 3
+
+    def test_duplicate_names(self):
+        driver = nodelib.get_driver(None, 'test', self.provider)
+        self.cloud.create_node(driver, 'web-1', driver.list_images()[0])
+        nodes = [n for n in nodelib.list_nodes(driver) if n.name == 'web-1']
+        assert len(nodes) == 2
+        used = []
+        run_on_node = nodelib.run_on_node
+        def record(driver, node, command, deployment, timeout):
+            used.append(deployment)
+            return run_on_node(driver, node, command, deployment, timeout)
+        nodelib.run_on_node = record
+        try:
+            results = nodelib.run_many(nodes, lambda: driver, bundles=['run-test'],
+                                       subvars=['greeting=hello'], timeout=10)
+        finally:
+            nodelib.run_on_node = run_on_node
+        assert all(r.ok for r in results), results
+        assert len(set(map(id, used))) == 2
+
+    def test_unreachable(self):
+        self.cloud.boot_time = 3600
+        driver = nodelib.get_driver(None, 'test', self.provider)
+        self.cloud.create_node(driver, 'web-booting', driver.list_images()[0])
+        retcode, out, err = self.run_nodes(prefix=['web-'], command='true')
+        assert retcode == 1
+        assert 'web-booting: ERROR node web-booting has no public IP address' in err
+        assert 'ran on 3 of 4 nodes: 1 failed' in err
+
+    def test_usage_errors(self):
+        assert self.run_nodes(command='true')[0] == 1
+        assert self.run_nodes(['web-1'])[0] == 1
+        assert self.run_nodes(['web-1'], command='true', bundles=['run-test'])[0] == 1
+        retcode, out, err = self.run_nodes(['web-1'], bundles=['no-such-bundle'])
+        assert 'unknown bundle no-such-bundle' in err
+
+if __name__ == '__main__':
+    unittest.main()
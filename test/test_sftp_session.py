@@ -0,0 +1,90 @@
+import io
+import tempfile
+import unittest
+
+import provision.config as config
+import libcloud.compute.deployment
+import libcloud.compute.ssh
+
+class MockFile(object):
+    def __init__(self, sftp, path):
+        self.sftp = sftp
+        self.path = path
+    def set_pipelined(self, pipelined):
+        pass
+    def write(self, data):
+        self.sftp.writes.append(len(data))
+        self.sftp.files[self.path] = self.sftp.files.get(self.path, '') + data
+    def chmod(self, mode):
+        pass
+    def close(self):
+        pass
+
+class MockSFTP(object):
+    def __init__(self):
+        self.mkdirs = []
+        self.files = {}
+        self.writes = []
+        self.closed = False
+    def mkdir(self, path):
+        self.mkdirs.append(path)
+    def file(self, path, mode='w'):
+        return MockFile(self, path)
+    def close(self):
+        self.closed = True
+
+class MockParamikoClient(object):
+    def __init__(self):
+        self.sessions = []
+    def open_sftp(self):
+        self.sessions.append(MockSFTP())
+        return self.sessions[-1]
+    def close(self):
+        pass
+
+class TestSFTPSession(unittest.TestCase):
+
+    def setUp(self):
+        config.patch_libcloud()
+        self.client = libcloud.compute.ssh.ParamikoSSHClient('localhost')
+        self.client.client = MockParamikoClient()
+
+    def test_one_session_per_connection(self):
+        for name in ['a', 'b', 'c']:
+            self.client.put('/root/deploy/' + name, contents=name)
+        assert len(self.client.client.sessions) == 1
+        assert sorted(self.client.client.sessions[0].files) == [
+            '/root/deploy/a', '/root/deploy/b', '/root/deploy/c']
+
+    def test_directories_created_once(self):
+        self.client.put('/root/.emacs.d/init.el', contents='')
+        self.client.put('/root/.screenrc', contents='')
+        self.client.put('.ssh/authorized_keys', contents='key')
+        self.client.put('.ssh/config', contents='')
+        assert self.client.client.sessions[0].mkdirs == [
+            '/root', '/root/.emacs.d', '.ssh']
+
+    def test_close_ends_session(self):
+        self.client.put('/tmp/a', contents='')
+        self.client.close()
+        assert self.client.client.sessions[0].closed
+        self.client.put('/tmp/b', contents='')
+        assert len(self.client.client.sessions) == 2
+        assert self.client.client.sessions[1].mkdirs == ['/tmp']
+
+    def test_file_like_contents_streamed(self):
+        self.client.put('/tmp/big', contents=io.BytesIO(b'x' * 1000), bufsize=300)
+        sftp = self.client.client.sessions[0]
+        assert sftp.writes == [300, 300, 300, 100]
+        assert len(sftp.files['/tmp/big']) == 1000
+
+    def test_file_deployment_memory_mapped(self):
+        source = tempfile.NamedTemporaryFile()
+        source.write(b'y' * 1000)
+        source.flush()
+        deployment = libcloud.compute.deployment.FileDeployment(
+            '/tmp/mapped', source.name, bufsize=400, mmap_threshold=1)
+        deployment.run(None, self.client)
+        sftp = self.client.client.sessions[0]
+        assert sftp.writes == [400, 400, 200]
+        assert sftp.files['/tmp/mapped'] == b'y' * 1000
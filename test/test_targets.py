@@ -0,0 +1,79 @@
+import json
+import os
+import unittest
+
+import provision.config as config
+import provision.nodelib as nodelib
+
+from libcloud.compute.base import NodeLocation
+
+from bench.fakecloud import FakeCloud
+
+class TestSpread(unittest.TestCase):
+
+    def test_weights(self):
+        a, b, c = [nodelib.Target(p, weight=w) for p, w in [('a', 3), ('b', 1), ('c', 1)]]
+        assert nodelib.spread([a, b, c], 5) == [a, b, a, c, a]
+        assert nodelib.spread([a, b, c], 10).count(a) == 6
+        assert nodelib.spread([b], 2) == [b, b]
+        assert nodelib.spread([a, b], 0) == []
+
+    def test_parse(self):
+        target = nodelib.Target.parse('rackspace/2=3', 'user', 'key')
+        assert (target.provider, target.location_id, target.weight) == ('rackspace', 2, 3)
+        assert (target.userid, target.secret_key) == ('user', 'key')
+        target = nodelib.Target.parse('rackspace')
+        assert (target.location_id, target.weight) == (config.DEFAULT_LOCATION_ID, 1)
+        for text in ['rackspace=0', 'rackspace/west', 'rackspace=x']:
+            self.assertRaises(ValueError, nodelib.Target.parse, text)
+
+class TestTargets(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((k, getattr(config, k)) for k in
+                          ['PROVIDERS', 'SSH_PORT', 'CACHE_DIR', 'CREDENTIALS'])
+        config.PROVIDERS = dict(config.PROVIDERS)
+        self.cloud = FakeCloud(seed=0)
+        self.provider = self.cloud.install()
+        self.cloud.install('fake-west')
+        self.cloud.locations.append(NodeLocation(1, 'west', 'IE', None))
+        config.CREDENTIALS = {'fake-west': ('west', None)}
+        config.CACHE_DIR = os.path.join(self.cloud.dir, 'cache')
+
+    def tearDown(self):
+        self.cloud.close()
+        for k, v in self.saved.items():
+            setattr(config, k, v)
+
+    def deploy(self, targets, count, event_loop=False):
+        deployments = [nodelib.Deployment(bundles=[]) for i in range(count)]
+        return nodelib.deploy_to_targets(deployments, targets, workers=4,
+                                         event_loop=event_loop)
+
+    def placement(self, node):
+        path = os.path.join(self.cloud.dir, node.name + '.json')
+        node.write_json(path)
+        with open(path) as f:
+            info = json.load(f)
+        return info['provider'], info['location_name'], info['country']
+
+    def test_placement(self):
+        for event_loop in (False, True):
+            targets = [nodelib.Target(self.provider, 0, 2, 'test'),
+                       nodelib.Target('fake-west', 1)]
+            results = self.deploy(targets, 3, event_loop)
+            assert all(r.ok for r in results), [r.tb for r in results]
+            assert [self.placement(r.value) for r in results] == [
+                (self.provider, 'local', 'US'), ('fake-west', 'west', 'IE'),
+                (self.provider, 'local', 'US')]
+        assert self.cloud.calls['list_locations'] == 2
+
+    def test_failed_target(self):
+        targets = [nodelib.Target('missing'), nodelib.Target(self.provider, userid='test')]
+        results = self.deploy(targets, 4)
+        assert [r.ok for r in results] == [False, True, False, True]
+        assert isinstance(results[0].error, KeyError)
+        assert self.cloud.calls['create_node'] == 2
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+
+import provision.config as config
+import provision.templates as templates
+
+FORMAT_SCRIPT = '''# provision-template-type: format-string
+echo {node_name} {{literal}} {count:>4} {name!r} {items[1]} {ci.real}
+echo {node_name}-done
+'''
+
+TEMPLATE_SCRIPT = '''# provision-template-type: template-string
+echo $node_name ${ci_user_host}x $$escaped $missing ${missing} $ 100%
+awk '{print $2}'
+'''
+
+class TestTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = templates.TemplateCache()
+        self.submap = {'node_name': 'web-1', 'count': 7, 'name': 'n', 'items': ('a', 'b'),
+                       'ci': 3, 'ci_user_host': 'user@host'}
+
+    def expected(self, script, submap):
+        kind = templates.template_type(script)
+        return config.TEMPLATE_TYPEMAP[kind](script, submap) if kind else script
+
+    def test_same_as_typemap(self):
+        scripts = [FORMAT_SCRIPT, TEMPLATE_SCRIPT, 'echo {plain} $plain\n']
+        scripts.extend([s + '# padding\n' * 1000 for s in scripts]) # joined, not formatted
+        for script in scripts:
+            for name in ['web-1', 'web-2']:
+                submap = dict(self.submap, node_name=name)
+                assert self.cache.render(script, submap) == self.expected(script, submap)
+
+    def test_nested_format_spec(self):
+        script = '# provision-template-type: format-string\n{count:>{width}}\n'
+        submap = dict(self.submap, width=6)
+        assert isinstance(self.cache.compile(script), templates.FunctionTemplate)
+        assert self.cache.render(script, submap) == self.expected(script, submap)
+
+    def test_missing_format_variable(self):
+        self.assertRaises(KeyError, self.cache.render, FORMAT_SCRIPT, {'node_name': 'x'})
+
+    def test_positional_fields(self):
+        for field in ['{0}', '{}', '{1.real}']:
+            script = '# provision-template-type: format-string\necho ' + field
+            self.assertRaises(IndexError, self.expected, script, self.submap)
+            self.assertRaises(IndexError, self.cache.render, script, self.submap)
+
+    def test_equal_values_of_other_types(self):
+        script = '# provision-template-type: format-string\necho {x}\n'
+        for x in [True, 1, 1.0, 1, True]:
+            assert self.cache.render(script, {'x': x}) == self.expected(script, {'x': x})
+
+    def test_unsupported_type(self):
+        script = '# provision-template-type: mako\n${x}\n'
+        self.assertRaises(KeyError, self.cache.render, script, {})
+        config.TEMPLATE_TYPEMAP['upper'] = lambda text, submap: text.upper()
+        try:
+            assert self.cache.render('# provision-template-type: upper\nx', {}) == \
+                '# PROVISION-TEMPLATE-TYPE: UPPER\nX'
+        finally:
+            del config.TEMPLATE_TYPEMAP['upper']
+
+    def test_bound_once_per_fleet(self):
+        template = self.cache.compile(FORMAT_SCRIPT)
+        assert template.keys == frozenset(['node_name', 'count', 'name', 'items', 'ci'])
+        for i in range(10):
+            self.cache.render(FORMAT_SCRIPT, dict(self.submap, node_name='web-{0}'.format(i)))
+        assert len(self.cache.compiled) == 1 and len(self.cache.bound) == 1
+        bound = list(self.cache.bound.values())[0]
+        assert [s.key for s in bound.segments if isinstance(s, templates.Field)] == \
+            ['node_name', 'node_name']
+        assert len(bound.segments) == 5
+
+        self.cache.render(FORMAT_SCRIPT, dict(self.submap, count=8))
+        assert len(self.cache.bound) == 2
+        self.cache.render(FORMAT_SCRIPT, dict(self.submap, unused=1))
+        assert len(self.cache.bound) == 2
+
+    def test_cache_size(self):
+        cache = templates.TemplateCache(size=2)
+        for i in range(3):
+            cache.render('echo {0}\n'.format(i), {})
+        assert len(cache.compiled) == 1
+
+if __name__ == '__main__':
+    unittest.main()
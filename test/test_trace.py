@@ -0,0 +1,116 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from libcloud.compute.deployment import ScriptDeployment
+
+import provision.catalog as catalog
+import provision.config as config
+import provision.nodelib as nodelib
+import provision.steps as steps
+import provision.trace as trace
+
+from test.test_pipeline import MockDriver, MockEntry
+
+class MockClient(object):
+    def put(self, path, contents=None, chmod=None, **kwargs):
+        pass
+    def run(self, cmd):
+        return ['out', '', 3]
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_span(self):
+        tracer = trace.Tracer('node')
+        with tracer.span('outer', size=1) as args:
+            with tracer.span('inner'):
+                pass
+            args['result'] = 2
+        spans = tracer.to_dicts()
+        assert [s['name'] for s in spans] == ['outer', 'inner']
+        assert spans[0]['args'] == {'size': 1, 'result': 2}
+        assert spans[0]['duration'] >= spans[1]['duration'] >= 0
+
+    def test_span_recorded_on_error(self):
+        tracer = trace.Tracer('node')
+        try:
+            with tracer.span('failing'):
+                raise ValueError()
+        except ValueError:
+            pass
+        assert tracer.spans[0].end is not None
+
+    def test_activate_per_thread(self):
+        tracer = trace.Tracer('node')
+        seen = []
+        with trace.activate(tracer):
+            t = threading.Thread(target=lambda: seen.append(trace.current()))
+            t.start()
+            t.join()
+            assert trace.current() is tracer
+        assert seen == [trace.NULL]
+        assert trace.current() is trace.NULL
+
+    def test_null_tracer(self):
+        with trace.NULL.span('ignored') as args:
+            args['x'] = 1
+        assert trace.NULL.spans == []
+
+    def test_traced_deployment(self):
+        script = ScriptDeployment('exit 3', '/root/script.sh')
+        deployment = steps.TracedDeployment([script])
+        tracer = trace.Tracer('node')
+        with trace.activate(tracer):
+            deployment.run(None, MockClient())
+        span = tracer.to_dicts()[0]
+        assert span['name'] == 'ScriptDeployment'
+        assert span['args'] == {'index': 0, 'target': '/root/script.sh', 'bytes': 6,
+                                'exit_status': 3}
+
+    def test_chrome_trace(self):
+        tracers = [trace.Tracer('a'), trace.Tracer('b')]
+        for tracer in tracers:
+            with tracer.span('create_node'):
+                pass
+        path = os.path.join(self.dir, 'trace.json')
+        trace.write_chrome_trace(path, tracers)
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        spans = [e for e in events if e['ph'] == 'X']
+        names = [e for e in events if e['ph'] == 'M']
+        assert len(spans) == 2
+        assert len(set(e['tid'] for e in spans)) == 2
+        assert sorted(e['args']['name'].split()[0] for e in names) == ['a', 'b']
+
+class TestDeploymentTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = catalog.Catalog([MockEntry('loc')], [MockEntry('size')],
+                                       [MockEntry(config.IMAGE_NAMES['lucid'])])
+        config.SSH_KEY_PATH = '/dev/null/id_rsa.pem'
+
+    def tearDown(self):
+        del config.SSH_KEY_PATH
+
+    def test_phases(self):
+        deployment = nodelib.Deployment(bundles=['mta'])
+        node = deployment.deploy(MockDriver(0), 0, 0, self.catalog, pipeline=True)
+        names = [s['name'] for s in node.trace.to_dicts()]
+        for phase in ['create_node', 'prepare', 'wait_until_running', 'connect_ssh_client',
+                      'run_deployment_script']:
+            assert phase in names, phase
+        assert deployment.tracer is node.trace
+        prepare = [s for s in node.trace.to_dicts() if s['name'] == 'prepare'][0]
+        assert prepare['thread'].startswith('provision-prepare')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import threading
+import time
+import unittest
+
+import provision.workers as workers
+
+class TestWorkers(unittest.TestCase):
+
+    def test_results_in_item_order(self):
+        def slow_square(n):
+            time.sleep(0.01 * (5 - n))
+            return n * n
+        results = workers.map_bounded(slow_square, range(5), 5)
+        assert [r.value for r in results] == [0, 1, 4, 9, 16]
+        assert all(r.ok for r in results)
+
+    def test_exceptions_captured_per_item(self):
+        def fail_odd(n):
+            if n % 2:
+                raise ValueError(n)
+            return n
+        results = workers.map_bounded(fail_odd, range(4), 2)
+        assert [r.ok for r in results] == [True, False, True, False]
+        assert isinstance(results[1].error, ValueError)
+        assert 'ValueError' in results[1].tb
+
+    def test_concurrency_bounded(self):
+        lock = threading.Lock()
+        active = [0, 0] # current, maximum
+        def track(n):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+        workers.map_bounded(track, range(20), 3)
+        assert active[1] == 3
+
+    def test_callback(self):
+        seen = []
+        workers.map_bounded(lambda n: n, range(3), 2, seen.append)
+        assert sorted(r.value for r in seen) == [0, 1, 2]
+
+    def test_empty(self):
+        assert workers.map_bounded(lambda n: n, [], 4) == []